@@ -80,27 +80,47 @@ MODULES.append( ('leptonFakeRateQCDVarsSusy', lambda : LeptonFakeRateQCDVars(
 #from CMGTools.TTHAnalysis.tools.leptonJetReCleaner import _susy2lss_multiIso_withMiniIsoRelaxed_ConePtJetPtRatio,_susy2lss_multiIso_withMiniIsoRelaxed_CutForFO4
 
 from CMGTools.TTHAnalysis.tools.objTagger import ObjTagger
+from CMGTools.TTHAnalysis.tools.leptonJetReCleaner import _susy2lss_lepId_CBloose_columns,_susy2lss_lepId_loosestFO_columns,_susy2lss_lepId_tighterFO_columns,_susy2lss_lepId_IPcuts_columns
+# the columnSel are used when reading the events in chunks (--read-chunk)
 MODULES.append ( ('leptonFakeRateFO2', lambda: ObjTagger('FO2','LepGood',[
                 lambda lep: lep.miniRelIso<0.4,
                 lambda lep: _susy2lss_lepId_CBloose(lep),
                 lambda lep: _susy2lss_lepId_loosestFO(lep),
                 lambda lep: _susy2lss_lepId_IPcuts(lep),
+                ], columnSel = [
+                lambda lep: lep.miniRelIso<0.4,
+                _susy2lss_lepId_CBloose_columns,
+                _susy2lss_lepId_loosestFO_columns,
+                _susy2lss_lepId_IPcuts_columns,
                 ] ) ) )
 MODULES.append ( ('leptonFakeRateFO2iso', lambda: ObjTagger('FO2iso','LepGood',[
                 lambda lep: lep.miniRelIso<0.4,
                 lambda lep: _susy2lss_lepId_CBloose(lep),
                 lambda lep: _susy2lss_lepId_tighterFO(lep),
                 lambda lep: _susy2lss_lepId_IPcuts(lep),
+                ], columnSel = [
+                lambda lep: lep.miniRelIso<0.4,
+                _susy2lss_lepId_CBloose_columns,
+                _susy2lss_lepId_tighterFO_columns,
+                _susy2lss_lepId_IPcuts_columns,
                 ] ) ) )
 MODULES.append ( ('leptonFakeRateFO2InSitu', lambda: ObjTagger('FO2InSitu','LepGood',[
                 lambda lep: lep.miniRelIso<0.4,
                 lambda lep: _susy2lss_lepId_CBloose(lep),
                 lambda lep: _susy2lss_lepId_loosestFO(lep),
+                ], columnSel = [
+                lambda lep: lep.miniRelIso<0.4,
+                _susy2lss_lepId_CBloose_columns,
+                _susy2lss_lepId_loosestFO_columns,
                 ] ) ) )
 MODULES.append ( ('leptonFakeRateFO2isoInSitu', lambda: ObjTagger('FO2isoInSitu','LepGood',[
                 lambda lep: lep.miniRelIso<0.4,
                 lambda lep: _susy2lss_lepId_CBloose(lep),
                 lambda lep: _susy2lss_lepId_tighterFO(lep),
+                ], columnSel = [
+                lambda lep: lep.miniRelIso<0.4,
+                _susy2lss_lepId_CBloose_columns,
+                _susy2lss_lepId_tighterFO_columns,
                 ] ) ) )
 
 # obsolete: it is now calculated in ntupleTypes
@@ -137,7 +157,10 @@ MODULES.append ( ('recalcLepAwareVars',ObjFloatCalc("recalcLepAwareVars","LepGoo
                 "jetPtRelv2_p4": (lambda lep : friendPtRelv2(lep,1.04)),
                 "jetPtRatio_LepAwareJECv2_p5": (lambda lep : friendPtRatiov2(lep,1.05)),
                 "jetPtRelv2_p5": (lambda lep : friendPtRelv2(lep,1.05)),
-                })) )
+                }, columnVars = dict(
+                [ ("jetPtRatio_LepAwareJECv2_p%d" % i, (lambda lep, c=c : friendPtRatiov2Columns(lep,c))) for (i,c) in enumerate((1,1.01,1.02,1.03,1.04,1.05)) ] +
+                [ ("jetPtRelv2_p%d" % i,               (lambda lep, c=c : friendPtRelv2Columns(lep,c)))   for (i,c) in enumerate((1,1.01,1.02,1.03,1.04,1.05)) ]
+                ))) )
 
 #from CMGTools.TTHAnalysis.tools.MultiIsoMVAFriend import MultiIsoMVAFriend
 #MODULES.append ( ('newMultiIsoMVAtraining_2015',
@@ -193,9 +216,11 @@ class VariableProducer(Module):
     def beginJob(self):
         self.t = PyTree(self.book("TTree","t","t"))
         self.branches = {}
+        self.moduleBranches = {}
         for name,mod in self._modules:
             print name
             print mod.listBranches()
+            self.moduleBranches[name] = mod.listBranches()
             for B in mod.listBranches():
                 # don't add the same branch twice
                 if B in self.branches: 
@@ -209,14 +234,268 @@ class VariableProducer(Module):
                         self.t.branch(B[0],B[1],n=B[2],lenVar=B[3])
                 else:
                     self.t.branch(B ,"F")
+    def requiredBranches(self):
+        ret = []
+        for name,mod in self._modules:
+            if not hasattr(mod,'requiredBranches'): return None
+            ret += mod.requiredBranches()
+        return ret
     def analyze(self,event):
         for name,mod in self._modules:
             keyvals = mod(event)
-            for B,V in keyvals.iteritems():
-                setattr(self.t, B, V)
-                setattr(event,  B, V)
+            self.t.update(keyvals)
+            event.__dict__.update(keyvals)
         self.t.fill()
 
+#### ========= INCREMENTAL PRODUCTION =======================
+import hashlib, inspect, json
+
+def _fingerprint(obj,seen):
+    """A string that changes if the code or the configuration of obj change"""
+    if type(obj) in (int,long,float,bool,str,unicode,types.NoneType): return repr(obj)
+    if type(obj) in (list,tuple,set,frozenset): return "%s(%s)" % (type(obj).__name__, ",".join(_fingerprint(x,seen) for x in obj))
+    if type(obj) == dict: return "{%s}" % ",".join("%s:%s" % (_fingerprint(k,seen),_fingerprint(v,seen)) for (k,v) in sorted(obj.items()))
+    if id(obj) in seen: return "<%s>" % getattr(obj,'__name__',type(obj).__name__)
+    seen.add(id(obj))
+    if type(obj) == types.FunctionType:
+        closure = [ c.cell_contents for c in (obj.func_closure or ()) ]
+        return "def %s(%s;%s;%s)" % (obj.__name__, _codeFingerprint(obj.func_code,obj.func_globals,seen), _fingerprint(obj.func_defaults,seen), _fingerprint(closure,seen))
+    if type(obj) == types.ModuleType: 
+        return "module %s" % obj.__name__
+    if inspect.isclass(obj):
+        try:
+            return "class %s(%s)" % (obj.__name__, hashlib.sha1(open(inspect.getsourcefile(obj)).read()).hexdigest())
+        except (TypeError, IOError): # built-in, or ROOT
+            return "class %s" % obj.__name__
+    if hasattr(obj,'__dict__') and not isinstance(obj, ROOT.TObject):
+        return "%s(%s)" % (_fingerprint(obj.__class__,seen), _fingerprint(obj.__dict__,seen))
+    return type(obj).__name__
+def _codeFingerprint(code,globs,seen):
+    consts = [ (_codeFingerprint(c,globs,seen) if type(c) == types.CodeType else _fingerprint(c,seen)) for c in code.co_consts ]
+    names  = [ ("%s=%s" % (n,_fingerprint(globs[n],seen)) if n in globs else n) for n in code.co_names ]
+    return "%s;%s;%s" % (code.co_code.encode('hex'), ",".join(consts), ",".join(names))
+def moduleHash(module):
+    """Hash of the code and configuration of a module (or of the function making it), including the
+       functions and classes it uses (for classes, the whole file where they're defined)"""
+    return hashlib.sha1(_fingerprint(module,set())).hexdigest()
+
+def _contiguous(entries):
+    return type(entries) == xrange or len(entries) == 0 or entries[-1] - entries[0] + 1 == len(entries)
+def _entriesFingerprint(entries):
+    if len(entries) == 0: return []
+    if _contiguous(entries): return [entries[0], len(entries)]
+    return [entries[0], len(entries), hashlib.sha1(array('l', entries).tostring()).hexdigest()]
+def _fileFingerprint(fname):
+    if "://" in fname or not os.path.exists(fname): return [fname]
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, int(st.st_mtime)]
+def inputFingerprint(fin,friends,name,entries):
+    ret = [ _fileFingerprint(fin), _entriesFingerprint(entries) ]
+    ret += [ [ft, _fileFingerprint(ff.format(name=name, cname=name))] for (ft,ff) in friends ]
+    return json.loads(json.dumps(ret)) # as it will be when read back
+
+def readFriendInfo(fname):
+    """What was used to make an output file: {'input':..., 'modules':{ name: {'hash':..., 'branches':[...]}}}"""
+    if not os.path.exists(fname): return None
+    tf = ROOT.TFile.Open(fname)
+    if not tf or tf.IsZombie(): return None
+    info = tf.Get("friendTreeInfo")
+    ret = json.loads(info.GetTitle()) if info else None
+    tf.Close()
+    return ret
+def writeFriendInfo(tfile,inputs,hashes,moduleBranches,events):
+    info = { 'input':inputs, 'modules':dict((m, {'hash':h, 'branches':moduleBranches[m]}) for (m,h) in hashes.iteritems()), 'events':events }
+    tfile.WriteTObject(ROOT.TNamed("friendTreeInfo", json.dumps(info)))
+def mergedFriendInfo(infos,ranges,events):
+    """The friendTreeInfo of the merge of chunks: the modules made with the same code in all of them, the inputs
+       with the entries of the whole dataset, and where the entries of each chunk are in the merged tree
+       ('chunks': [ [entries fingerprint, first entry], ... ], see previousOutputFor); None if the chunks don't agree"""
+    if None in infos: return None
+    inputs = [ i['input'][:1] + i['input'][2:] for i in infos ]
+    if any(x != inputs[0] for x in inputs): return None
+    modules = dict((m,v) for (m,v) in infos[0]['modules'].iteritems() if all(i['modules'].get(m,{}).get('hash') == v['hash'] for i in infos))
+    chunks, first = [], 0
+    for r in ranges:
+        chunks.append([ _entriesFingerprint(r), first ])
+        first += len(r)
+    info = { 'input':inputs[0][:1] + [ _entriesFingerprint(_joinEntries(ranges)) ] + inputs[0][1:], 'modules':modules, 'events':events, 'chunks':chunks }
+    return json.loads(json.dumps(info)) # as it will be when read back
+
+#### ========= ENTRY LISTS =======================
+def readEntryList(fname):
+    """Sorted entry numbers of the 'elist' TEventList or TEntryList of a file (e.g. selection_eventlist.root from skimTrees.py)"""
+    tf = ROOT.TFile.Open(fname)
+    elist = tf.Get("elist") if tf and not tf.IsZombie() else None
+    if not elist: raise RuntimeError, "Cannot read the entry list 'elist' from %s" % fname
+    ret = sorted(elist.GetEntry(i) for i in xrange(elist.GetN()))
+    tf.Close()
+    return ret
+def _joinEntries(ranges):
+    if all(type(r) == xrange for r in ranges) and all(len(r) for r in ranges):
+        return xrange(ranges[0][0], ranges[-1][-1]+1)
+    return list(itertools.chain(*ranges))
+def _selectEntries(tree,entries):
+    """Make Draw and CopyTree use only these entries: returns the (nentries, firstentry) arguments to use,
+       and for entries that are not contiguous sets an entry list on the tree (to be reset with SetEntryList(None))"""
+    if _contiguous(entries): return (len(entries), entries[0] if len(entries) else 0)
+    elist = ROOT.TEntryList(tree)
+    for e in entries: elist.Enter(e)
+    tree.SetEntryList(elist)
+    tree._selectedEntries = elist # keep it alive while it's used
+    return (tree.GetEntries(), 0)
+
+def eventIdHash(tree,entries):
+    """Hash of the run, lumi and event numbers of a range (or list) of entries of the tree"""
+    h = hashlib.sha1()
+    if len(entries) == 0: return h.hexdigest()
+    estimate = tree.GetEstimate()
+    tree.SetEstimate(len(entries)+1)
+    for b in "run", "lumi", "evt": tree.SetBranchStatus(b,1)
+    (nentries,first) = _selectEntries(tree,entries)
+    n = tree.Draw("run:lumi:evt","","goff",nentries,first)
+    for v in tree.GetV1(), tree.GetV2(), tree.GetV3():
+        if n > 0: h.update(array('d', [ v[i] for i in xrange(n) ]).tostring())
+    tree.SetEntryList(None)
+    tree.SetEstimate(estimate)
+    return h.hexdigest()
+
+from CMGTools.TTHAnalysis.plotter.eventIndex import FRIEND_IDS, readEventIds
+from CMGTools.TTHAnalysis.plotter import eventIndex
+def writeEventIds(tdir,tree,entries):
+    """Save the run, lumi and event numbers of the entries in a separate tree, so that the alignment
+       of the friend tree with the main one can be checked when using it (mcPlots.py --check-friends)"""
+    gdir = ROOT.gDirectory
+    tdir.cd()
+    tree.SetBranchStatus("*",0)
+    for b in "run", "lumi", "evt": tree.SetBranchStatus(b,1)
+    (nentries,first) = _selectEntries(tree,entries)
+    ids = tree.CopyTree("", "", nentries, first)
+    ids.SetName(FRIEND_IDS)
+    tree.SetEntryList(None)
+    ids.Write()
+    tree.SetBranchStatus("*",1)
+    gdir.cd()
+
+#### ========= MERGING OF CHUNKS =======================
+def openMainTree(fname):
+    tfile = ROOT.TFile.Open(fname)
+    tree = tfile.Get(options.tree) if tfile else None
+    if not tree: tree = tfile.Get("tree") # new trees
+    return (tfile,tree)
+def mergeChunks(name,fin,outdir,ranges):
+    """Merge the chunks of a dataset, after checking that each one has the right entries of
+       the main tree; returns the list of chunk files (to be deleted) or None on failure"""
+    fout = "%s/evVarFriend_%s.root" % (outdir,name)
+    chunks = [ "%s/evVarFriend_%s.chunk%d.root" % (outdir,name,i) for i in xrange(len(ranges)) ]
+    missing = [ f for f in chunks if not os.path.exists(f) ]
+    if missing:
+        if len(missing) == len(chunks) and os.path.exists(fout):
+            print "%s is up to date, nothing to merge" % fout # see previousOutputFor
+            return []
+        print "ERROR: missing chunks for %s: %s" % (name, ", ".join(missing))
+        return None
+    if not eventIndex.available():
+        print "ERROR: can't check the alignment of the chunks of %s with the main tree without numpy" % name
+        return None
+    (tfile,tree) = openMainTree(fin)
+    mainIds = readEventIds(tree)
+    ok = True
+    infos = []
+    for (fchunk,entries) in zip(chunks,ranges):
+        info = readFriendInfo(fchunk)
+        infos.append(info)
+        tf = ROOT.TFile.Open(fchunk)
+        nf = tf.Get(options.treeDir+"/t").GetEntries() if tf and not tf.IsZombie() and tf.Get(options.treeDir+"/t") else -1
+        idtree = tf.Get(FRIEND_IDS) if nf != -1 else None
+        ids = readEventIds(idtree) if idtree else None
+        if tf: tf.Close()
+        if nf != len(entries):
+            print "ERROR: %s has %d entries instead of %d" % (fchunk, nf, len(entries)); ok = False
+        elif ids is None:
+            print "ERROR: %s has no %s tree, can't check its alignment with the main tree" % (fchunk, FRIEND_IDS); ok = False
+        else:
+            expected = mainIds[entries[0]:entries[0]+len(entries)] if _contiguous(entries) else mainIds[list(entries)]
+            if not eventIndex.numpy.array_equal(ids, expected):
+                print "ERROR: %s is not aligned with entries %d-%d of the main tree" % (fchunk, entries[0], entries[-1]); ok = False
+    ntot = tree.GetEntries() if not options.entryList else sum(len(r) for r in ranges)
+    info = mergedFriendInfo(infos,ranges,eventIdHash(tree,_joinEntries(ranges))) if ok else None
+    tfile.Close()
+    if not ok: return None
+    ftemp = fout+".tmp"
+    chain = ROOT.TChain(options.treeDir+"/t")
+    for f in chunks: chain.Add(f)
+    fmerged = ROOT.TFile(ftemp,"RECREATE")
+    fmerged.mkdir(options.treeDir).cd()
+    merged = chain.CloneTree(-1,"fast") # copies the baskets, without unzipping them
+    merged.Write()
+    nmerged = merged.GetEntries()
+    idchain = ROOT.TChain(FRIEND_IDS)
+    for f in chunks: idchain.Add(f)
+    if idchain.GetEntries() == nmerged:
+        fmerged.cd()
+        idchain.CloneTree(-1,"fast").Write()
+    if info != None:
+        fmerged.WriteTObject(ROOT.TNamed("friendTreeInfo", json.dumps(info)))
+    else:
+        print "Warning: the chunks of %s were not made from the same inputs and modules, --incremental won't be able to use %s" % (name, fout)
+    fmerged.Close()
+    if nmerged != ntot:
+        print "ERROR: merged %d entries for %s instead of %d" % (nmerged, name, ntot)
+        os.unlink(ftemp)
+        return None
+    os.rename(ftemp,fout)
+    print "Merged %d chunks in %s (%d entries)" % (len(chunks), fout, nmerged)
+    return chunks
+
+class PreviousOutput:
+    """The friend tree made by a previous run, from which the branches of the unchanged modules are taken"""
+    def __init__(self,fname,treeDir,branches,entries,offset=0):
+        self.tfile = ROOT.TFile.Open(fname)
+        self.tree  = self.tfile.Get(treeDir+"/t")
+        self.tree.SetBranchStatus("*",0)
+        for b in branches: self.tree.SetBranchStatus(b,1)
+        self.first = entries[0] if len(entries) else 0
+        self.index = None if _contiguous(entries) else dict((e,i) for (i,e) in enumerate(entries))
+        self.offset = offset # position of the first of the entries in the file (e.g. for a chunk in a merged file)
+        self.entry = -1
+    def load(self,entry):
+        if self.entry != entry:
+            self.tree.GetEntry(self.offset + (entry - self.first if self.index == None else self.index[entry]))
+            self.entry = entry
+def previousOutputFor(fout,inputs):
+    """The output of a previous run to be used with --incremental, as (file name, friendTreeInfo, offset of the
+       entries in the file): the file itself or, for a chunk that was merged and deleted (--merge), the merged file"""
+    info = readFriendInfo(fout)
+    if info != None or not re.search(r"\.chunk\d+\.root$", fout): return (fout,info,0)
+    fmerged = re.sub(r"\.chunk\d+\.root$", ".root", fout)
+    info = readFriendInfo(fmerged)
+    if info == None or 'chunks' not in info: return (fout,None,0)
+    if info['input'][:1] + info['input'][2:] != inputs[:1] + inputs[2:]: return (fout,None,0)
+    for (entries,first) in info['chunks']:
+        if entries == inputs[1]:
+            info = dict(info, input=inputs) # same inputs, for the entries of this chunk
+            return (fmerged,info,first)
+    return (fout,None,0)
+class BranchCopier:
+    """Stands for a module that didn't change, copying its branches from the previous output"""
+    def __init__(self,previous,branches):
+        self._previous = previous
+        self._branches = [ (tuple(str(x) if type(x) == unicode else x for x in b) if type(b) == list else str(b)) for b in branches ]
+        self._leaves = None
+    def listBranches(self):
+        return self._branches
+    def __call__(self,event):
+        self._previous.load(event._entry)
+        if self._leaves == None:
+            self._leaves = []
+            for B in self._branches:
+                (name,btype,isArray) = (B[0], B[1], len(B) == 4) if type(B) == tuple else (B, "F", False)
+                self._leaves.append((name, self._previous.tree.GetLeaf(name), isArray, int if btype in "IiLlSsBbO" else float))
+        ret = {}
+        for (name,leaf,isArray,conv) in self._leaves:
+            ret[name] = [ conv(leaf.GetValue(i)) for i in xrange(leaf.GetLen()) ] if isArray else conv(leaf.GetValue(0))
+        return ret
+
 import os, itertools
 
 from optparse import OptionParser
@@ -231,6 +510,13 @@ parser.add_option("-p", "--pretend", dest="pretend",   action="store_true", defa
 parser.add_option("-T", "--tree-dir",   dest="treeDir",     type="string", default="sf", help="Directory of the friend tree in the file (default: 'sf')");
 parser.add_option("-q", "--queue",   dest="queue",     type="string", default=None, help="Run jobs on lxbatch instead of locally");
 parser.add_option("-t", "--tree",    dest="tree",      default='ttHLepTreeProducerTTH', help="Pattern for tree name");
+parser.add_option("--read-chunk", dest="readChunk", type="int", default=0, help="Read the input branches this many events at a time into memory (needs numpy; default 0 = event by event)");
+parser.add_option("--only-used-branches", dest="onlyUsedBranches", action="store_true", default=False, help="Read only the branches used by the modules, each when first asked for");
+parser.add_option("--incremental", dest="incremental", action="store_true", default=False, help="If an output exists and was made from the same inputs, recompute only the modules whose code or configuration changed, and copy the other branches from it (modules using the outputs of a changed module must be selected too)");
+parser.add_option("--pilot", dest="pilot", type="int", default=0, help="Before starting, run on this many events of each dataset without timing records, to estimate how long its chunks will take");
+parser.add_option("--merge", dest="merge", action="store_true", default=False, help="When all the chunks of a dataset are done, check them against the main tree, merge them and delete them");
+parser.add_option("--keep-chunks", dest="keepChunks", action="store_true", default=False, help="With --merge, don't delete the chunks after merging them");
+parser.add_option("--entry-list", dest="entryList", type="string", default=None, help="Process only the entries in this entry list (e.g. the selection_eventlist.root of a skim made with skimTrees.py), so that the friend trees are aligned with the skimmed trees. Can use {name}, {cname} patterns, e.g. 'skims/{name}/selection_eventlist.root'");
 parser.add_option("-V", "--vector",  dest="vectorTree", action="store_true", default=True, help="Input tree is a vector");
 parser.add_option("-F", "--add-friend",    dest="friendTrees",  action="append", default=[], nargs=2, help="Add a friend tree (treename, filename). Can use {name}, {cname} patterns in the treename") 
 parser.add_option("--FMC", "--add-friend-mc",    dest="friendTreesMC",  action="append", default=[], nargs=2, help="Add a friend tree (treename, filename) to MC only. Can use {name}, {cname} patterns in the treename") 
@@ -260,6 +546,7 @@ if len(options.chunks) != 0 and len(options.datasets) != 1:
     exit()
 
 jobs = []
+allChunks = {} # datasets for which all chunks are run, and how many there are
 for D in glob(args[0]+"/*"):
     treename = options.tree
     fname    = "%s/%s/%s_tree.root" % (D,options.tree,options.tree)
@@ -289,6 +576,17 @@ for D in glob(args[0]+"/*"):
             continue
         entries = t.GetEntries()
         f.Close()
+        selected = None
+        if options.entryList:
+            flist = options.entryList.format(name=short, cname=short)
+            if not os.path.exists(flist):
+                print "  ",short," no entry list %s, skipped" % flist
+                continue
+            selected = readEntryList(flist)
+            if len(selected) and selected[-1] >= entries:
+                print "ERROR: entry list %s selects entry %d, but %s has only %d entries" % (flist, selected[-1], fname, entries)
+                continue
+            entries = len(selected)
         if options.newOnly:
             fout = "%s/evVarFriend_%s.root" % (args[1],short)
             if os.path.exists(fout):
@@ -303,14 +601,16 @@ for D in glob(args[0]+"/*"):
         chunk = options.chunkSize
         if entries < chunk:
             print "  ",os.path.basename(D),("  DATA" if data else "  MC")," single chunk"
-            jobs.append((short,fname,"%s/evVarFriend_%s.root" % (args[1],short),data,xrange(entries),-1))
+            jobs.append((short,fname,"%s/evVarFriend_%s.root" % (args[1],short),data,xrange(entries) if selected == None else selected,-1))
         else:
             nchunk = int(ceil(entries/float(chunk)))
             print "  ",os.path.basename(D),("  DATA" if data else "  MC")," %d chunks" % nchunk
+            if options.chunks == []: allChunks[short] = nchunk
             for i in xrange(nchunk):
                 if options.chunks != []:
                     if i not in options.chunks: continue
-                r = xrange(int(i*chunk),min(int((i+1)*chunk),entries))
+                (first,last) = (int(i*chunk),min(int((i+1)*chunk),entries))
+                r = xrange(first,last) if selected == None else selected[first:last]
                 jobs.append((short,fname,"%s/evVarFriend_%s.chunk%d.root" % (args[1],short,i),data,r,i))
 print "\n"
 print "I have %d task(s) to process" % len(jobs)
@@ -322,6 +622,10 @@ if options.queue:
                 self=sys.argv[0], chunkSize=options.chunkSize, tdir=options.treeDir, tree=options.tree, data=args[0], output=args[1]
             )
     if options.vectorTree: basecmd += " --vector "
+    if options.readChunk: basecmd += " --read-chunk %d " % options.readChunk
+    if options.onlyUsedBranches: basecmd += " --only-used-branches "
+    if options.incremental: basecmd += " --incremental "
+    if options.entryList: basecmd += " --entry-list '%s' " % options.entryList
     friendPost =  "".join(["  -F  %s %s " % (fn,ft) for fn,ft in options.friendTrees])
     friendPost += "".join([" --FM %s %s " % (fn,ft) for fn,ft in options.friendTreesMC])
     friendPost += "".join([" --FD %s %s " % (fn,ft) for fn,ft in options.friendTreesData])
@@ -366,7 +670,6 @@ def _runIt(myargs):
         print "==== pretending to run %s (%d entries, %s) ====" % (name, nev, fout)
         return (name,(nev,0))
     print "==== %s starting (%d entries) ====" % (name, nev)
-    booker = Booker(fout)
     modulesToRun = MODULES
     if options.modules != []:
         toRun = {}
@@ -375,21 +678,91 @@ def _runIt(myargs):
                 if re.match(pat,m):
                     toRun[m] = True 
         modulesToRun = [ (m,v) for (m,v) in MODULES if m in toRun ]
-    el = EventLoop([ VariableProducer(options.treeDir,booker,modulesToRun), ])
-    el.loop([tb], eventRange=range)
+    hashes = dict((m,moduleHash(v)) for (m,v) in modulesToRun)
+    inputs = inputFingerprint(fin, friends, name, range)
+    previous, fwrite = None, fout
+    (fprev,info,offset) = previousOutputFor(fout,inputs) if options.incremental else (fout,None,0)
+    if info != None and info['input'] == inputs:
+        unchanged = [ m for (m,v) in modulesToRun if m in info['modules'] and info['modules'][m]['hash'] == hashes[m] ]
+        if len(unchanged) == len(modulesToRun):
+            print "==== %s is up to date ====" % fprev
+            return (name,(nev,0))
+        if unchanged:
+            print "==== %s: recomputing %s ====" % (name, ", ".join(m for (m,v) in modulesToRun if m not in unchanged))
+            branches = []
+            for m in unchanged: 
+                branches += [ (b[0] if type(b) == list else b) for b in info['modules'][m]['branches'] ]
+            previous = PreviousOutput(fprev, options.treeDir, branches, range, offset)
+            modulesToRun = [ (m, BranchCopier(previous, info['modules'][m]['branches']) if m in unchanged else v) for (m,v) in modulesToRun ]
+            fwrite = fout+".tmp"
+    booker = Booker(fwrite)
+    producer = VariableProducer(options.treeDir,booker,modulesToRun)
+    el = EventLoop([ producer, ])
+    el.loop([tb], eventRange=range, chunkSize=options.readChunk, onlyUsedBranches=options.onlyUsedBranches)
+    writeFriendInfo(booker.tdir, inputs, hashes, producer.moduleBranches, eventIdHash(tb,range))
+    writeEventIds(booker.tdir, tb, range)
     booker.done()
     fb.Close()
+    if previous != None:
+        previous.tfile.Close()
+        os.rename(fwrite, fout)
     time = timer.RealTime()
     print "=== %s done (%d entries, %.0f s, %.0f e/s) ====" % ( name, nev, time,(nev/time) )
     return (name,(nev,time))
 
+def _runTimed(job):
+    (name,(nev,time)) = _runIt(job)
+    return (job,time)
+
+# speed of each dataset (entries/s), from the previous runs, to start the longest jobs first
+timingFile = "%s/evVarFriend_timing.json" % args[1]
+rates = json.load(open(timingFile)) if os.path.exists(timingFile) else {}
+def _updateRate(name,entries,time):
+    if time <= 0 or entries <= 0: return
+    (oldEntries,oldTime) = rates[name] if name in rates and name in updated else (0,0)
+    rates[name] = (oldEntries+entries, oldTime+time)
+    updated.add(name)
+updated = set()
+
+pool = None
 if options.jobs > 0:
     from multiprocessing import Pool
     pool = Pool(options.jobs)
-    ret  = dict(pool.map(_runIt, jobs)) if options.jobs > 0 else dict([_runIt(j) for j in jobs])
-else:
-    ret = dict(map(_runIt, jobs))
+if options.pilot > 0 and not options.pretend:
+    import tempfile, shutil
+    pilotDir = tempfile.mkdtemp()
+    pilots = {}
+    for (name,fin,fout,data,range,chunk) in jobs:
+        if name in rates or name in pilots or len(range) == 0: continue
+        pilots[name] = (name,fin,"%s/evVarFriend_%s.root" % (pilotDir,name),data,xrange(range[0],min(range[0]+options.pilot,range[-1]+1)) if type(range) == xrange else range[:options.pilot],-1)
+    print "Running pilot jobs for %d dataset(s)" % len(pilots)
+    for (job,time) in (pool.imap_unordered(_runTimed, pilots.values()) if pool else itertools.imap(_runTimed, pilots.values())):
+        _updateRate(job[0],len(job[4]),time)
+    shutil.rmtree(pilotDir)
+    updated.clear() # the pilot runs are less reliable than real ones
+
+def _speed(name):
+    if name in rates: return rates[name][1]/float(rates[name][0])
+    if rates: return sorted(t/float(e) for (e,t) in rates.itervalues())[len(rates)/2] # median
+    return 1.0
+jobs.sort(key = lambda job : -len(job[4])*_speed(job[0]))
+
+ret = []
+chunksDone = dict((name,{}) for name in allChunks)
+for (job,time) in (pool.imap_unordered(_runTimed, jobs) if pool else itertools.imap(_runTimed, jobs)):
+    (name,fin,fout,data,range,chunk) = job
+    ret.append((len(range),time))
+    _updateRate(name,len(range),time)
+    print "[%d/%d] %s%s: %d entries in %.0f s (%.0f e/s)" % (len(ret), len(jobs), name, (" chunk %d" % chunk if chunk != -1 else ""), len(range), time, len(range)/max(time,1e-3))
+    if options.merge and not options.pretend and chunk != -1 and name in allChunks:
+        chunksDone[name][chunk] = range
+        if len(chunksDone[name]) == allChunks[name]:
+            merged = mergeChunks(name, fin, args[1], [ chunksDone[name][i] for i in xrange(allChunks[name]) ])
+            if merged and not options.keepChunks:
+                for f in merged: os.unlink(f)
+if updated and not options.pretend:
+    json.dump(rates, open(timingFile,"w"))
 fulltime = maintimer.RealTime()
-totev   = sum([ev   for (ev,time) in ret.itervalues()])
-tottime = sum([time for (ev,time) in ret.itervalues()])
+totev   = sum([ev   for (ev,time) in ret])
+tottime = sum([time for (ev,time) in ret])
 print "Done %d tasks in %.1f min (%d entries, %.1f min)" % (len(jobs),fulltime/60.,totev,tottime/60.)
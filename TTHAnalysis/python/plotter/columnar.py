@@ -0,0 +1,181 @@
+import re, ast
+from math import sqrt
+
+import ROOT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def available():
+    return numpy != None
+
+class Unsupported(Exception):
+    """Raised for expressions that can't be evaluated on columns, and must be left to TTree::Draw"""
+    pass
+
+_functions = {}
+if numpy != None:
+    for _names, _func in [ (("abs","fabs","TMath__Abs","std__abs"),  numpy.abs),
+                           (("sqrt","TMath__Sqrt","std__sqrt"),       numpy.sqrt),
+                           (("exp","TMath__Exp","std__exp"),          numpy.exp),
+                           (("log","TMath__Log","std__log"),          numpy.log),
+                           (("log10","TMath__Log10","std__log10"),    numpy.log10),
+                           (("sin","TMath__Sin"),                     numpy.sin),
+                           (("cos","TMath__Cos"),                     numpy.cos),
+                           (("tan","TMath__Tan"),                     numpy.tan),
+                           (("atan2","TMath__ATan2"),                 numpy.arctan2),
+                           (("pow","TMath__Power","std__pow"),        numpy.power),
+                           (("min","TMath__Min","std__min"),          numpy.minimum),
+                           (("max","TMath__Max","std__max"),          numpy.maximum),
+                           (("TMath__Pi",),                           lambda : numpy.pi) ]:
+        for _name in _names: _functions[_name] = _func
+
+def translate(expr):
+    """Turn a TTreeFormula expression into python syntax, with the same precedence of the operators.
+       Raises Unsupported for anything that can't be done on columns of scalars (arrays, ternary
+       operators, integer and bitwise operators, special variables, strings)"""
+    if re.search(r"[\[\]\?\^\"'$%~]", expr): raise Unsupported, expr
+    # '!' binds tighter than comparisons in C++ but not in python: make it a function call
+    if re.search(r"!\s*\w+\s*\(", expr): raise Unsupported, expr
+    ret = expr.replace("::","__")
+    ret = re.sub(r"!(?!=)\s*(\w+)", r"_not_(\1)", ret)
+    ret = re.sub(r"!(?!=)\s*\(", r"_not_(", ret)
+    ret = ret.replace("&&"," and ").replace("||"," or ")
+    if "!" in ret.replace("!=",""): raise Unsupported, expr
+    try:
+        return ast.parse(ret.strip(), mode='eval').body
+    except SyntaxError:
+        raise Unsupported, expr
+
+def names(node):
+    """Set of the branch names used in a translated expression"""
+    ret, funcs = set(), set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id not in ("true","false"): ret.add(n.id)
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Name): funcs.add(n.func.id)
+    return ret - funcs
+
+def _divide(a,b):
+    # as TTreeFormula, x/0 = 0
+    return numpy.where(b != 0, numpy.true_divide(a, numpy.where(b != 0, b, 1)), 0.)
+
+_binops  = { ast.Add : numpy.add, ast.Sub : numpy.subtract, ast.Mult : numpy.multiply, ast.Div : _divide } if numpy != None else {}
+_compare = { ast.Gt : numpy.greater, ast.GtE : numpy.greater_equal, ast.Lt : numpy.less, ast.LtE : numpy.less_equal,
+             ast.Eq : numpy.equal,   ast.NotEq : numpy.not_equal } if numpy != None else {}
+
+class ColumnarTree:
+    """The scalar branches of a range of entries of a tree, read once into numpy arrays, on which
+       cuts, weights and plot expressions are evaluated with vectorized operations.
+       fill() produces the same histograms as TTree::Draw, or returns False if the expressions can't
+       be evaluated this way (the caller should then use TTree::Draw)"""
+    def __init__(self,tree,maxEntries,firstEntry=0):
+        self._tree = tree
+        self._range = (maxEntries, firstEntry)
+        self._n = max(min(maxEntries, tree.GetEntries() - firstEntry), 0)
+        self._columns = {}
+        self._parsed = {}
+    def entryRange(self):
+        return self._range
+    def _parse(self,expr):
+        if expr not in self._parsed:
+            try:
+                node = translate(expr)
+                for name in names(node): self._checkBranch(name)
+                self._parsed[expr] = node
+            except Unsupported:
+                self._parsed[expr] = None
+        if self._parsed[expr] == None: raise Unsupported, expr
+        return self._parsed[expr]
+    def _checkBranch(self,name):
+        if self._tree.GetAlias(name): raise Unsupported, name
+        leaf = self._tree.GetLeaf(name)
+        if not leaf or leaf.GetLenStatic() != 1 or leaf.GetLeafCount(): raise Unsupported, name
+    def _read(self,names):
+        """Read the columns not already in memory, four at a time (what TTree::Draw can give back)"""
+        todo = [ n for n in sorted(names) if n not in self._columns ]
+        if not todo: return
+        estimate = self._tree.GetEstimate()
+        self._tree.SetEstimate(self._n + 1)
+        for i in xrange(0, len(todo), 4):
+            group = todo[i:i+4]
+            nrows = self._tree.Draw(":".join(group), "", "goff", self._range[0], self._range[1])
+            if nrows != self._n:
+                self._tree.SetEstimate(estimate)
+                raise RuntimeError, "Read %d rows instead of %d for %s" % (nrows, self._n, group)
+            # GetV1() ... GetV4() are the expressions in the order they're given to TTree::Draw
+            for j,name in enumerate(group):
+                buf = getattr(self._tree, "GetV%d" % (j+1))()
+                if hasattr(buf,'SetSize'): buf.SetSize(self._n)
+                self._columns[name] = numpy.array(numpy.frombuffer(buf, dtype=numpy.float64, count=self._n))
+        self._tree.SetEstimate(estimate)
+    def eval(self,expr):
+        node = self._parse(expr)
+        self._read(names(node))
+        return self._eval(node) + numpy.zeros(self._n) # also constants as arrays
+    def _eval(self,node):
+        if isinstance(node, ast.Num):
+            return float(node.n)
+        if isinstance(node, ast.Name):
+            if node.id == "true":  return 1.
+            if node.id == "false": return 0.
+            return self._columns[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in _binops:
+            return _binops[type(node.op)](self._eval(node.left), self._eval(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            return -self._eval(node.operand) if isinstance(node.op, ast.USub) else self._eval(node.operand)
+        if isinstance(node, ast.BoolOp):
+            func = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+            ret = self._eval(node.values[0]) != 0
+            for v in node.values[1:]: ret = func(ret, self._eval(v) != 0)
+            return ret.astype(numpy.float64) if hasattr(ret,'astype') else float(ret)
+        if isinstance(node, ast.Compare) and all(type(op) in _compare for op in node.ops):
+            # a < b < c means (a < b) < c in C++
+            ret = self._eval(node.left)
+            for op,right in zip(node.ops, node.comparators):
+                ret = _compare[type(op)](ret, self._eval(right))
+                ret = ret.astype(numpy.float64) if hasattr(ret,'astype') else float(ret)
+            return ret
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            if node.func.id == "_not_" and len(node.args) == 1:
+                ret = (self._eval(node.args[0]) == 0)
+                return ret.astype(numpy.float64) if hasattr(ret,'astype') else float(ret)
+            if node.func.id in _functions:
+                return _functions[node.func.id](*[ self._eval(a) for a in node.args ])
+        raise Unsupported, ast.dump(node)
+    def count(self,cut):
+        """Number of entries passing the cut, or None if it can't be evaluated"""
+        try:
+            return int(numpy.count_nonzero(self.eval(cut)))
+        except Unsupported:
+            return None
+    def fill(self,histo,expr,cut):
+        """Fill histo as TTree::Draw(expr>>histo, cut) would do. Returns False if not possible"""
+        if not histo.InheritsFrom("TH1") or histo.InheritsFrom("TProfile") or histo.InheritsFrom("TProfile2D"): return False
+        exprs = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+        exprs.reverse() # TTree::Draw syntax is z:y:x
+        if len(exprs) != histo.GetDimension(): return False
+        try:
+            weight = self.eval(cut)
+            values = [ self.eval(e) for e in exprs ]
+        except Unsupported:
+            return False
+        selected = (weight != 0)
+        weight = weight[selected]
+        # global bin number, as in TH1::GetBin
+        gbin, stride = numpy.zeros(len(weight), dtype=numpy.int64), 1
+        for x,axis in zip(values, (histo.GetXaxis(), histo.GetYaxis(), histo.GetZaxis())):
+            nb = axis.GetNbins()
+            edges = numpy.array([ axis.GetBinLowEdge(b) for b in xrange(1,nb+2) ])
+            gbin += stride * numpy.searchsorted(edges, x[selected], side='right')
+            stride *= nb+2
+        sumw  = numpy.bincount(gbin, weights=weight,        minlength=stride)
+        sumw2 = numpy.bincount(gbin, weights=weight*weight, minlength=stride)
+        for b in numpy.nonzero(sumw2)[0]:
+            b = int(b)
+            histo.SetBinContent(b, histo.GetBinContent(b) + sumw[b])
+            histo.SetBinError(b, sqrt(histo.GetBinError(b)**2 + sumw2[b]))
+        histo.ResetStats()
+        histo.SetEntries(int(len(weight)))
+        return True
@@ -0,0 +1,86 @@
+import os, os.path
+
+import ROOT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def available():
+    return numpy != None
+
+## name of the tree with the run, lumi and event numbers of each entry, written in the friend tree files
+FRIEND_IDS = "eventIds"
+
+def readEventIds(tree):
+    """run, lumi and event numbers of all the entries of the tree, as a numpy array of shape (N,3)"""
+    n = tree.GetEntries()
+    estimate = tree.GetEstimate()
+    tree.SetEstimate(n + 1)
+    rows = tree.Draw("run:lumi:evt", "", "goff")
+    if rows != n:
+        tree.SetEstimate(estimate)
+        raise RuntimeError, "Read %d event numbers instead of %d from %s" % (rows, n, tree.GetName())
+    ret = numpy.zeros((n,3), dtype=numpy.int64)
+    for i,buf in enumerate((tree.GetV1(), tree.GetV2(), tree.GetV3())):
+        if n == 0: break
+        if hasattr(buf,'SetSize'): buf.SetSize(n)
+        ret[:,i] = numpy.frombuffer(buf, dtype=numpy.float64, count=n)
+    tree.SetEstimate(estimate)
+    return ret
+
+def mainTreeIds(tree,fname):
+    """Event numbers of a main tree, stored in a sidecar file next to it (if possible) to be read only once"""
+    sidecar = fname+".evtidx.npy"
+    local = "://" not in fname and os.path.exists(fname)
+    if local and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(fname):
+        return numpy.load(sidecar)
+    ret = readEventIds(tree)
+    if local and os.access(os.path.dirname(os.path.abspath(fname)), os.W_OK):
+        ftemp = "%s.%d.npy" % (fname, os.getpid())
+        numpy.save(ftemp, ret)
+        os.rename(ftemp, sidecar)
+    return ret
+
+def _keys(ids):
+    """(run, lumi*2^32+evt), which identify an event within a dataset"""
+    return (ids[:,0], (ids[:,1] << 32) + ids[:,2])
+
+def isSubset(ids,ofIds):
+    """True if all the events of ids are also in ofIds"""
+    (run, lumiEvt), (orun, olumiEvt) = _keys(ids), _keys(ofIds)
+    for r in numpy.unique(run):
+        if not numpy.all(numpy.in1d(lumiEvt[run == r], olumiEvt[orun == r])): return False
+    return True
+
+class FriendAligner:
+    """Checks that the entries of the friend trees are the same events as those of the main tree.
+       If the main tree is a skim of the tree from which the friend was made, the friend is
+       attached with an index on the event numbers instead of by entry number."""
+    def __init__(self,tree,fname):
+        self._tree = tree
+        self._fname = fname
+        self._ids = None
+    def addFriend(self,treename,fname):
+        """Add the friend to the tree, returning what must be kept alive as long as it's used"""
+        tfile = ROOT.TFile.Open(fname)
+        if not tfile or tfile.IsZombie(): raise RuntimeError, "Cannot open friend tree file %s" % fname
+        idtree = tfile.Get(FRIEND_IDS)
+        if not idtree:
+            print "Warning: %s has no event numbers (%s tree), can't check its alignment with %s" % (fname, FRIEND_IDS, self._fname)
+            tfile.Close()
+            return self._tree.AddFriend(treename, fname)
+        if self._ids is None: self._ids = mainTreeIds(self._tree, self._fname)
+        fids = readEventIds(idtree)
+        if self._ids.shape == fids.shape and numpy.array_equal(self._ids, fids):
+            tfile.Close()
+            return self._tree.AddFriend(treename, fname)
+        if len(self._ids) < len(fids) and isSubset(self._ids, fids):
+            print "Friend %s is made for a larger tree than %s: matching the entries by event number" % (fname, self._fname)
+            friend = tfile.Get(treename)
+            friend.AddFriend(idtree)
+            friend.BuildIndex("run", "lumi*4294967296+evt")
+            self._tree.AddFriend(friend)
+            return (tfile, friend)
+        raise RuntimeError, "Friend tree %s is not aligned with %s (%d vs %d entries)" % (fname, self._fname, len(fids), len(self._ids))
@@ -14,6 +14,7 @@ class FakeRate:
         self._weight = None
         self._mods = []
         self._cutMods = []
+        self._histoFiles = []
         for file in files:
             stream = open(file,'r')
 	    for line in stream:
@@ -31,6 +32,7 @@ class FakeRate:
 	        elif fields[0] == "load-histo":
 	            data = "%s/src/CMGTools/TTHAnalysis/data/" % os.environ['CMSSW_BASE'];
 	            ROOT.loadFRHisto(fields[1],fields[2].replace("$DATA",data),fields[3] if len(fields) >= 4 else fields[1])
+	            self._histoFiles.append(fields[2].replace("$DATA",data))
 	        elif fields[0] == 'norm-lumi-override':
 	            if self._weight is None: raise RuntimeError, "norm-lumi-override must follow weight declaration in fake rate file "+file
 	            if not lumi: raise RuntimeError, "lumi not set in options, cannot apply norm-lumi-override"
@@ -50,5 +52,7 @@ class FakeRate:
         return self._weight
     def mods(self): 
         return self._mods
+    def histoFiles(self):
+        return self._histoFiles
     def cutMods(self): 
         return self._cutMods
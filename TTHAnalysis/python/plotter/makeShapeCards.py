@@ -74,7 +74,11 @@ def getYieldScale(mass,process):
             break
     return scale 
 
-report = mca.getPlotsRaw("x", args[2], args[3], cuts.allCuts(), nodata=options.asimov)
+if mca.listVariations():
+    # the templates of the variations (e.g. p_X_Up, p_X_Dn for a 'templates' systematic X) are filled together with the nominal
+    report = mca.getPlotsWithVariations(PlotSpec("x", args[2], args[3], {}), cuts.allCuts(), nodata=options.asimov)
+else:
+    report = mca.getPlotsRaw("x", args[2], args[3], cuts.allCuts(), nodata=options.asimov)
 
 if options.asimov:
     tomerge = []
@@ -381,3 +385,5 @@ workspace.Close()
 
 print "Wrote to ",myout+binname+".input.root"
 
+printStats(options)
+mca.printTimingReport()
@@ -2,7 +2,7 @@
 #from tree2yield import *
 from CMGTools.TTHAnalysis.plotter.tree2yield import *
 from CMGTools.TTHAnalysis.plotter.projections import *
-import pickle, re
+import pickle, re, sys
 
 ## These must be defined as standalone functions, to allow runing them in parallel
 def _runYields(args):
@@ -11,15 +11,62 @@ def _runYields(args):
 
 def _runPlot(args):
     key,tty,plotspec,cut = args
-    #timer = ROOT.TStopwatch()
-    #print "Starting plot %s for %s, %s" % (plotspec.name,key,tty._cname)
-    ret = (key,tty.getPlot(plotspec,cut))
-    #print "Done plot %s for %s, %s in %s s" % (plotspec.name,key,tty._cname,timer.RealTime())
-    return ret
+    return (key,tty.getPlot(plotspec,cut))
+
+def _runManyPlots(args):
+    key,tty,plotspecs,cut = args
+    return (key,tty.getManyPlots(plotspecs,cut))
+
+def _runCutFlowPlots(args):
+    key,tty,plotspecs,cuts,steps = args
+    return (key,tty.getCutFlowPlots(cuts,steps,plotspecs))
+
+def _runCategoryPlots(args):
+    key,tty,plotspecs,cuts,common = args
+    return (key,tty.getCategoryPlots(cuts,plotspecs,common))
+
+def _runVariationPlots(args):
+    key,tty,plotspecs,cut,variations = args
+    return (key,tty.getVariationPlots(cut,plotspecs,variations))
+
+## The worker processes keep their own copy of all the components, opened once and reused for all the tasks
+_workerTtys = []
+def _initWorker(ttys):
+    global _workerTtys
+    _workerTtys = ttys
+
+def _runInWorker(args):
+    ## run a task on the copy of the component in this worker, after bringing it in sync with the main process.
+    func,key,index,state,rest = args
+    tty = _workerTtys[index]
+    tty.setState(state)
+    return _runRecording(func,(key,tty)+rest)
+
+def _runRecording(func,task):
+    ## run a task, returning also a record of what it did: time, entries and bytes read, cache hits and misses,
+    ## and the increase of all the other counters of tree2yield.
+    key,tty = task[:2]
+    cache = getPlotCache(tty._options)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    stats = dict(getStats())
+    bytesRead = ROOT.TFile.GetFileBytesRead()
+    timer = ROOT.TStopwatch()
+    ret = func(task)
+    timer.Stop()
+    record = dict(task = func.__name__.replace("_run",""), process = key, component = tty.cname(), entryRange = tty.entryRange(),
+                  cpu = timer.CpuTime(), wall = timer.RealTime(), bytesRead = ROOT.TFile.GetFileBytesRead() - bytesRead,
+                  cacheHits = (cache.hits - hits if cache else 0), cacheMisses = (cache.misses - misses if cache else 0),
+                  counters = dict((k, v - stats.get(k,0)) for (k,v) in getStats().iteritems()))
+    record['entries'] = record['counters'].get('entries',0)
+    record['branchUsage'] = popBranchUsage()
+    return (ret, record)
 
 class MCAnalysis:
     def __init__(self,samples,options):
         self._options = options
+        self._pool = None
+        self._ttys = [] # all the components, in the same order as in the worker processes
+        self._records = [] # what each task did, see _runRecording
         self._allData     = {}
         self._data        = []
         self._signals     = []
@@ -27,6 +74,7 @@ class MCAnalysis:
         self._isSignal    = {}
         self._rank        = {} ## keep ranks as in the input text file
         self._projection  = Projections(options.project, options) if options.project != None else None
+        self._variations  = readVariations(options.variationsFile) if options.variationsFile != None else []
         self._premap = []
         for premap in options.premap:
             to,fro = premap.split("=")
@@ -105,6 +153,7 @@ class MCAnalysis:
                 self._backgrounds.append(tty)
             if pname in self._allData: self._allData[pname].append(tty)
             else                        : self._allData[pname] =     [tty]
+            self._ttys.append(tty)
             if "data" not in pname:
                 pckobj  = pickle.load(open(pckfile,'r'))
                 counters = dict(pckobj)
@@ -181,6 +230,8 @@ class MCAnalysis:
     def scaleUpProcess(self,process,scaleFactor):
         for tty in self._allData[process]: 
             tty.setScaleFactor( "((%s) * (%s))" % (tty.getScaleFactor(),scaleFactor) )
+    def listVariations(self):
+        return self._variations[:]
     def getProcessOption(self,process,name,default=None):
         return self._allData[process][0].getOption(name,default=default)
     def setProcessOption(self,process,name,value):
@@ -196,17 +247,7 @@ class MCAnalysis:
             for tty in ttys:
                 tasks.append((key,tty,cuts,noEntryLine))
         ## then do the work
-        retlist = []
-        if self._options.jobs == 0: 
-            retlist = map(_runYields, tasks)
-        else:
-            #from sys import stderr
-            #stderr.write("Will run %d tasks on %d multiple treads\n" % (len(tasks),self._options.jobs))
-            from multiprocessing import Pool
-            pool = Pool(self._options.jobs)
-            retlist  = pool.map(_runYields, tasks)
-            pool.close()
-            pool.join()
+        retlist = self._runTasks(_runYields, tasks, lambda tty,reports : tty.mergeChunkReports(reports,noEntryLine))
         ## then gather results with the same process
         mergemap = {}
         for (k,v) in retlist: 
@@ -243,26 +284,160 @@ class MCAnalysis:
     def getPlotsRaw(self,name,expr,bins,cut,process=None,nodata=False,makeSummary=False):
         return self.getPlots(PlotSpec(name,expr,bins,{}),cut,process,nodata,makeSummary)
     def getPlots(self,plotspec,cut,process=None,nodata=False,makeSummary=False):
-        ret = { }
-        allSig = []; allBg = []
         tasks = []
         for key,ttys in self._allData.iteritems():
             if key == 'data' and nodata: continue
             if process != None and key != process: continue
             for tty in ttys:
                 tasks.append((key,tty,plotspec,cut))
-        retlist = []
+        retlist = self._runTasks(_runPlot, tasks, lambda tty,plots : tty.mergeChunkPlots(plots,plotspec))
+        return self._mergePlots(plotspec,retlist,makeSummary)
+    def getManyPlots(self,plotspecs,cut,process=None,nodata=False,makeSummary=False):
+        """Like getPlots, for many plots at once: each tree is read only once, and all plots are filled together.
+           Returns a list with the map of plots for each of the plotspecs."""
+        tasks = []
+        for key,ttys in self._allData.iteritems():
+            if key == 'data' and nodata: continue
+            if process != None and key != process: continue
+            for tty in ttys:
+                tasks.append((key,tty,plotspecs,cut))
+        retlist = self._runTasks(_runManyPlots, tasks, lambda tty,results : [ tty.mergeChunkPlots(plots,plotspec) for (plots,plotspec) in zip(zip(*results),plotspecs) ])
+        return [ self._mergePlots(plotspec,[ (k,v[i]) for (k,v) in retlist ],makeSummary) for (i,plotspec) in enumerate(plotspecs) ]
+    def getCutFlowPlots(self,plotspecs,cuts,steps,process=None,nodata=False,makeSummary=False):
+        """Like getManyPlots, for several steps of the cut-flow at once (see TreeToYield.getCutFlowPlotsRaw):
+           each tree is read only once, and each cut evaluated at most once per event.
+           Returns, for each step, the list with the map of plots for each of the plotspecs."""
+        return self._getPlotGrid(_runCutFlowPlots,plotspecs,(cuts,steps),len(steps),process,nodata,makeSummary)
+    def getCategoryPlots(self,plotspecs,cuts,common=None,process=None,nodata=False,makeSummary=False):
+        """Like getManyPlots, for many cuts at once (e.g. the bins of a search), reading each tree only once.
+           If given, common is a selection implied by all the cuts, used to skip the other events.
+           Returns, for each cut, the list with the map of plots for each of the plotspecs."""
+        return self._getPlotGrid(_runCategoryPlots,plotspecs,(cuts,common),len(cuts),process,nodata,makeSummary)
+    def getPlotsWithVariations(self,plotspec,cut,variations=None,process=None,nodata=False,makeSummary=False):
+        """Like getPlots, filling also the plots of the systematic variations (by default, the ones from --variations)
+           in the same loop on each tree. The plots of a variation are merged, scaled and regrouped as the nominal
+           ones, among the processes it applies to, and returned in the same map with key process+"_"+name."""
+        if variations == None: variations = self._variations
+        applied = lambda key : [ v for v in variations if v.appliesTo(key) ]
+        tasks = []
+        for key,ttys in self._allData.iteritems():
+            if key == 'data' and nodata: continue
+            if process != None and key != process: continue
+            for tty in ttys:
+                tasks.append((key,tty,[ plotspec ],cut,applied(key)))
+        merge = lambda tty,results : [ [ tty.mergeChunkPlots([ r[j][0] for r in results ],plotspec) ] for j in xrange(len(results[0])) ]
+        retlist = self._runTasks(_runVariationPlots, tasks, merge)
+        ret = self._mergePlots(plotspec,[ (k,v[0][0]) for (k,v) in retlist ],makeSummary)
+        for var in variations:
+            varlist = []
+            for (k,v) in retlist:
+                names = [ x.name for x in applied(k) ]
+                if var.name in names: varlist.append((k, v[names.index(var.name)+1][0]))
+            if not varlist: continue
+            for (k,h) in self._mergePlots(plotspec,varlist).iteritems():
+                h.SetName("%s_%s_%s" % (plotspec.name,k,var.name))
+                ret["%s_%s" % (k,var.name)] = h
+        return ret
+    def _getPlotGrid(self,func,plotspecs,args,n,process,nodata,makeSummary):
+        tasks = []
+        for key,ttys in self._allData.iteritems():
+            if key == 'data' and nodata: continue
+            if process != None and key != process: continue
+            for tty in ttys:
+                tasks.append((key,tty,plotspecs)+args)
+        merge = lambda tty,results : [ [ tty.mergeChunkPlots(plots,plotspec) for (plots,plotspec) in zip(zip(*[ r[j] for r in results ]),plotspecs) ] for j in xrange(n) ]
+        retlist = self._runTasks(func, tasks, merge)
+        return [ [ self._mergePlots(plotspec,[ (k,v[j][i]) for (k,v) in retlist ],makeSummary) for (i,plotspec) in enumerate(plotspecs) ] for j in xrange(n) ]
+    def _runTasks(self,func,tasks,merge=None):
         if self._options.jobs == 0: 
-            retlist = map(_runPlot, tasks)
-        else:
-            #from sys import stderr
-            #stderr.write("Will run %d tasks on %d multiple treads\n" % (len(tasks),self._options.jobs))
+            retlist = []
+            for i,task in enumerate(tasks):
+                ret, record = _runRecording(func, task)
+                self._addRecord(record, i, len(tasks), local=True)
+                retlist.append(ret)
+            return retlist
+        if merge and self._options.splitFactor > 0:
+            return self._runSplitTasks(func,tasks,merge)
+        #from sys import stderr
+        #stderr.write("Will run %d tasks on %d multiple treads\n" % (len(tasks),self._options.jobs))
+        if self._pool == None:
             from multiprocessing import Pool
-            pool = Pool(self._options.jobs)
-            retlist  = pool.map(_runPlot, tasks)
-            pool.close()
-            pool.join()
-        ## then gather results with the same process
+            self._pool = Pool(self._options.jobs, _initWorker, (self._ttys,))
+            self._poolIndex = dict((id(tty),i) for (i,tty) in enumerate(self._ttys))
+        ## components are not sent to the workers, only their index and their current state
+        wtasks = []
+        for task in tasks:
+            tty = task[1]
+            index = self._poolIndex[id(tty.chunkOf())]
+            wtasks.append((func, task[0], index, tty.getState(), task[2:]))
+        retlist = []
+        for i,(ret,record) in enumerate(self._pool.imap(_runInWorker, wtasks)):
+            self._addRecord(record, i, len(tasks), local=False)
+            retlist.append(ret)
+        return retlist
+    def _addRecord(self,record,itask,ntasks,local):
+        addBranchUsage(record.pop('branchUsage'))
+        self._records.append(record)
+        if not local: # sum up the counters of the workers with the ones of this process
+            cache = getPlotCache(self._options)
+            if cache: cache.hits += record['cacheHits']; cache.misses += record['cacheMisses']
+            for (k,v) in record['counters'].iteritems(): addStat(k,v)
+            addStat('bytesReadByWorkers', record['bytesRead'])
+        if self._options.timing:
+            sys.stderr.write("\r  done %d/%d tasks (last: %s for %s, %.1f s)   " % (itask+1, ntasks, record['task'], record['component'], record['wall']))
+            if itask+1 == ntasks: sys.stderr.write("\n")
+    def printTimingReport(self):
+        """Print a summary of the time spent, entries and bytes read per component; 
+           optionally, save all the records of the tasks in a json file"""
+        if self._options.timingJSON:
+            import json
+            json.dump(self._records, open(self._options.timingJSON, "w"), indent=1)
+        if not self._options.timing or not self._records: return
+        sums = {}
+        for r in self._records:
+            s = sums.setdefault((r['process'],r['component']), dict(tasks=0, entries=0, bytesRead=0, cpu=0, wall=0, cacheHits=0, cacheMisses=0))
+            s['tasks'] += 1
+            for k in s.keys():
+                if k != 'tasks': s[k] += r.get(k,0)
+        print "%-20s %-40s %6s %12s %10s %9s %9s %10s %8s %10s" % ("process","component","tasks","entries","MB read","cpu (s)","wall (s)","kev/s","MB/s","cache hit")
+        for (p,c),s in sorted(sums.items(), key = lambda (k,s) : -s['wall']):
+            wall = max(s['wall'],1e-3)
+            print "%-20s %-40s %6d %12d %10.1f %9.1f %9.1f %10.1f %8.1f %10s" % (p, c, s['tasks'], s['entries'], s['bytesRead']/1024.**2, s['cpu'], s['wall'],
+                        s['entries']/1000./wall, s['bytesRead']/1024.**2/wall, "%d/%d" % (s['cacheHits'], s['cacheHits']+s['cacheMisses']))
+    def close(self):
+        """Stop the worker processes, if any"""
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    def __del__(self):
+        if getattr(self,'_pool',None) != None: self._pool.terminate()
+    def _runSplitTasks(self,func,tasks,merge):
+        """Run the tasks splitting the large components in chunks of entries, so that all jobs are kept
+           busy until the end. The results of the chunks of each component are put back together with
+           merge(tty, list of results)."""
+        entries = [ task[1].getEntriesToRead() for task in tasks ]
+        chunkSize = max(sum(entries)/(self._options.jobs*self._options.splitFactor), self._options.minChunkEntries)
+        chunks, owners = [], []
+        for i,task in enumerate(tasks):
+            for chunk in task[1].split(chunkSize):
+                chunks.append((task[0],chunk)+task[2:])
+                owners.append(i)
+        if len(chunks) == len(tasks): 
+            return self._runTasks(func,tasks)
+        # start from the largest chunks, so that small ones fill the gaps at the end
+        order = sorted(range(len(chunks)), key = lambda i : -chunks[i][1].getEntriesToRead())
+        results = [ [] for task in tasks ]
+        for i,(key,ret) in zip(order, self._runTasks(func, [ chunks[i] for i in order ])):
+            results[owners[i]].append((i,ret))
+        retlist = []
+        for task,rets in zip(tasks,results):
+            rets.sort() # merge in the order of the entries
+            if len(rets) == 1: retlist.append((task[0], rets[0][1]))
+            else:              retlist.append((task[0], merge(task[1], [ r for (i,r) in rets ])))
+        return retlist
+    def _mergePlots(self,plotspec,retlist,makeSummary=False):
+        ## gather results with the same process
         mergemap = {}
         for (k,v) in retlist: 
             if k not in mergemap: mergemap[k] = []
@@ -407,6 +582,10 @@ class MCAnalysis:
 def addMCAnalysisOptions(parser,addTreeToYieldOnesToo=True):
     if addTreeToYieldOnesToo: addTreeToYieldOptions(parser)
     parser.add_option("-j", "--jobs",           dest="jobs", type="int", default=0, help="Use N threads");
+    parser.add_option("--timing", dest="timing", action="store_true", default=False, help="Show the progress of the tasks, and print at the end the time spent, entries and bytes read for each component");
+    parser.add_option("--timing-json", dest="timingJSON", type="string", default=None, help="Save the time spent, entries and bytes read by each task in this json file");
+    parser.add_option("--split-factor",         dest="splitFactor", type="int", default=0, help="When running with N threads, split the large components in chunks of entries, aiming at about this number of chunks per thread (default: 0, i.e. don't split)");
+    parser.add_option("--min-chunk-entries",    dest="minChunkEntries", type="int", default=100000, help="Minimum number of entries of a chunk, with --split-factor");
     parser.add_option("-P", "--path",           dest="path",        type="string", default="./",      help="path to directory with input trees and pickle files (./)") 
     parser.add_option("--RP", "--remote-path",   dest="remotePath",  type="string", default=None,      help="path to remote directory with trees, but not other metadata (default: same as path)") 
     parser.add_option("-p", "--process", dest="processes", type="string", default=[], action="append", help="Processes to print (comma-separated list of regexp, can specify multiple ones)");
@@ -419,6 +598,7 @@ def addMCAnalysisOptions(parser,addTreeToYieldOnesToo=True):
     parser.add_option("--AP", "--all-processes", dest="allProcesses", action="store_true", help="Include also processes that are marked with SkipMe=True in the MCA.txt")
     parser.add_option("--project", dest="project", type="string", help="Project to a scenario (e.g 14TeV_300fb_scenario2)")
     parser.add_option("--plotgroup", dest="plotmergemap", type="string", default=[], action="append", help="Group plots into one. Syntax is '<newname> := (comma-separated list of regexp)', can specify multiple times. Note it is applied after plotting.")
+    parser.add_option("--variations", dest="variationsFile", type="string", default=None, help="Text file with systematic variations (alternate weights, replacements of branches) to be filled in the same loop as the nominal plots, with lines 'name : process regexp : weight factor [: old=new, ...]'");
     parser.add_option("--scaleplot", dest="plotscalemap", type="string", default=[], action="append", help="Scale plots by this factor (before grouping). Syntax is '<newname> := (comma-separated list of regexp)', can specify multiple times.")
 
 if __name__ == "__main__":
@@ -434,3 +614,5 @@ if __name__ == "__main__":
             cf.add(cut[0],cut[1])
     report = tty.getYields(cf)#, process=options.process)
     tty.prettyPrint(report)
+    printStats(options)
+    if isinstance(tty,MCAnalysis): tty.printTimingReport()
@@ -16,10 +16,10 @@ class SimpleCorrection:
         self._onlyForCuts = onlyForCuts
         self.alsoData = alsoData
     def __call__(self,expr,process,component,iscut):
-        if self._procMatch and not re.match(self._procMatch, process): return expr
-        if self._componentMatch and not re.match(self._componentMatch, component   ): return expr
+        if self._procMatch and not self._procMatch.match(process): return expr
+        if self._componentMatch and not self._componentMatch.match(component): return expr
         if self._onlyForCuts and not iscut: return expr
-        return re.sub(self._find, self._replace, expr)
+        return self._find.sub(self._replace, expr)
 
 class MCCorrections:
     def __init__(self,file):
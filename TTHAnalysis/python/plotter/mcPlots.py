@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 #from mcAnalysis import *
 from CMGTools.TTHAnalysis.plotter.mcAnalysis import *
-import itertools
+import itertools, hashlib, pickle, tempfile, shutil
 
 ## OFFICIAL CMS LUMI
 import CMS_lumi
@@ -604,7 +604,20 @@ class PlotMaker:
             for i,(cn,cv) in enumerate(allcuts[:-1]): # skip the last one which is equal to all cuts
                 cnsafe = "cut_%02d_%s" % (i, re.sub("[^a-zA-Z0-9_.]","",cn.replace(" ","_")))
                 sets.append((cnsafe,cn,cv))
-        for subname, title, cut in sets:
+        pspecs = plots.plots()
+        if options.preFitData:
+            matchspec = [ p for p in pspecs if p.name == options.preFitData ]
+            if not matchspec: raise RuntimeError, "Error: plot %s not found" % options.preFitData
+            pspecs = matchspec + [ p for p in pspecs if p.name != options.preFitData ]
+        setPlots = None
+        if self._options.singlePassCutFlow and len(sets) > 1:
+            if options.preFitData: 
+                print "Not filling the plots of all the cut steps at once, since the pre-fit changes the following ones"
+            else:
+                # step of the cut-flow of each set: all cuts first, then each sequential (or n-minus-one) one
+                steps = [ len(cuts.cuts()) ] + [ i+1 for i in xrange(len(sets)-1) ]
+                setPlots = mca.getCutFlowPlots(pspecs,cuts,steps,makeSummary=True)
+        for iset,(subname, title, cut) in enumerate(sets):
             print "cut set: ",title
             dir = self._dir
             if subname:
@@ -613,14 +626,15 @@ class PlotMaker:
                 else:
                     dir = self._dir.mkdir(subname,title)
             dir.cd()
-            pspecs = plots.plots()
-            if options.preFitData:
-                matchspec = [ p for p in pspecs if p.name == options.preFitData ]
-                if not matchspec: raise RuntimeError, "Error: plot %s not found" % options.preFitData
-                pspecs = matchspec + [ p for p in pspecs if p.name != options.preFitData ]
-            for pspec in pspecs:
+            filled = dict(enumerate(setPlots[iset])) if setPlots else {}
+            if setPlots: setPlots[iset] = None
+            renders = [] # plots to draw, once they're all filled
+            for ip,pspec in enumerate(pspecs):
                 print "    plot: ",pspec.name
-                pmap = mca.getPlots(pspec,cut,makeSummary=True)
+                if self._options.singlePass and not filled and not (options.preFitData and pspec.name == options.preFitData):
+                    # fill this and all the following plots in one go (the pre-fit one, if any, is done first on its own)
+                    filled = dict(zip(range(ip,len(pspecs)), mca.getManyPlots(pspecs[ip:],cut,makeSummary=True)))
+                pmap = filled.pop(ip) if ip in filled else mca.getPlots(pspec,cut,makeSummary=True)
                 #
                 # blinding policy
                 blind = pspec.getOption('Blinded','None') if 'data' in pmap else 'None'
@@ -672,16 +686,6 @@ class PlotMaker:
                         dir.WriteTObject(v)
                     continue
                 #
-                stack = ROOT.THStack(pspec.name+"_stack",pspec.name)
-                hists = [v for k,v in pmap.iteritems() if k != 'data']
-                total = hists[0].Clone(pspec.name+"_total"); total.Reset()
-                totalSyst = hists[0].Clone(pspec.name+"_totalSyst"); totalSyst.Reset()
-                if self._options.plotmode == "norm": 
-                    if 'data' in pmap:
-                        total.GetYaxis().SetTitle(total.GetYaxis().GetTitle()+" (normalized)")
-                    else:
-                        total.GetYaxis().SetTitle("density/bin")
-                    total.GetYaxis().SetDecimals(True)
                 if options.scaleSignalToData: doScaleSigNormData(pspec,pmap,mca)
                 elif options.fitData: doNormFit(pspec,pmap,mca)
                 elif options.preFitData and pspec.name == options.preFitData: 
@@ -690,271 +694,389 @@ class PlotMaker:
                 for k,v in pmap.iteritems():
                     if v.InheritsFrom("TH1"): v.SetDirectory(dir) 
                     dir.WriteTObject(v)
-                #
-                for p in itertools.chain(reversed(mca.listBackgrounds(allProcs=True)), reversed(mca.listSignals(allProcs=True))):
+                renders.append((pspec,pmap,dir,subname,xblind))
+            self._renderAll(mca,renders,makeCanvas)
+    def _renderPlot(self,mca,pspec,pmap,subname,xblind,makeCanvas,write):
+        """Make the stack, canvas and ratio of a filled plot, passing to write() what goes in the output
+           file, and print it; returns the list of printed files"""
+        printed = []
+        stack = ROOT.THStack(pspec.name+"_stack",pspec.name)
+        hists = [v for k,v in pmap.iteritems() if k != 'data']
+        total = hists[0].Clone(pspec.name+"_total"); total.Reset()
+        totalSyst = hists[0].Clone(pspec.name+"_totalSyst"); totalSyst.Reset()
+        if self._options.plotmode == "norm": 
+            if 'data' in pmap:
+                total.GetYaxis().SetTitle(total.GetYaxis().GetTitle()+" (normalized)")
+            else:
+                total.GetYaxis().SetTitle("density/bin")
+            total.GetYaxis().SetDecimals(True)
+        #
+        for p in itertools.chain(reversed(mca.listBackgrounds(allProcs=True)), reversed(mca.listSignals(allProcs=True))):
 
-                    if p in pmap: 
-                        plot = pmap[p]
-                        if plot.Integral() == 0:
-                            print 'Warning: plotting histo %s with zero integral, there might be problems in the following'%p
-                        if plot.Integral() < 0:
-                            print 'Warning: plotting histo %s with negative integral (%f), the stack plot will probably be incorrect.'%(p,plot.Integral())
-                        if 'TH1' in plot.ClassName():
+            if p in pmap: 
+                plot = pmap[p]
+                if plot.Integral() == 0:
+                    print 'Warning: plotting histo %s with zero integral, there might be problems in the following'%p
+                if plot.Integral() < 0:
+                    print 'Warning: plotting histo %s with negative integral (%f), the stack plot will probably be incorrect.'%(p,plot.Integral())
+                if 'TH1' in plot.ClassName():
+                    for b in xrange(1,plot.GetNbinsX()+1):
+                        if plot.GetBinContent(b)<0: print 'Warning: histo %s has bin %d with negative content (%f), the stack plot will probably be incorrect.'%(p,b,plot.GetBinContent(b))
+                elif 'TH2' in plot.ClassName():
+                    for b1 in xrange(1,plot.GetNbinsX()+1):
+                        for b2 in xrange(1,plot.GetNbinsY()+1):
+                            if plot.GetBinContent(b1,b2)<0: print 'Warning: histo %s has bin %d,%d with negative content (%f), the stack plot will probably be incorrect.'%(p,b1,b2,plot.GetBinContent(b))
+#                if plot.Integral() <= 0: continue
+                if mca.isSignal(p): plot.Scale(options.signalPlotScale)
+                if mca.isSignal(p) and options.noStackSig == True: continue 
+                if self._options.plotmode == "stack":
+                    stack.Add(plot)
+                    total.Add(plot)
+                    totalSyst.Add(plot)
+                    if mca.getProcessOption(p,'NormSystematic',0.0) > 0:
+                        syst = mca.getProcessOption(p,'NormSystematic',0.0)
+                        if "TH1" in plot.ClassName():
                             for b in xrange(1,plot.GetNbinsX()+1):
-                                if plot.GetBinContent(b)<0: print 'Warning: histo %s has bin %d with negative content (%f), the stack plot will probably be incorrect.'%(p,b,plot.GetBinContent(b))
-                        elif 'TH2' in plot.ClassName():
-                            for b1 in xrange(1,plot.GetNbinsX()+1):
-                                for b2 in xrange(1,plot.GetNbinsY()+1):
-                                    if plot.GetBinContent(b1,b2)<0: print 'Warning: histo %s has bin %d,%d with negative content (%f), the stack plot will probably be incorrect.'%(p,b1,b2,plot.GetBinContent(b))
-#                        if plot.Integral() <= 0: continue
-                        if mca.isSignal(p): plot.Scale(options.signalPlotScale)
-                        if mca.isSignal(p) and options.noStackSig == True: continue 
-                        if self._options.plotmode == "stack":
-                            stack.Add(plot)
-                            total.Add(plot)
-                            totalSyst.Add(plot)
-                            if mca.getProcessOption(p,'NormSystematic',0.0) > 0:
-                                syst = mca.getProcessOption(p,'NormSystematic',0.0)
-                                if "TH1" in plot.ClassName():
-                                    for b in xrange(1,plot.GetNbinsX()+1):
-                                        totalSyst.SetBinError(b, hypot(totalSyst.GetBinError(b), syst*plot.GetBinContent(b)))
-                        else:
-                            plot.SetLineColor(plot.GetFillColor())
-                            plot.SetLineWidth(3)
-                            plot.SetFillStyle(0)
-                            if self._options.plotmode == "norm" and (plot.ClassName()[:2] == "TH"):
-                                ref = pmap['data'].Integral() if 'data' in pmap else 1.0
-                                plot.Scale(ref/plot.Integral())
-                            stack.Add(plot)
-                            total.SetMaximum(max(total.GetMaximum(),1.3*plot.GetMaximum()))
-                        if self._options.errors and self._options.plotmode != "stack":
-                            plot.SetMarkerColor(plot.GetFillColor())
-                            plot.SetMarkerStyle(21)
-                            plot.SetMarkerSize(1.5)
-                        else:
-                            plot.SetMarkerStyle(0)
+                                totalSyst.SetBinError(b, hypot(totalSyst.GetBinError(b), syst*plot.GetBinContent(b)))
+                else:
+                    plot.SetLineColor(plot.GetFillColor())
+                    plot.SetLineWidth(3)
+                    plot.SetFillStyle(0)
+                    if self._options.plotmode == "norm" and (plot.ClassName()[:2] == "TH"):
+                        ref = pmap['data'].Integral() if 'data' in pmap else 1.0
+                        plot.Scale(ref/plot.Integral())
+                    stack.Add(plot)
+                    total.SetMaximum(max(total.GetMaximum(),1.3*plot.GetMaximum()))
+                if self._options.errors and self._options.plotmode != "stack":
+                    plot.SetMarkerColor(plot.GetFillColor())
+                    plot.SetMarkerStyle(21)
+                    plot.SetMarkerSize(1.5)
+                else:
+                    plot.SetMarkerStyle(0)
 
 
-                # to get fraction
-                if self._options.fraction:
-                    for plot in stack.GetHists():
-                        plot.Divide(total)
-                        plot.SetLineColor(plot.GetFillColor())
-                    total.Divide(total)
-                    total.SetMaximum(1)
+        # to get fraction
+        if self._options.fraction:
+            for plot in stack.GetHists():
+                plot.Divide(total)
+                plot.SetLineColor(plot.GetFillColor())
+            total.Divide(total)
+            total.SetMaximum(1)
 
-                # define aspect ratio
-                plotformat = (1200,600) if self._options.wideplot else (600,600)
-                sf = 20./plotformat[0]
-                ROOT.gStyle.SetPadLeftMargin(600.*0.18/plotformat[0])
+        # define aspect ratio
+        plotformat = (1200,600) if self._options.wideplot else (600,600)
+        sf = 20./plotformat[0]
+        ROOT.gStyle.SetPadLeftMargin(600.*0.18/plotformat[0])
 
-                stack.Draw("GOFF")
-                stack.GetYaxis().SetTitle(pspec.getOption('YTitle',"Events"))
-                stack.GetXaxis().SetTitle(pspec.getOption('XTitle',pspec.name))
-                stack.GetXaxis().SetNdivisions(pspec.getOption('XNDiv',510))
-                dir.WriteTObject(stack)
-                # 
-                if not makeCanvas and not self._options.printPlots: continue
-                doRatio = self._options.showRatio and ('data' in pmap or (self._options.plotmode != "stack" and len(pmap) == 4)) and ("TH2" not in total.ClassName())
-                # define aspect ratio
-                islog = pspec.hasOption('Logy');
-                if doRatio: ROOT.gStyle.SetPaperSize(20.,sf*(plotformat[1]+150))
-                else:       ROOT.gStyle.SetPaperSize(20.,sf*plotformat[1])
-                # create canvas
-                #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, 600, (750 if doRatio else 600))
-                #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, 600,600)
-                #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, plotformat[0], (plotformat[1]+150 if doRatio else plotformat[1]))
-                c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, plotformat[0], (plotformat[1] if doRatio else plotformat[1]))
-                c1.SetTopMargin(c1.GetTopMargin()*options.topSpamSize);
-                c1.Draw()
-                p1, p2 = c1, None # high and low panes
-                # set borders, if necessary create subpads
-                if doRatio:
-                    c1.SetWindowSize(plotformat[0] + (plotformat[0] - c1.GetWw()), (plotformat[1]+150 + (plotformat[1]+150 - c1.GetWh())));
-                    p1 = ROOT.TPad("pad1","pad1",0,0.31,1,1);
-                    p1.SetBottomMargin(0);
-                    p1.Draw();
-                    p2 = ROOT.TPad("pad2","pad2",0,0,1,0.31);
-                    p2.SetTopMargin(0);
-                    p2.SetBottomMargin(0.3);
-                    p2.SetFillStyle(0);
-                    p2.Draw();
-                    p1.cd();
-                else:
-                    c1.SetWindowSize(plotformat[0] + (plotformat[0] - c1.GetWw()), plotformat[1] + (plotformat[1] - c1.GetWh()));
-                p1.SetLogy(islog)
-                p1.SetLogz(pspec.hasOption('Logz'))
-                if pspec.hasOption('Logx'):
-                    p1.SetLogx(True)
-                    if p2: p2.SetLogx(True)
-                    total.GetXaxis().SetNoExponent(True)
-                    total.GetXaxis().SetMoreLogLabels(True)
-                #if islog: total.SetMaximum(2*total.GetMaximum())
-                #if not islog: total.SetMinimum(0)
-                if not options.extraLabel=="": #free some space on the canvas for extra label lines
-                    tmpMin = 0.1 #default log miminum
-                    if pspec.hasOption('YMin'):
-                        tmpMin = pspec.getOption('YMin',1.0)
-                    total.SetMinimum(tmpMin)
-                    tmpMax = total.GetMaximum()#total.GetBinContent(total.GetMaximumBin())
-                    relHistHeight = 1- (ROOT.gStyle.GetPadTopMargin() + ROOT.gStyle.GetPadBottomMargin() + 0.03*len(options.extraLabel.split("\\n")))
-                    if islog: maximum = tmpMin * pow(tmpMax/tmpMin,1./relHistHeight);
-                    else: maximum = (tmpMax-tmpMin)/relHistHeight + tmpMin
-                    total.SetMaximum(maximum)
-                elif islog: #plain log without extra labels
-                    total.SetMaximum(2*total.GetMaximum())
-                    total.SetMinimum(0.05) # default min value for logy
-                    if pspec.hasOption('YMin'): total.SetMinimum(pspec.getOption('YMin',1.0))
-                else: total.SetMinimum(0)
+        stack.Draw("GOFF")
+        stack.GetYaxis().SetTitle(pspec.getOption('YTitle',"Events"))
+        stack.GetXaxis().SetTitle(pspec.getOption('XTitle',pspec.name))
+        stack.GetXaxis().SetNdivisions(pspec.getOption('XNDiv',510))
+        write(stack)
+        # 
+        if not makeCanvas and not self._options.printPlots: return printed
+        doRatio = self._options.showRatio and ('data' in pmap or (self._options.plotmode != "stack" and len(pmap) == 4)) and ("TH2" not in total.ClassName())
+        # define aspect ratio
+        islog = pspec.hasOption('Logy');
+        if doRatio: ROOT.gStyle.SetPaperSize(20.,sf*(plotformat[1]+150))
+        else:       ROOT.gStyle.SetPaperSize(20.,sf*plotformat[1])
+        # create canvas
+        #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, 600, (750 if doRatio else 600))
+        #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, 600,600)
+        #c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, plotformat[0], (plotformat[1]+150 if doRatio else plotformat[1]))
+        c1 = ROOT.TCanvas(pspec.name+"_canvas", pspec.name, plotformat[0], (plotformat[1] if doRatio else plotformat[1]))
+        c1.SetTopMargin(c1.GetTopMargin()*options.topSpamSize);
+        c1.Draw()
+        p1, p2 = c1, None # high and low panes
+        # set borders, if necessary create subpads
+        if doRatio:
+            c1.SetWindowSize(plotformat[0] + (plotformat[0] - c1.GetWw()), (plotformat[1]+150 + (plotformat[1]+150 - c1.GetWh())));
+            p1 = ROOT.TPad("pad1","pad1",0,0.31,1,1);
+            p1.SetBottomMargin(0);
+            p1.Draw();
+            p2 = ROOT.TPad("pad2","pad2",0,0,1,0.31);
+            p2.SetTopMargin(0);
+            p2.SetBottomMargin(0.3);
+            p2.SetFillStyle(0);
+            p2.Draw();
+            p1.cd();
+        else:
+            c1.SetWindowSize(plotformat[0] + (plotformat[0] - c1.GetWw()), plotformat[1] + (plotformat[1] - c1.GetWh()));
+        p1.SetLogy(islog)
+        p1.SetLogz(pspec.hasOption('Logz'))
+        if pspec.hasOption('Logx'):
+            p1.SetLogx(True)
+            if p2: p2.SetLogx(True)
+            total.GetXaxis().SetNoExponent(True)
+            total.GetXaxis().SetMoreLogLabels(True)
+        #if islog: total.SetMaximum(2*total.GetMaximum())
+        #if not islog: total.SetMinimum(0)
+        if not options.extraLabel=="": #free some space on the canvas for extra label lines
+            tmpMin = 0.1 #default log miminum
+            if pspec.hasOption('YMin'):
+                tmpMin = pspec.getOption('YMin',1.0)
+            total.SetMinimum(tmpMin)
+            tmpMax = total.GetMaximum()#total.GetBinContent(total.GetMaximumBin())
+            relHistHeight = 1- (ROOT.gStyle.GetPadTopMargin() + ROOT.gStyle.GetPadBottomMargin() + 0.03*len(options.extraLabel.split("\\n")))
+            if islog: maximum = tmpMin * pow(tmpMax/tmpMin,1./relHistHeight);
+            else: maximum = (tmpMax-tmpMin)/relHistHeight + tmpMin
+            total.SetMaximum(maximum)
+        elif islog: #plain log without extra labels
+            total.SetMaximum(2*total.GetMaximum())
+            total.SetMinimum(0.05) # default min value for logy
+            if pspec.hasOption('YMin'): total.SetMinimum(pspec.getOption('YMin',1.0))
+        else: total.SetMinimum(0)
 
-                total.Draw("HIST")
-                if self._options.plotmode == "stack":
-                    if self._options.fraction:
-                        stack.Draw("SAME HIST E")
-                    else:
-                        stack.Draw("SAME HIST ")
-                    total.Draw("AXIS SAME")
-                else: 
-                    if self._options.errors:
-                        ROOT.gStyle.SetErrorX(0.5)
-                        stack.Draw("SAME E NOSTACK")
-                    else:
-                        stack.Draw("SAME HIST NOSTACK")
-                if pspec.getOption('MoreY',1.0) > 1.0:
-                    total.SetMaximum(pspec.getOption('MoreY',1.0)*total.GetMaximum())
-                if options.showMCError:
-                    totalError = doShadedUncertainty(totalSyst)
-                is2D = total.InheritsFrom("TH2")
-                if 'data' in pmap: 
-                    if options.poisson and not is2D:
-                        pdata = getDataPoissonErrors(pmap['data'], False, True)
-                        pdata.Draw("PZ SAME")
-                        pmap['data'].poissonGraph = pdata ## attach it so it doesn't get deleted
-                    else:
-                        pmap['data'].Draw("E SAME")
-                    reMax(total,pmap['data'],islog)
-                    if xblind[0] < xblind[1]:
-                        blindbox = ROOT.TBox(xblind[0],total.GetYaxis().GetXmin(),xblind[1],total.GetMaximum())
-                        blindbox.SetFillColor(ROOT.kBlue+3)
-                        blindbox.SetFillStyle(3944)
-                        blindbox.Draw()
-                        xblind.append(blindbox) # so it doesn't get deleted
-                    if options.doStatTests:
-                        doStatTests(totalSyst, pmap['data'], options.doStatTests, legendCorner=pspec.getOption('Legend','TR'))
-                if pspec.hasOption('YMin') and pspec.hasOption('YMax'):
-                    total.GetYaxis().SetRangeUser(pspec.getOption('YMin',1.0), pspec.getOption('YMax',1.0))
-                #legendCutoff = pspec.getOption('LegendCutoff', 1e-5 if c1.GetLogy() else 1e-2)
-                legendCutoff = 0
-                if self._options.plotmode == "norm": legendCutoff = 0 
-                doLegend(pmap,mca,corner=pspec.getOption('Legend','TR'),
-                                  cutoff=legendCutoff, mcStyle=("F" if self._options.plotmode == "stack" else "L"),
-                                  cutoffSignals=not(options.showSigShape or options.showIndivSigShapes or options.showSFitShape), 
-                                  textSize=(0.045 if doRatio else 0.035),
-                                  legWidth=options.legendWidth)
-                if not options.cmslumi:
-                    doTinyCmsPrelim(hasExpo = total.GetMaximum() > 9e4 and not c1.GetLogy(),textSize=(0.045 if doRatio else 0.033))
-                else:
-                    if 'data' in pmap:
-                        doCMSlumi(c1)
-                    else:
-                        doCMSlumi(c1,True)
+        total.Draw("HIST")
+        if self._options.plotmode == "stack":
+            if self._options.fraction:
+                stack.Draw("SAME HIST E")
+            else:
+                stack.Draw("SAME HIST ")
+            total.Draw("AXIS SAME")
+        else: 
+            if self._options.errors:
+                ROOT.gStyle.SetErrorX(0.5)
+                stack.Draw("SAME E NOSTACK")
+            else:
+                stack.Draw("SAME HIST NOSTACK")
+        if pspec.getOption('MoreY',1.0) > 1.0:
+            total.SetMaximum(pspec.getOption('MoreY',1.0)*total.GetMaximum())
+        if options.showMCError:
+            totalError = doShadedUncertainty(totalSyst)
+        is2D = total.InheritsFrom("TH2")
+        if 'data' in pmap: 
+            if options.poisson and not is2D:
+                pdata = getDataPoissonErrors(pmap['data'], False, True)
+                pdata.Draw("PZ SAME")
+                pmap['data'].poissonGraph = pdata ## attach it so it doesn't get deleted
+            else:
+                pmap['data'].Draw("E SAME")
+            reMax(total,pmap['data'],islog)
+            if xblind[0] < xblind[1]:
+                blindbox = ROOT.TBox(xblind[0],total.GetYaxis().GetXmin(),xblind[1],total.GetMaximum())
+                blindbox.SetFillColor(ROOT.kBlue+3)
+                blindbox.SetFillStyle(3944)
+                blindbox.Draw()
+                xblind.append(blindbox) # so it doesn't get deleted
+            if options.doStatTests:
+                doStatTests(totalSyst, pmap['data'], options.doStatTests, legendCorner=pspec.getOption('Legend','TR'))
+        if pspec.hasOption('YMin') and pspec.hasOption('YMax'):
+            total.GetYaxis().SetRangeUser(pspec.getOption('YMin',1.0), pspec.getOption('YMax',1.0))
+        #legendCutoff = pspec.getOption('LegendCutoff', 1e-5 if c1.GetLogy() else 1e-2)
+        legendCutoff = 0
+        if self._options.plotmode == "norm": legendCutoff = 0 
+        doLegend(pmap,mca,corner=pspec.getOption('Legend','TR'),
+                          cutoff=legendCutoff, mcStyle=("F" if self._options.plotmode == "stack" else "L"),
+                          cutoffSignals=not(options.showSigShape or options.showIndivSigShapes or options.showSFitShape), 
+                          textSize=(0.045 if doRatio else 0.035),
+                          legWidth=options.legendWidth)
+        if not options.cmslumi:
+            doTinyCmsPrelim(hasExpo = total.GetMaximum() > 9e4 and not c1.GetLogy(),textSize=(0.045 if doRatio else 0.033))
+        else:
+            if 'data' in pmap:
+                doCMSlumi(c1)
+            else:
+                doCMSlumi(c1,True)
 
-                if not options.extraLabel=="": printExtraLabel(options.extraLabel,pspec.getOption('Legend','TR'))
-                signorm = None; datnorm = None; sfitnorm = None
-                if options.showSigShape or options.showIndivSigShapes or options.showIndivSigs: 
-                    signorms = doStackSignalNorm(pspec,pmap,options.showIndivSigShapes or options.showIndivSigs,extrascale=options.signalPlotScale, norm=not options.showIndivSigs)
-                    for signorm in signorms:
-                        signorm.SetDirectory(dir); dir.WriteTObject(signorm)
-                        reMax(total,signorm,islog)
-                if options.showDatShape: 
-                    datnorm = doDataNorm(pspec,pmap)
-                    if datnorm != None:
-                        datnorm.SetDirectory(dir); dir.WriteTObject(datnorm)
-                        reMax(total,datnorm,islog)
-                if options.showSFitShape: 
-                    (sfitnorm,sf) = doStackSigScaledNormData(pspec,pmap)
-                    if sfitnorm != None:
-                        sfitnorm.SetDirectory(dir); dir.WriteTObject(sfitnorm)
-                        reMax(total,sfitnorm,islog)
-                if options.flagDifferences and len(pmap) == 4:
-                    new = pmap['signal']
-                    ref = pmap['background']
-                    if "TH1" in new.ClassName():
-                        for b in xrange(1,new.GetNbinsX()+1):
-                            if new.GetBinContent(b) != ref.GetBinContent(b):
-                                print "Plot: difference found in %s, bin %d" % (pspec.name, b)
-                                p1.SetFillColor(ROOT.kYellow-10)
-                                if p2: p2.SetFillColor(ROOT.kYellow-10)
-                                break
-                if makeCanvas: dir.WriteTObject(c1)
-                rdata,rnorm,rnorm2,rline = (None,None,None,None)
-                if doRatio:
-                    p2.cd(); 
-                    rdata,rnorm,rnorm2,rline = doRatioHists(pspec,pmap,total,totalSyst, maxRange=options.maxRatioRange, fitRatio=options.fitRatio)
-                    # write ratio also to dir
-                    rdata.SetName(stack.GetName().replace("stack","ratio"))
-                    dir.WriteTObject(rdata)
+        if not options.extraLabel=="": printExtraLabel(options.extraLabel,pspec.getOption('Legend','TR'))
+        signorm = None; datnorm = None; sfitnorm = None
+        if options.showSigShape or options.showIndivSigShapes or options.showIndivSigs: 
+            signorms = doStackSignalNorm(pspec,pmap,options.showIndivSigShapes or options.showIndivSigs,extrascale=options.signalPlotScale, norm=not options.showIndivSigs)
+            for signorm in signorms:
+                write(signorm)
+                reMax(total,signorm,islog)
+        if options.showDatShape: 
+            datnorm = doDataNorm(pspec,pmap)
+            if datnorm != None:
+                write(datnorm)
+                reMax(total,datnorm,islog)
+        if options.showSFitShape: 
+            (sfitnorm,sf) = doStackSigScaledNormData(pspec,pmap)
+            if sfitnorm != None:
+                write(sfitnorm)
+                reMax(total,sfitnorm,islog)
+        if options.flagDifferences and len(pmap) == 4:
+            new = pmap['signal']
+            ref = pmap['background']
+            if "TH1" in new.ClassName():
+                for b in xrange(1,new.GetNbinsX()+1):
+                    if new.GetBinContent(b) != ref.GetBinContent(b):
+                        print "Plot: difference found in %s, bin %d" % (pspec.name, b)
+                        p1.SetFillColor(ROOT.kYellow-10)
+                        if p2: p2.SetFillColor(ROOT.kYellow-10)
+                        break
+        if makeCanvas: write(c1)
+        rdata,rnorm,rnorm2,rline = (None,None,None,None)
+        if doRatio:
+            p2.cd(); 
+            rdata,rnorm,rnorm2,rline = doRatioHists(pspec,pmap,total,totalSyst, maxRange=options.maxRatioRange, fitRatio=options.fitRatio)
+            # write ratio also to dir
+            rdata.SetName(stack.GetName().replace("stack","ratio"))
+            write(rdata)
 
-                if self._options.printPlots:
-                    for ext in self._options.printPlots.split(","):
-                        fdir = self._options.printDir;
-                        if subname: fdir += "/"+subname;
-                        if not os.path.exists(fdir): 
-                            os.makedirs(fdir); 
-                            #if os.path.exists("/afs/cern.ch"): os.system("cp /afs/cern.ch/user/g/gpetrucc/php/index.php "+fdir)
-                            if os.path.exists("/afs/desy.de"): os.system("cp /afs/cern.ch/user/a/alobanov/public/php/index.php "+fdir)
-                        if ext == "txt":
-                            dump = open("%s/%s.%s" % (fdir, pspec.name, ext), "w")
-                            maxlen = max([len(mca.getProcessOption(p,'Label',p)) for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True)]+[7])
-                            fmt    = "%%-%ds %%9.2f +/- %%9.2f (stat)" % (maxlen+1)
-                            for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True) + ["signal", "background"]:
+        if self._options.printPlots:
+            for ext in self._options.printPlots.split(","):
+                fdir = self._printDir(subname)
+                if ext == "txt":
+                    dump = open("%s/%s.%s" % (fdir, pspec.name, ext), "w")
+                    printed.append(dump.name)
+                    maxlen = max([len(mca.getProcessOption(p,'Label',p)) for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True)]+[7])
+                    fmt    = "%%-%ds %%9.2f +/- %%9.2f (stat)" % (maxlen+1)
+                    for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True) + ["signal", "background"]:
+                        if p not in pmap: continue
+                        plot = pmap[p]
+                        if plot.Integral() <= 0: continue
+                        norm = plot.Integral()
+                        if p not in ["signal","background"] and mca.isSignal(p): norm /= options.signalPlotScale # un-scale what was scaled
+                        stat = sqrt(sum([plot.GetBinError(b)**2 for b in xrange(1,plot.GetNbinsX()+1)]))
+                        syst = norm * mca.getProcessOption(p,'NormSystematic',0.0) if p not in ["signal", "background"] else 0;
+                        if p == "signal": dump.write(("-"*(maxlen+45))+"\n");
+                        dump.write(fmt % (_unTLatex(mca.getProcessOption(p,'Label',p) if p not in ["signal", "background"] else p.upper()), norm, stat))
+                        if syst: dump.write(" +/- %9.2f (syst)"  % syst)
+                        dump.write("\n")
+                    if 'data' in pmap: 
+                        dump.write(("-"*(maxlen+45))+"\n");
+                        dump.write(("%%%ds %%7.0f\n" % (maxlen+1)) % ('DATA', pmap['data'].Integral()))
+                    for logname, loglines in pspec.allLogs():
+                        dump.write("\n\n --- %s --- \n" % logname)
+                        for line in loglines: dump.write("%s\n" % line)
+                        dump.write("\n")
+                    dump.close()
+                else:
+                    if "TH2" in total.ClassName() or "TProfile2D" in total.ClassName():
+                        pmap["total"] = total
+                        for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True) + ["signal", "background", "data", "total"]:
+                            if p not in pmap: continue
+                            plot = pmap[p]
+                            if "TGraph" in plot.ClassName(): continue
+                            c1.SetRightMargin(0.20)
+                            if pspec.hasOption('Logz'):
+                                plot.SetContour(20)
+                                plot.Draw("CONT0Z")
+                            else:
+                                plot.SetContour(100)
+                                plot.Draw(pspec.getOption("PlotMode","COLZ TEXT45"))
+                            printed.append("%s/%s_%s.%s" % (fdir, pspec.name, p, ext))
+                            c1.Print(printed[-1])
+                        if "data" in pmap and "TGraph" in pmap["data"].ClassName():
+                            pmap["data"].SetMarkerSize(pspec.getOption("MarkerSize",1.6))
+                            for p in ["signal", "background", "total"]:
                                 if p not in pmap: continue
                                 plot = pmap[p]
-                                if plot.Integral() <= 0: continue
-                                norm = plot.Integral()
-                                if p not in ["signal","background"] and mca.isSignal(p): norm /= options.signalPlotScale # un-scale what was scaled
-                                stat = sqrt(sum([plot.GetBinError(b)**2 for b in xrange(1,plot.GetNbinsX()+1)]))
-                                syst = norm * mca.getProcessOption(p,'NormSystematic',0.0) if p not in ["signal", "background"] else 0;
-                                if p == "signal": dump.write(("-"*(maxlen+45))+"\n");
-                                dump.write(fmt % (_unTLatex(mca.getProcessOption(p,'Label',p) if p not in ["signal", "background"] else p.upper()), norm, stat))
-                                if syst: dump.write(" +/- %9.2f (syst)"  % syst)
-                                dump.write("\n")
-                            if 'data' in pmap: 
-                                dump.write(("-"*(maxlen+45))+"\n");
-                                dump.write(("%%%ds %%7.0f\n" % (maxlen+1)) % ('DATA', pmap['data'].Integral()))
-                            for logname, loglines in pspec.allLogs():
-                                dump.write("\n\n --- %s --- \n" % logname)
-                                for line in loglines: dump.write("%s\n" % line)
-                                dump.write("\n")
-                            dump.close()
-                        else:
-                            if "TH2" in total.ClassName() or "TProfile2D" in total.ClassName():
-                                pmap["total"] = total
-                                for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True) + ["signal", "background", "data", "total"]:
-                                    if p not in pmap: continue
-                                    plot = pmap[p]
-                                    if "TGraph" in plot.ClassName(): continue
-                                    c1.SetRightMargin(0.20)
-                                    if pspec.hasOption('Logz'):
-                                        plot.SetContour(20)
-                                        plot.Draw("CONT0Z")
-                                    else:
-                                        plot.SetContour(100)
-                                        plot.Draw(pspec.getOption("PlotMode","COLZ TEXT45"))
-                                    c1.Print("%s/%s_%s.%s" % (fdir, pspec.name, p, ext))
-                                if "data" in pmap and "TGraph" in pmap["data"].ClassName():
-                                    pmap["data"].SetMarkerSize(pspec.getOption("MarkerSize",1.6))
-                                    for p in ["signal", "background", "total"]:
-                                        if p not in pmap: continue
-                                        plot = pmap[p]
-                                        c1.SetRightMargin(0.20)
-                                        plot.SetContour(100)
-                                        plot.Draw(pspec.getOption("PlotMode","COLZ TEXT45"))
-                                        pmap["data"].Draw("P SAME")
-                                        c1.Print("%s/%s_data_%s.%s" % (fdir, pspec.name, p, ext))
-                            else:
-                                c1.Print("%s/%s.%s" % (fdir, pspec.name, ext))
-                c1.Close()
+                                c1.SetRightMargin(0.20)
+                                plot.SetContour(100)
+                                plot.Draw(pspec.getOption("PlotMode","COLZ TEXT45"))
+                                pmap["data"].Draw("P SAME")
+                                printed.append("%s/%s_data_%s.%s" % (fdir, pspec.name, p, ext))
+                                c1.Print(printed[-1])
+                    else:
+                        printed.append("%s/%s.%s" % (fdir, pspec.name, ext))
+                        c1.Print(printed[-1])
+        c1.Close()
+        return printed
+    def _renderAll(self,mca,renders,makeCanvas):
+        """Draw and print the filled plots. With --print and either --render-jobs N or --render-cache DIR,
+           each plot is drawn into a file of its own, from which what goes in the output file is then copied:
+           the plots can be drawn by a pool of processes (--render-jobs), and the files kept in DIR are used
+           not to draw again the plots whose inputs didn't change since they were last printed (--render-cache)"""
+        if not self._options.printPlots or not (self._options.renderJobs > 1 or self._options.renderCache):
+            for (pspec,pmap,dir,subname,xblind) in renders:
+                self._renderPlot(mca,pspec,pmap,subname,xblind,makeCanvas,_writer(dir))
+            return
+        cdir = self._options.renderCache if self._options.renderCache else tempfile.mkdtemp(prefix="mcPlotsRender")
+        try:
+            self._renderInFiles(mca,renders,makeCanvas,cdir)
+        finally:
+            if not self._options.renderCache: shutil.rmtree(cdir)
+    def _renderInFiles(self,mca,renders,makeCanvas,cdir):
+        global _toRender
+        _toRender = []
+        for (pspec,pmap,dir,subname,xblind) in renders:
+            fname = self._renderFile(cdir,subname,pspec)
+            key = self._renderHash(mca,pspec,pmap,subname,xblind,makeCanvas)
+            if not _renderUpToDate(fname,key):
+                _toRender.append((self,mca,pspec,pmap,subname,xblind,makeCanvas,fname,key))
+        if len(_toRender) < len(renders):
+            print "Drawing %d of %d plots, the others are unchanged" % (len(_toRender), len(renders))
+        if self._options.renderJobs > 1 and len(_toRender) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(self._options.renderJobs,len(_toRender)))
+            pool.map(_renderToFile, xrange(len(_toRender)))
+            pool.close()
+            pool.join()
+        else:
+            map(_renderToFile, xrange(len(_toRender)))
+        _toRender = []
+        for (pspec,pmap,dir,subname,xblind) in renders:
+            _copyRendered(self._renderFile(cdir,subname,pspec), dir)
+    def _renderFile(self,cdir,subname,pspec):
+        fdir = cdir+"/"+subname if subname else cdir
+        if not os.path.exists(fdir): os.makedirs(fdir)
+        return "%s/%s.render.root" % (fdir, pspec.name)
+    def _renderHash(self,mca,pspec,pmap,subname,xblind,makeCanvas):
+        """Hash of what determines how a plot is drawn: its histograms, the plot and process options,
+           the command line options used in drawing (_drawingOptions), and the code (_codeSignature)"""
+        h = hashlib.sha1(_codeSignature)
+        h.update(repr((pspec.name, pspec.expr, pspec.bins, sorted(pspec.opts.items()), sorted(pspec.logs.items()), subname, xblind[:2], makeCanvas)))
+        h.update(repr([ (k,getattr(self._options,k,None)) for k in _drawingOptions ]))
+        h.update(repr([ (p, mca.getProcessOption(p,'Label',p), mca.isSignal(p), mca.getProcessOption(p,'NormSystematic',0.0)) for p in mca.listSignals(allProcs=True) + mca.listBackgrounds(allProcs=True) ]))
+        for k in sorted(pmap.iterkeys()):
+            h.update(k)
+            h.update(pickle.dumps(pmap[k]))
+        return h.hexdigest()
+    def _printDir(self,subname):
+        fdir = self._options.printDir;
+        if subname: fdir += "/"+subname;
+        if not os.path.exists(fdir): 
+            os.makedirs(fdir); 
+            #if os.path.exists("/afs/cern.ch"): os.system("cp /afs/cern.ch/user/g/gpetrucc/php/index.php "+fdir)
+            if os.path.exists("/afs/desy.de"): os.system("cp /afs/cern.ch/user/a/alobanov/public/php/index.php "+fdir)
+        return fdir
+
+def _source(fname):
+    fname = fname.replace(".pyc",".py")
+    return open(fname).read() if os.path.exists(fname) else fname
+## to redraw the plots when the drawing code changes: this file, the helpers in mcAnalysis, the CMS label and the style (loaded from the current directory)
+_codeSignature = "".join(_source(f) for f in (__file__, sys.modules['CMGTools.TTHAnalysis.plotter.mcAnalysis'].__file__, CMS_lumi.__file__, "tdrstyle.cc"))
+## the command line options used by _renderPlot and the functions it calls (the others change the plots only through their histograms)
+_drawingOptions = ( 'lumi', 'lspam', 'rspam', 'cmslumi', 'topSpamSize', 'extraLabel', 'wideplot', 'plotmode', 'errors', 'poisson', 'fraction',
+                    'signalPlotScale', 'noStackSig', 'showSigShape', 'showIndivSigShapes', 'showIndivSigs', 'showDatShape', 'showSFitShape', 'showMCError',
+                    'showRatio', 'fitRatio', 'maxRatioRange', 'doStatTests', 'flagDifferences', 'legendWidth', 'legendBorder', 'legendFontSize',
+                    'printPlots', 'printDir' )
+_toRender = [] # plots to be drawn by _renderToFile, set before forking the processes that draw them
+def _writer(tdir):
+    def write(obj):
+        if obj.InheritsFrom("TH1"): obj.SetDirectory(tdir)
+        tdir.WriteTObject(obj)
+    return write
+def _renderToFile(i):
+    (maker,mca,pspec,pmap,subname,xblind,makeCanvas,fname,key) = _toRender[i]
+    gdir = ROOT.gDirectory
+    tfile = ROOT.TFile(fname+".tmp","RECREATE")
+    gdir.cd()
+    printed = maker._renderPlot(mca,pspec,pmap,subname,xblind,makeCanvas,_writer(tfile))
+    tfile.WriteTObject(ROOT.TNamed("renderHash",key))
+    tfile.WriteTObject(ROOT.TNamed("renderOutputs",",".join(printed)))
+    tfile.Close()
+    gdir.cd()
+    os.rename(fname+".tmp",fname)
+def _renderUpToDate(fname,key):
+    if not os.path.exists(fname): return False
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie(): return False
+    (rkey,outputs) = (tfile.Get("renderHash"), tfile.Get("renderOutputs"))
+    ret = bool(rkey) and bool(outputs) and rkey.GetTitle() == key and all(os.path.exists(f) for f in outputs.GetTitle().split(",") if f)
+    tfile.Close()
+    return ret
+def _copyRendered(fname,tdir):
+    write = _writer(tdir)
+    tfile = ROOT.TFile.Open(fname)
+    for key in tfile.GetListOfKeys():
+        if key.GetName() in ("renderHash","renderOutputs"): continue
+        write(key.ReadObj())
+    tfile.Close()
+
 def addPlotMakerOptions(parser):
     addMCAnalysisOptions(parser)
     parser.add_option("--ss",  "--scale-signal", dest="signalPlotScale", default=1.0, type="float", help="scale the signal in the plots by this amount");
@@ -965,6 +1087,9 @@ def addPlotMakerOptions(parser):
     parser.add_option("--topSpamSize", dest="topSpamSize",   type="float", default=1., help="Zoom factor for the top spam");
     parser.add_option("--print", dest="printPlots", type="string", default="png,pdf,txt", help="print out plots in this format or formats (e.g. 'png,pdf,txt')");
     parser.add_option("--pdir", "--print-dir", dest="printDir", type="string", default="plots", help="print out plots in this directory");
+    parser.add_option("--single-pass-cut-flow", dest="singlePassCutFlow", action="store_true", default=False, help="Fill the plots for all the steps of the cut-flow (sequential, or n-minus-one with -N) in a single loop on each tree, evaluating each cut once per event");
+    parser.add_option("--render-jobs", dest="renderJobs", type="int", default=0, help="Draw and print the plots with N processes, after they're all filled (only with --print)");
+    parser.add_option("--render-cache", dest="renderCache", type="string", default=None, help="Keep here the drawn plots, so that those whose inputs didn't change are not drawn again when printing them (only with --print)");
     parser.add_option("--showSigShape", dest="showSigShape", action="store_true", default=False, help="Superimpose a normalized signal shape")
     parser.add_option("--showIndivSigShapes", dest="showIndivSigShapes", action="store_true", default=False, help="Superimpose normalized shapes for each signal individually")
     parser.add_option("--showIndivSigs", dest="showIndivSigs", action="store_true", default=False, help="Superimpose shapes for each signal individually (normalized to their expected event yield)")
@@ -1023,6 +1148,9 @@ if __name__ == "__main__":
     outfile  = ROOT.TFile(outname,"RECREATE")
     plotter = PlotMaker(outfile)
     plotter.run(mca,cuts,plots)
+    mca.close()
     outfile.Close()
+    printStats(options)
+    mca.printTimingReport()
 
 
@@ -0,0 +1,279 @@
+#include <TTree.h>
+#include <TEntryList.h>
+#include <TTreeFormula.h>
+#include <TTreeFormulaManager.h>
+#include <TH1.h>
+#include <TH2.h>
+#include <TH3.h>
+#include <TProfile.h>
+#include <TProfile2D.h>
+#include <THnBase.h>
+#include <string>
+#include <vector>
+#include <map>
+#include <iostream>
+
+//// Fill many histograms from the same tree in a single loop on the entries.
+//// Each histogram behaves as if made with TTree::Draw("z:y:x>>histo", weight);
+//// histograms sharing the same weight expression (usually the full selection
+//// times the event weight) get it evaluated only once per event.
+//// Optionally, a list of cuts can be defined, and histograms can be filled only
+//// for events passing a given step of the cut-flow (sequential or n-minus-one):
+//// each cut is evaluated at most once per event, stopping at the first failure.
+class MultiDraw {
+    public:
+        MultiDraw(TTree *tree) : tree_(tree), treeNumber_(-1), nMinusOne_(false), maxStep_(-1) {}
+        ~MultiDraw() ;
+        /// append a cut to the cut-flow. returns its index, or -1 if the expression is invalid
+        /// or is not a scalar (cuts on arrays have a different meaning in TTree::Draw)
+        int addCut(const char *expr) ;
+        /// steps are n-minus-one cuts instead of sequential ones
+        void setNMinusOne(bool nMinusOne) { nMinusOne_ = nMinusOne; }
+        /// book a histogram to be filled with the given expressions, in the order of the axes
+        /// (i.e. reversed with respect to TTree::Draw; yexpr, zexpr may be empty).
+        /// for profiles, the last non-empty expression is the profiled quantity.
+        /// if step is not negative, the histogram is filled only for events passing the cut-flow up to that step:
+        /// the first 'step' cuts for a sequential cut-flow, all cuts except 'step' for a n-minus-one one
+        /// (all cuts if step is equal to the number of cuts).
+        /// returns the index of the histogram, or -1 if any of the expressions is invalid.
+        int add(TH1 *histo, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step=-1) ;
+        /// same for a sparse histogram (e.g. THnSparse), which TTree::Draw can't fill
+        int add(THnBase *histo, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step=-1) ;
+        /// loop on the tree, as TTree::Draw(..., nentries, firstentry). returns the number of entries read.
+        /// if the tree has an entry list, only its entries are read, and the range refers to positions in the list
+        Long64_t run(Long64_t maxEntries=1000000000, Long64_t firstEntry=0) ;
+        /// number of histograms booked
+        int size() const { return plots_.size(); }
+    private:
+        struct Weight {
+            TTreeFormula *formula;
+            bool multiple;
+            bool done;
+            double value;
+        };
+        struct Plot {
+            TH1 *histo;
+            THnBase *sparse;
+            int nvars;
+            bool profile;
+            TTreeFormula *vars[3];
+            TTreeFormula *weight; // own copy of the weight, only if it has to be evaluated per instance
+            int iweight;
+            int step;
+        };
+        TTree *tree_;
+        Int_t  treeNumber_;
+        std::vector<Weight> weights_;
+        std::map<std::string,int> weightIndex_;
+        std::vector<Plot> plots_;
+        std::vector<TTreeFormula *> allFormulas_;
+        std::vector<TTreeFormula *> cuts_;
+        bool nMinusOne_;
+        int  maxStep_;
+        // cut-flow status of the current event: number of leading cuts passed (sequential),
+        // or number of failed cuts and index of the last failed one (n-minus-one)
+        int passed_, failed_, lastFailed_;
+
+        TTreeFormula *makeFormula(const char *expr) ;
+        int addWeight(const char *expr) ;
+        int addPlot(Plot &p, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step) ;
+        void fill(Plot &p, double w, int instance) ;
+        void evalCuts() ;
+        bool passCuts(int step) const ;
+        double weight(Weight &w) ;
+};
+
+MultiDraw::~MultiDraw()
+{
+    // managers are deleted together with the last formula they manage
+    for (std::vector<TTreeFormula *>::iterator it = allFormulas_.begin(), ed = allFormulas_.end(); it != ed; ++it) {
+        delete *it;
+    }
+}
+
+TTreeFormula * MultiDraw::makeFormula(const char *expr)
+{
+    TTreeFormula *f = new TTreeFormula(Form("multiDraw_%d",int(allFormulas_.size())), expr, tree_);
+    allFormulas_.push_back(f);
+    if (f->GetNdim() == 0) {
+        std::cerr << "ERROR in MultiDraw: cannot compile expression '" << expr << "'" << std::endl;
+        return 0;
+    }
+    return f;
+}
+
+int MultiDraw::addWeight(const char *expr)
+{
+    std::map<std::string,int>::const_iterator match = weightIndex_.find(expr);
+    if (match != weightIndex_.end()) return match->second;
+    TTreeFormula *f = makeFormula(expr);
+    if (f == 0) return -1;
+    Weight w;
+    w.formula = f; w.multiple = (f->GetMultiplicity() != 0); w.done = false; w.value = 0;
+    weights_.push_back(w);
+    weightIndex_[expr] = weights_.size()-1;
+    return weights_.size()-1;
+}
+
+int MultiDraw::addCut(const char *expr)
+{
+    TTreeFormula *f = makeFormula(expr);
+    if (f == 0) return -1;
+    if (f->GetMultiplicity() != 0) {
+        std::cerr << "ERROR in MultiDraw: cut '" << expr << "' is not a scalar" << std::endl;
+        return -1;
+    }
+    cuts_.push_back(f);
+    return cuts_.size()-1;
+}
+
+int MultiDraw::add(TH1 *histo, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step)
+{
+    Plot p;
+    p.histo  = histo;
+    p.sparse = 0;
+    p.profile = histo->InheritsFrom("TProfile") || histo->InheritsFrom("TProfile2D");
+    return addPlot(p, xexpr, yexpr, zexpr, weight, step);
+}
+
+int MultiDraw::add(THnBase *histo, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step)
+{
+    Plot p;
+    p.histo  = 0;
+    p.sparse = histo;
+    p.profile = false;
+    return addPlot(p, xexpr, yexpr, zexpr, weight, step);
+}
+
+int MultiDraw::addPlot(Plot &p, const char *xexpr, const char *yexpr, const char *zexpr, const char *weight, int step)
+{
+    p.step  = step;
+    if (step > int(cuts_.size())) {
+        std::cerr << "ERROR in MultiDraw: cut-flow step " << step << " beyond the " << cuts_.size() << " cuts defined" << std::endl;
+        return -1;
+    }
+    p.iweight = addWeight(weight);
+    if (p.iweight == -1) return -1;
+    const char *exprs[3] = { xexpr, yexpr, zexpr };
+    p.nvars = 0;
+    TTreeFormulaManager *manager = new TTreeFormulaManager();
+    for (int i = 0; i < 3; ++i) {
+        p.vars[i] = 0;
+        if (exprs[i] == 0 || exprs[i][0] == '\0') continue;
+        p.vars[i] = makeFormula(exprs[i]);
+        if (p.vars[i] == 0) {
+            if (p.nvars == 0) delete manager;
+            return -1;
+        }
+        manager->Add(p.vars[i]);
+        p.nvars++;
+    }
+    if (p.sparse && p.nvars != p.sparse->GetNdimensions()) {
+        std::cerr << "ERROR in MultiDraw: " << p.nvars << " expressions for a histogram with " << p.sparse->GetNdimensions() << " dimensions" << std::endl;
+        if (p.nvars == 0) delete manager;
+        return -1;
+    }
+    p.weight = 0;
+    if (weights_[p.iweight].multiple) {
+        // TTree::Draw evaluates a selection with arrays instance by instance, in sync with the variables
+        p.weight = makeFormula(weight);
+        manager->Add(p.weight);
+    }
+    manager->Sync();
+    if (step > maxStep_) maxStep_ = step;
+    plots_.push_back(p);
+    return plots_.size()-1;
+}
+
+void MultiDraw::fill(Plot &p, double w, int i)
+{
+    double x = p.vars[0]->EvalInstance(i);
+    if (p.sparse) {
+        double xs[3] = { x, 0, 0 };
+        for (int j = 1; j < p.nvars; ++j) xs[j] = p.vars[j]->EvalInstance(i);
+        p.sparse->Fill(xs, w);
+        return;
+    }
+    switch (p.nvars) {
+        case 1:
+            p.histo->Fill(x, w);
+            break;
+        case 2:
+            if (p.profile) ((TProfile *)p.histo)->Fill(x, p.vars[1]->EvalInstance(i), w);
+            else           ((TH2 *)p.histo)->Fill(x, p.vars[1]->EvalInstance(i), w);
+            break;
+        case 3:
+            if (p.profile) ((TProfile2D *)p.histo)->Fill(x, p.vars[1]->EvalInstance(i), p.vars[2]->EvalInstance(i), w);
+            else           ((TH3 *)p.histo)->Fill(x, p.vars[1]->EvalInstance(i), p.vars[2]->EvalInstance(i), w);
+            break;
+    }
+}
+
+void MultiDraw::evalCuts()
+{
+    passed_ = 0; failed_ = 0; lastFailed_ = -1;
+    int ncuts = cuts_.size();
+    for (int i = 0; i < ncuts; ++i) {
+        if (!nMinusOne_ && i >= maxStep_) break; // nobody needs the following ones
+        cuts_[i]->GetNdata();
+        if (cuts_[i]->EvalInstance(0) != 0) {
+            if (failed_ == 0) passed_++;
+        } else {
+            failed_++; lastFailed_ = i;
+            if (!nMinusOne_ || failed_ > 1) break;
+        }
+    }
+}
+
+bool MultiDraw::passCuts(int step) const
+{
+    if (step < 0) return true;
+    if (!nMinusOne_) return passed_ >= step;
+    return failed_ == 0 || (failed_ == 1 && lastFailed_ == step);
+}
+
+double MultiDraw::weight(Weight &w)
+{
+    if (!w.done) {
+        w.formula->GetNdata();
+        w.value = w.formula->EvalInstance(0);
+        w.done  = true;
+    }
+    return w.value;
+}
+
+Long64_t MultiDraw::run(Long64_t maxEntries, Long64_t firstEntry)
+{
+    TEntryList *elist = tree_->GetEntryList();
+    Long64_t nentries = elist ? elist->GetN() : tree_->GetEntries(), nread = 0;
+    if (maxEntries >= 0 && firstEntry + maxEntries < nentries) nentries = firstEntry + maxEntries;
+    for (Long64_t i = firstEntry; i < nentries; ++i) {
+        Long64_t entry = elist ? tree_->GetEntryNumber(i) : i;
+        if (entry < 0 || tree_->LoadTree(entry) < 0) break;
+        if (tree_->GetTreeNumber() != treeNumber_) {
+            for (std::vector<TTreeFormula *>::iterator it = allFormulas_.begin(), ed = allFormulas_.end(); it != ed; ++it) {
+                (*it)->UpdateFormulaLeaves();
+            }
+            treeNumber_ = tree_->GetTreeNumber();
+        }
+        nread++;
+        if (maxStep_ >= 0) evalCuts();
+        // weights are evaluated only if needed, and at most once
+        for (std::vector<Weight>::iterator it = weights_.begin(), ed = weights_.end(); it != ed; ++it) {
+            it->done = false;
+        }
+        for (std::vector<Plot>::iterator it = plots_.begin(), ed = plots_.end(); it != ed; ++it) {
+            Plot &p = *it;
+            if (!passCuts(p.step)) continue;
+            double w0 = p.weight ? 1.0 : weight(weights_[p.iweight]);
+            if (w0 == 0) continue;
+            int ndata = p.vars[0]->GetManager()->GetNdata();
+            for (int i = 0; i < ndata; ++i) {
+                double w = p.weight ? p.weight->EvalInstance(i) : w0;
+                if (w == 0) continue;
+                fill(p, w, i);
+            }
+        }
+    }
+    return nread;
+}
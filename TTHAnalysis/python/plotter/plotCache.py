@@ -0,0 +1,106 @@
+import os, os.path, hashlib
+
+import ROOT
+
+class PlotCache:
+    """Content-addressed store of histograms and yields on local disk.
+
+       Each entry is a small ROOT file, named after the hash of everything that
+       determines its content; entries are touched when read, and the least
+       recently used ones are removed when the total size exceeds the limit."""
+    def __init__(self,path,maxSizeMB=2000):
+        self._path = path
+        self._maxSize = maxSizeMB*1024*1024
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+    def key(self,*items):
+        return hashlib.sha1(repr(items)).hexdigest()
+    def _file(self,key):
+        return "%s/%s/%s.root" % (self._path, key[:2], key)
+    def get(self,key):
+        fname = self._file(key)
+        obj = None
+        if os.path.exists(fname):
+            gdir = ROOT.gDirectory
+            tfile = ROOT.TFile.Open(fname)
+            if tfile and not tfile.IsZombie():
+                obj = tfile.Get("obj")
+                if obj and (obj.InheritsFrom("TH1") or obj.InheritsFrom("TEntryList")):
+                    obj.SetDirectory(None)
+                    ROOT.SetOwnership(obj, True)
+                tfile.Close()
+            gdir.cd()
+        if not obj:
+            self.misses += 1
+            return None
+        os.utime(fname, None) # mark as recently used
+        self.hits += 1
+        return obj
+    def getYield(self,key):
+        vec = self.get(key)
+        return [ vec[i] for i in xrange(vec.GetNoElements()) ] if vec else None
+    def put(self,key,obj):
+        fname = self._file(key)
+        if not os.path.isdir(os.path.dirname(fname)):
+            try:
+                os.makedirs(os.path.dirname(fname))
+            except OSError: # made in the meantime by some other job
+                pass
+        gdir = ROOT.gDirectory
+        ftemp = "%s.%d.tmp" % (fname, os.getpid())
+        tfile = ROOT.TFile.Open(ftemp, "RECREATE")
+        tfile.WriteTObject(obj, "obj")
+        tfile.Close()
+        gdir.cd()
+        os.rename(ftemp, fname) # so that concurrent jobs never see partial files
+        if self._size == None: self._size = self._diskUsage()
+        else: self._size += os.path.getsize(fname)
+        if self._size > self._maxSize: self._evict()
+    def putYield(self,key,values):
+        vec = ROOT.TVectorD(len(values))
+        for i,v in enumerate(values): vec[i] = v
+        self.put(key,vec)
+    def _entries(self):
+        ret = []
+        for sub in os.listdir(self._path):
+            if not os.path.isdir(self._path+"/"+sub): continue
+            for f in os.listdir(self._path+"/"+sub):
+                if not f.endswith(".root"): continue
+                try:
+                    st = os.stat("%s/%s/%s" % (self._path,sub,f))
+                    ret.append((st.st_mtime, st.st_size, "%s/%s/%s" % (self._path,sub,f)))
+                except OSError: # removed in the meantime by some other job
+                    pass
+        return ret
+    def _diskUsage(self):
+        return sum(size for (mtime,size,fname) in self._entries())
+    def _evict(self):
+        entries = self._entries()
+        entries.sort()
+        self._size = sum(size for (mtime,size,fname) in entries)
+        target = 0.9*self._maxSize # leave some room, not to do this at every put
+        for mtime,size,fname in entries:
+            if self._size <= target: break
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+            self._size -= size
+    def __str__(self):
+        return "plot cache %s: %d hits, %d misses (%.1f%% hit rate)" % (self._path, self.hits, self.misses, 100.0*self.hits/max(self.hits+self.misses,1))
+
+_caches = {}
+def getPlotCache(options):
+    """The cache for these options (one per process), or None if caching is not enabled"""
+    path = getattr(options,'cacheDir',None)
+    if not path: return None
+    if path not in _caches:
+        _caches[path] = PlotCache(path, getattr(options,'cacheSize',2000))
+    return _caches[path]
+
+def fileSignature(fname):
+    """What identifies the content of a file: path, size and modification time (if local)"""
+    if "://" in fname or not os.path.exists(fname): return (fname,)
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_size, int(st.st_mtime))
@@ -10,19 +10,39 @@ dsets = [d for d in dsets if d in os.listdir(sys.argv[1])]
 
 fname = [x for x in sys.argv[2].split('/') if x!=''][-1]
 
+def entryNumbers(elist):
+    return [elist.GetEntry(i) for i in xrange(elist.GetN())]
+
+def skim(tree,entries):
+    # a TEntryList is tied to the tree (and file) it was made on, so give each tree its own plain list
+    evlist = ROOT.TEventList("skim_"+tree.GetName(),"",len(entries))
+    for i in entries: evlist.Enter(i)
+    tree.SetEventList(evlist)
+    return tree.CopyTree('1')
+
 for dset in dsets:
     print dset,
     fsel = ROOT.TFile.Open(sys.argv[1]+'/'+dset+'/selection_eventlist.root')
     elist = fsel.elist
     f_f = ROOT.TFile.Open(sys.argv[2]+'/evVarFriend_'+dset+'.root')
     t_f = f_f.Get("sf/t")
-    t_f.SetEventList(elist)
+    entries = entryNumbers(elist)
+    if entries and max(entries) >= t_f.GetEntries():
+        print ': ERROR, the friend tree has %d entries, it was not made for the tree of the entry list (or was already skimmed)' % t_f.GetEntries()
+        f_f.Close()
+        fsel.Close()
+        continue
     os.system('mkdir -p %s/%s'%(sys.argv[3],fname))
     f2 = ROOT.TFile('%s/%s/evVarFriend_%s.root'%(sys.argv[3],fname,dset),'recreate')
     f2.cd()
     f2.mkdir('sf')
     f2.cd('sf')
-    t2 = t_f.CopyTree('1')
+    t2 = skim(t_f,entries)
+    # keep the event numbers of the selected entries, to check the alignment with the skimmed trees
+    t_ids = f_f.Get("eventIds")
+    if t_ids:
+        f2.cd()
+        t2ids = skim(t_ids,entries)
     f2.Write()
     print ': skimmed friend trees put in %s'%f2.GetName()
     f2.Close()
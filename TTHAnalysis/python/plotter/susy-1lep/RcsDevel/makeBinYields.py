@@ -80,6 +80,13 @@ def addOptions(options):
             options.bins = "200,0,200"
             #options.bins = "25,500,1500"
 
+def plotOptions(options):
+
+    # sparse histograms for the mass scans, where most of the bins are empty
+    if options.signal and options.sparse:
+        return {'Sparse':True}
+    return {}
+
 def makeLepYieldGrid(hist, options):
 
     for ybin in range(1,hist.GetNbinsY()+1):
@@ -132,16 +139,18 @@ def makeUpHist(hist, options):
         hist.GetXaxis().SetTitle("m_{#tildeg}")
         hist.GetYaxis().SetTitle("m_{LSP}")
 
-def writeYields(options):
+def writeYields(options, mca = None, report = None):
 
-    addOptions(options)
+    # mca and report are given if the yields of all bins are made at once (writeAllYields)
+    if mca == None:
+        addOptions(options)
 
-    if options.verbose > 1:
-        print options
+        if options.verbose > 1:
+            print options
 
-    # make MCA and cut vars
-    mca  = MCAnalysis(options.mcaFile,options)
-    cuts = CutsFile(options.cutFile,options)
+        # make MCA and cut vars
+        mca  = MCAnalysis(options.mcaFile,options)
+        cuts = CutsFile(options.cutFile,options)
 
     # make bin name and outdir names
     binname = options.bin
@@ -153,8 +162,8 @@ def writeYields(options):
     # get report
     if options.pretend:
         report = []
-    else:
-        report = mca.getPlotsRaw("x", options.var, options.bins, cuts.allCuts(), nodata=options.asimov)
+    elif report == None:
+        report = mca.getPlots(PlotSpec("x", options.var, options.bins, plotOptions(options)), cuts.allCuts(), nodata=options.asimov)
 
 #    print mca._backgrounds
 #    print mca.listBackgrounds()
@@ -233,7 +242,8 @@ def writeYields(options):
     if not options.pretend:
         #for n,h in report.iteritems():
         # sort by hist names
-        hlist = sorted(report.values(), key = lambda h: h.GetName())
+        # sparse histograms are written as dense ones, as expected when reading the yields
+        hlist = sorted([denseHisto(h) for h in report.values()], key = lambda h: h.GetName())
 
         for h in hlist:
             makeUpHist(h,options)
@@ -248,6 +258,48 @@ def writeYields(options):
 
     return 1
 
+def writeAllYields(options, binCuts):
+
+    # fill the yields of all bins with a single loop on each tree, then write them as writeYields does
+    # binCuts: list of (bin name, cuts to add, mca file)
+
+    mcaBins = {}
+    for (bin,cuts,mcaFile) in binCuts:
+        mcaBins.setdefault(mcaFile,[]).append((bin,cuts))
+
+    for mcaFile,bins in mcaBins.iteritems():
+        options.mcaFile = mcaFile
+        options.cutsToAdd = []
+        addOptions(options)
+        extraCuts = options.cutsToAdd[:]
+
+        if options.verbose > 1:
+            print options
+
+        mca  = MCAnalysis(options.mcaFile,options)
+        # the baseline, passed by the events of all bins
+        common = CutsFile(options.cutFile,options).allCuts()
+
+        binCutStrings = []
+        for (bin,cuts) in bins:
+            options.cutsToAdd = cuts + extraCuts
+            binCutStrings.append(CutsFile(options.cutFile,options).allCuts())
+
+        if options.pretend:
+            reports = [ [ None ] for bin in bins ]
+        else:
+            print "Filling %i bins at once with %s" % (len(bins), mcaFile)
+            reports = mca.getCategoryPlots([ PlotSpec("x", options.var, options.bins, plotOptions(options)) ], binCutStrings, common=common, nodata=options.asimov)
+
+        for (bin,cuts),report in zip(bins,reports):
+            options.bin = bin
+            options.cutsToAdd = cuts + extraCuts
+            writeYields(options, mca, report[0])
+
+        mca.close()
+
+    return 1
+
 # dict of Nb cut and corresp. Nb weights
 mcaName = {}
 mcaName["NB1"] = "mca-MC_syst_btag_1b_NB1.txt"
@@ -390,11 +442,13 @@ if __name__ == "__main__":
     parser.add_option("-c","--chunk", dest="chunk",type="int",default=None,help="Number of chunk")
     parser.add_option("-b","--batch", dest="batch",default=False, action="store_true", help="batch command for submission")
     parser.add_option("--jobList","--jobList", dest="jobListName",default="jobList.txt",help="job list name")
+    parser.add_option("--one-pass", dest="onePass",default=False, action="store_true", help="when running all bins locally, fill them all with a single loop on each tree")
 
     # more options
     parser.add_option("--asimov", dest="asimov", action="store_true", default=False, help="Make Asimov pseudo-data")
     parser.add_option("--mcPoisson", dest="mcPoissonErrors", action="store_true", default=False, help="Make MC errors poisson")
     parser.add_option("--signal", dest="signal", action="store_true", default=False, help="Is signal scan")
+    parser.add_option("--sparse", dest="sparse", action="store_true", default=False, help="Use sparse histograms for the signal scan (less memory)")
     parser.add_option("--grid", dest="grid", action="store_true", default=False, help="Plot 2d grid: ele/mu vs selected/anti")
 
     # make normal plots
@@ -461,6 +515,7 @@ if __name__ == "__main__":
     print "Beginning processing locally..."
     if options.chunk == None:
         # execute all bins locally
+        binCuts = []
         for idx,bin in enumerate(binList):
             cuts = cDict[bin]
             options.bin = bin
@@ -479,9 +534,16 @@ if __name__ == "__main__":
                 (cuts,options.mcaFile) = getBTagWstring(cuts,options)
                 print cuts,options.mcaFile
 
+            if options.onePass:
+                binCuts.append((bin,cuts,options.mcaFile))
+                continue
+
             options.cutsToAdd = cuts
 
             writeYields(options)
+
+        if options.onePass:
+            writeAllYields(options, binCuts)
         print
     elif options.chunk < len(binList):
         # to test a single job
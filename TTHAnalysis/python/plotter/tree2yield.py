@@ -17,15 +17,68 @@ from copy import *
 from CMGTools.TTHAnalysis.plotter.cutsFile import *
 from CMGTools.TTHAnalysis.plotter.mcCorrections import *
 from CMGTools.TTHAnalysis.plotter.fakeRate import *
+from CMGTools.TTHAnalysis.plotter.plotCache import getPlotCache, fileSignature
+from CMGTools.TTHAnalysis.plotter import columnar
+from CMGTools.TTHAnalysis.plotter.eventIndex import FriendAligner
+from CMGTools.TTHAnalysis.plotter import eventIndex
 
 if "/functions_cc.so" not in ROOT.gSystem.GetLibraries(): 
     ROOT.gROOT.ProcessLine(".L %s/src/CMGTools/TTHAnalysis/python/plotter/functions.cc+" % os.environ['CMSSW_BASE']);
 
+## macros with functions that the expressions can call: changing them changes the plots, so they go in the cache keys
+_exprMacros = [ "functions.cc", "fakeRate.cc", "mcCorrections.cc", "smearer.cc", "smearer.h", "bin2Dto1Dlib.cc" ]
+def _macroSignatures():
+    return [ fileSignature("%s/src/CMGTools/TTHAnalysis/python/plotter/%s" % (os.environ['CMSSW_BASE'], m)) for m in _exprMacros ]
+
+def _loadMultiDraw():
+    if "/multiDraw_cc.so" not in ROOT.gSystem.GetLibraries(): 
+        ROOT.gROOT.ProcessLine(".L %s/src/CMGTools/TTHAnalysis/python/plotter/multiDraw.cc+" % os.environ['CMSSW_BASE']);
+
+## counters of the work done in this process (summed also over the worker processes by MCAnalysis)
+_stats = {}
+def addStat(name,value):
+    _stats[name] = _stats.get(name,0) + value
+def getStats():
+    return _stats
+
+## branches used by each component with --prune-branches: (file, tree, entry range) -> [ fraction of the entries, total bytes, { branch : bytes } ]
+_branchUsage = {}
+def popBranchUsage():
+    global _branchUsage
+    ret, _branchUsage = _branchUsage, {}
+    return ret
+def addBranchUsage(usage):
+    for (key,(fraction,total,used)) in usage.iteritems():
+        _branchUsage.setdefault(key, [fraction,total,{}])[2].update(used)
+
+def printStats(options):
+    cache = getPlotCache(options)
+    if cache: print cache
+    if getattr(options,'pruneBranches',False) and _branchUsage:
+        needed = sum(fraction * sum(used.itervalues()) for (fraction,total,used) in _branchUsage.itervalues())
+        skipped = sum(fraction * total for (fraction,total,used) in _branchUsage.itervalues()) - needed
+        read = ROOT.TFile.GetFileBytesRead() + _stats.get('bytesReadByWorkers',0)
+        print "branch pruning: %.1f MB of branches used, %.1f MB not read (%.1f MB actually read from the files)" % (needed/1024.**2, skipped/1024.**2, read/1024.**2)
+
+def _branchKey(branch):
+    tdir = branch.GetTree().GetDirectory()
+    return "%s/%s" % (tdir.GetPath() if tdir else branch.GetTree().GetName(), branch.GetName())
+
+_identifier = re.compile(r"(?<!\w)[A-Za-z_]\w*")
+def identifiersInExpr(expr):
+    """All the words that might be branch names in a TTreeFormula expression"""
+    return set(_identifier.findall(expr))
+
+_s2vObject = re.compile(r"(LepGood|Lep|JetFwd|Jet|GenTop|SV)(\d)_(\w+)")
+_s2vMet    = re.compile(r"\bmet\b")
+_s2vCache  = {}
 def scalarToVector(x):
-    x0 = x
-    x = re.sub(r"(LepGood|Lep|JetFwd|Jet|GenTop|SV)(\d)_(\w+)", lambda m : "%s_%s[%d]" % (m.group(1),m.group(3),int(m.group(2))-1), x)
-    x = re.sub(r"\bmet\b", "met_pt", x)
-    return x
+    if x not in _s2vCache:
+        x0 = x
+        x = _s2vObject.sub(lambda m : "%s_%s[%d]" % (m.group(1),m.group(3),int(m.group(2))-1), x)
+        x = _s2vMet.sub("met_pt", x)
+        _s2vCache[x0] = x
+    return _s2vCache[x0]
 
 class PlotSpec:
     def __init__(self,name,expr,bins,opts):
@@ -45,6 +98,54 @@ class PlotSpec:
     def allLogs(self):
         return self.logs.iteritems()
 
+class Variation:
+    """A systematic variation of the plots, filled in the same loop on the tree as the nominal ones (see
+       TreeToYield.getVariationPlotsRaw): a factor multiplying the event weight, and replacements of whole
+       identifiers (e.g. nJet25 -> nJet25_jecUp) in the plotted expressions, the cuts and the weight, as written
+       by the user (i.e. before MC corrections and s2v). It applies to the processes matching the regexp, but never to data."""
+    def __init__(self,name,weight="1",replacements=[],processes=".*"):
+        self.name = name
+        self.weight = weight
+        self.replacements = replacements
+        self.processes = processes
+    def appliesTo(self,process):
+        return process != 'data' and re.match(self.processes+"$", process) != None
+    def adaptExpr(self,expr):
+        for (old,new) in self.replacements:
+            expr = re.sub(r"\b%s\b" % re.escape(old), lambda m : new, expr)
+        return expr
+    def unmatched(self,exprs):
+        """The replaced identifiers not found in any of these expressions"""
+        found = set()
+        for expr in exprs: found.update(identifiersInExpr(expr))
+        return [ old for (old,new) in self.replacements if old not in found ]
+
+_warnedReplacements = set()
+
+def readVariations(fname):
+    """Read the systematic variations from a text file, one per line:
+         name : process regexp : weight factor [: old=new, old2=new2, ...]"""
+    ret = []
+    for line in open(fname,'r'):
+        if re.match("\s*#.*", line): continue
+        line = re.sub("#.*","",line).strip()
+        if len(line) == 0: continue
+        field = [f.strip() for f in line.split(':')]
+        if len(field) < 3 or len(field) > 4:
+            raise RuntimeError, "Malformed line %s in file %s"%(line,fname)
+        replacements = []
+        if len(field) == 4 and field[3]:
+            for r in field[3].split(","):
+                if r.count("=") != 1: raise RuntimeError, "Malformed replacement %s in file %s"%(r,fname)
+                replacements.append(tuple(x.strip() for x in r.split("=")))
+        if field[0] in [ v.name for v in ret ]:
+            raise RuntimeError, "Duplicate variation %s in file %s"%(field[0],fname)
+        ret.append(Variation(field[0], field[2] if field[2] else "1", replacements, field[1]))
+    return ret
+
+_dataOnly = re.compile(r'\$DATA\{(.*?)\}')
+_mcOnly   = re.compile(r'\$MC\{(.*?)\}')
+
 class TreeToYield:
     def __init__(self,root,options,scaleFactor=1.0,name=None,cname=None,settings={},treename=None):
         self._name  = name  if name != None else root
@@ -60,6 +161,8 @@ class TreeToYield:
         self._fullYield = 0 # yield of the full sample, as if it passed the full skim and all cuts
         self._fullNevt = 0 # number of events of the full sample, as if it passed the full skim and all cuts
         self._settings = settings
+        self._entryRange = None # (first, number) of entries to read, if this is a chunk of the tree
+        self._adaptedExprs = {}
         loadMCCorrections(options)            ## make sure this is loaded
         self._mcCorrs = globalMCCorrections() ##  get defaults
         if 'SkipDefaultMCCorrections' in settings: ## unless requested to 
@@ -89,6 +192,7 @@ class TreeToYield:
             self._weightString += "* (" + self.adaptExpr(self._FR.weight(), cut=True) + ")"
             ## modify cuts to get to control region. order is important
             self._mcCorrs = self._mcCorrs + self._FR.cutMods()  + self._FR.mods()
+            self._adaptedExprs = {} # the corrections have changed
             self._weight = True
         #print "Done creation  %s for task %s in pid %d " % (self._fname, self._name, os.getpid())
     def setScaleFactor(self,scaleFactor):
@@ -117,15 +221,19 @@ class TreeToYield:
     def adaptDataMCExpr(self,expr):
         ret = expr
         if self._isdata:
-            ret = re.sub(r'\$MC\{.*?\}', '', re.sub(r'\$DATA\{(.*?)\}', r'\1', expr));
+            ret = _mcOnly.sub('', _dataOnly.sub(r'\1', expr));
         else:
-            ret = re.sub(r'\$DATA\{.*?\}', '', re.sub(r'\$MC\{(.*?)\}', r'\1', expr));
+            ret = _dataOnly.sub('', _mcOnly.sub(r'\1', expr));
         return ret
     def adaptExpr(self,expr,cut=False):
-        ret = self.adaptDataMCExpr(expr)
-        for mcc in self._mcCorrs:
-            ret = mcc(ret,self._name,self._cname,cut)
-        return ret
+        ## memoized: process, component and corrections of this object never change
+        key = (expr,cut)
+        if key not in self._adaptedExprs:
+            ret = self.adaptDataMCExpr(expr)
+            for mcc in self._mcCorrs:
+                ret = mcc(ret,self._name,self._cname,cut)
+            self._adaptedExprs[key] = ret
+        return self._adaptedExprs[key]
     def _init(self):
         if "root://" in self._fname:
             ROOT.gEnv.SetValue("TFile.AsyncReading", 1);
@@ -143,23 +251,184 @@ class TreeToYield:
         #self._tree.SetCacheSize(10*1000*1000)
         if "root://" in self._fname: self._tree.SetCacheSize()
         self._friends = []
+        aligner = None
+        if self._options.checkFriends:
+            if not eventIndex.available(): raise RuntimeError, "--check-friends needs numpy"
+            aligner = FriendAligner(self._tree, self._fname)
+        for tf_tree,tf_file in self._friendFiles():
+#            print 'Adding friend',tf_tree,tf_file
+            if aligner:
+                tf = aligner.addFriend(tf_tree, tf_file)
+            else:
+                tf = self._tree.AddFriend(tf_tree, tf_file),
+            self._friends.append(tf)
+        self._columnar = None
+        self._entryLists = {}
+        self._isInit = True
+    def _friendFiles(self):
         friendOpts = self._options.friendTrees[:]
         friendOpts += [ ('sf/t', d+"/evVarFriend_{cname}.root") for d in self._options.friendTreesSimple]
         friendOpts += (self._options.friendTreesData if self._isdata else self._options.friendTreesMC)
         friendOpts += [ ('sf/t', d+"/evVarFriend_{cname}.root") for d in (self._options.friendTreesDataSimple if self._isdata else self._options.friendTreesMCSimple) ]
         if 'Friends' in self._settings: friendOpts += self._settings['Friends']
         if 'FriendsSimple' in self._settings: friendOpts += [ ('sf/t', d+"/evVarFriend_{cname}.root") for d in self._settings['FriendsSimple'] ]
-        for tf_tree,tf_file in friendOpts:
-#            print 'Adding friend',tf_tree,tf_file
-            tf = self._tree.AddFriend(tf_tree, tf_file.format(name=self._name, cname=self._cname, P=getattr(self._options,'path',''))),
-            self._friends.append(tf)
-        self._isInit = True
+        return [ (tf_tree, tf_file.format(name=self._name, cname=self._cname, P=getattr(self._options,'path',''))) for (tf_tree,tf_file) in friendOpts ]
+    def _cacheKey(self,cache,*items):
+        """Key for the plot cache: the content of the tree and its friends, plus the items given.
+           The expressions passed should be the final ones (after MC corrections, weights and s2v)"""
+        if not hasattr(self,'_signature'):
+            self._signature = (fileSignature(self._fname), self._treename,
+                               [ (tf_tree, fileSignature(tf_file)) for (tf_tree,tf_file) in self._friendFiles() ],
+                               _macroSignatures(), [ fileSignature(f) for f in (self._FR.histoFiles() if hasattr(self,'_FR') else []) ])
+        return cache.key(self._signature, self._options.maxEntries, self._entryRange, self._options.allowNegative, *items)
+    def _drawRange(self):
+        """(nentries, firstentry) to be passed to TTree::Draw"""
+        if self._isInit and self._tree.GetEntryList(): return (1000000000, 0) # the list is already restricted to the range
+        if self._entryRange: return (self._entryRange[1], self._entryRange[0])
+        return (self._options.maxEntries, 0)
+    def _loopSize(self):
+        """Number of entries read by a loop on the tree (with the current range and entry list)"""
+        nentries, first = self._drawRange()
+        total = self._tree.GetEntryList().GetN() if self._tree.GetEntryList() else self._tree.GetEntries()
+        return max(min(nentries, total - first), 0)
+    def _draw(self,varexp,selection,option):
+        """TTree::Draw on the entries to read, counting them"""
+        ret = self._tree.Draw(varexp, selection, option, *self._drawRange())
+        addStat('entries', self._loopSize())
+        return ret
+    def entryRange(self):
+        """(first, number) of the entries read by this chunk, or None if it reads the whole tree"""
+        return self._entryRange
+    def getEntries(self):
+        """Number of entries of the tree, opening it only temporarily if not done yet"""
+        if not hasattr(self,'_nEntries'):
+            if self._isInit: 
+                self._nEntries = self._tree.GetEntries()
+            else:
+                tfile = ROOT.TFile.Open(self._fname)
+                if not tfile: raise RuntimeError, "Cannot open %s\n" % self._fname
+                t = tfile.Get(self._treename)
+                if not t: raise RuntimeError, "Cannot find tree %s in file %s\n" % (self._treename, self._fname)
+                self._nEntries = t.GetEntries()
+                tfile.Close()
+        return self._nEntries
+    def getEntriesToRead(self):
+        if self._entryRange: return self._entryRange[1]
+        return min(self.getEntries(), self._options.maxEntries)
+    def split(self,chunkSize):
+        """Split in copies of this component, each reading a range of about chunkSize entries.
+           The results of the chunks are partial: negative bins are not truncated, overflows are not
+           folded, and they must be merged with mergeChunkReports or mergeChunkPlots."""
+        if self.getOption("KeysPdf",False): return [ self ] # needs the full histogram
+        nentries = self.getEntriesToRead()
+        nchunks = int(ceil(nentries/float(max(chunkSize,1))))
+        if nchunks <= 1: return [ self ]
+        ret = []
+        for i in xrange(nchunks):
+            first, last = (i*nentries)/nchunks, ((i+1)*nentries)/nchunks
+            chunk = copy(self)
+            for attr in '_tfile', '_tree', '_friends', '_columnar', '_entryLists': 
+                if attr in chunk.__dict__: del chunk.__dict__[attr]
+            chunk._isInit = False
+            chunk._entryRange = (first, last-first)
+            chunk._chunkOf = self
+            ret.append(chunk)
+        return ret
+    def chunkOf(self):
+        """The component this is a chunk of (or itself, if it's not a chunk)"""
+        return getattr(self,'_chunkOf',self)
+    def getState(self):
+        """What can change after creation, to keep in sync copies of this object living in other processes"""
+        return (self._scaleFactor, self._settings, self._options, self._entryRange)
+    def setState(self,state):
+        (self._scaleFactor, self._settings, self._options, self._entryRange) = state
+    def mergeChunkReports(self,reports,noEntryLine=False):
+        ret = mergeReports(reports)
+        if self._weight and not self._options.allowNegative:
+            for (cn,y) in ret:
+                if y[0] < 0: y[0] = 0; y[1] = 0
+        if self._options.fullSampleYields and not noEntryLine:
+            ret.insert(0, ('full sample', [self._fullYield,0,self._fullNevt]) )
+        return ret
+    def mergeChunkPlots(self,plots,plotspec):
+        ret = mergePlots(plots[0].GetName(),plots)
+        self.negativeCheck(ret)
+        return self._finishPlot(ret,plotspec)
 
+    def _columnarTree(self):
+        """The branches of the tree read as numpy arrays (see columnar.py), if enabled and possible; None otherwise"""
+        if not self._options.columnar or not columnar.available(): return None
+        if not self._isInit: self._init()
+        if self._columnar == None or self._columnar.entryRange() != self._drawRange():
+            self._columnar = columnar.ColumnarTree(self._tree, *self._drawRange())
+            addStat('entries', self._loopSize())
+        return self._columnar
+    def _pruneBranches(self,exprs):
+        """Enable only the branches used by these (final) expressions, in the tree and its friends,
+           and restrict the TTreeCache to them"""
+        if not self._options.pruneBranches: return
+        if not self._isInit: self._init()
+        trees = [ self._tree ] + [ fe.GetTree() for fe in (self._tree.GetListOfFriends() or []) ]
+        if any(t.GetListOfAliases() and t.GetListOfAliases().GetSize() for t in trees): return # can't see through them
+        used = self._usedBranches(exprs)
+        self._tree.SetBranchStatus("*",0)
+        for branch in used: 
+            self._tree.SetBranchStatus(branch.GetName(),1)
+        if self._tree.GetCacheSize() > 0:
+            self._tree.DropBranchFromCache("*",True)
+            for branch in used: self._tree.AddBranchToCache(branch,True)
+            self._tree.StopCacheLearningPhase()
+        key = (self._fname, self._treename, self._entryRange)
+        if key not in _branchUsage:
+            fraction = self.getEntriesToRead()/float(max(self.getEntries(),1))
+            _branchUsage[key] = [ fraction, sum(t.GetZipBytes() for t in trees), {} ]
+        _branchUsage[key][2].update((_branchKey(branch), branch.GetZipBytes("*")) for branch in used)
+    def _usedBranches(self,exprs):
+        """Branches of the tree and its friends read by these expressions, with the counters of the arrays"""
+        used = set()
+        for expr in exprs:
+            for name in identifiersInExpr(expr):
+                leaf = self._tree.GetLeaf(name)
+                if not leaf: continue
+                used.add(leaf.GetBranch())
+                if leaf.GetLeafCount(): used.add(leaf.GetLeafCount().GetBranch())
+        return used
+    def _selectEntries(self,selection):
+        """Restrict the following loops on the tree to the entries passing the selection (already adapted, without
+           weights), found with a loop on the tree only the first time. None goes back to reading all entries."""
+        if selection == None or not self._options.entryLists or self._options.columnar:
+            if self._isInit and self._tree.GetEntryList(): self._tree.SetEntryList(None)
+            return
+        if not self._isInit: self._init()
+        self._tree.SetEntryList(None)
+        key = (selection, self._entryRange)
+        if key not in self._entryLists:
+            name = "elist_%d_%d" % (id(self), len(self._entryLists))
+            cache = getPlotCache(self._options)
+            stored = cache.get(self._cacheKey(cache, "entrylist", selection)) if cache else None
+            if stored:
+                # make a new one, as the stored one refers to the tree with the path it had when saved
+                elist = ROOT.TEntryList(name, selection, self._tree)
+                for i in xrange(stored.GetN()): elist.Enter(stored.GetEntry(i))
+            else:
+                if self._options.pruneBranches: # make sure what's needed is enabled
+                    for branch in self._usedBranches([selection]): self._tree.SetBranchStatus(branch.GetName(),1)
+                self._draw(">>"+name, selection, "entrylist")
+                elist = ROOT.gDirectory.Get(name)
+                elist.SetDirectory(None)
+                if cache: cache.put(self._cacheKey(cache, "entrylist", selection), elist)
+            self._entryLists[key] = elist
+        self._tree.SetEntryList(self._entryLists[key])
     def getTree(self):
         if not self._isInit: self._init()
         return self._tree
     def getYields(self,cuts,noEntryLine=False):
-        if not self._isInit: self._init()
+        if self._options.singlePass:
+            report = self._getCutFlowYields(cuts,noEntryLine)
+            if report != None:
+                if self._options.fullSampleYields and not noEntryLine and not self._entryRange:
+                    report.insert(0, ('full sample', [self._fullYield,0,self._fullNevt]) )
+                return report
         report = []; cut = ""
         cutseq = [ ['entry point','1'] ]
         if noEntryLine: cutseq = []
@@ -179,10 +448,67 @@ class TreeToYield:
                 cut += "(%s)" % cv
             else:
                 cut = cv
-            report.append((cn,self._getYield(self._tree,cut)))
-        if self._options.fullSampleYields and not noEntryLine:
+            report.append((cn,self._getYield(cut)))
+        if self._options.fullSampleYields and not noEntryLine and not self._entryRange:
             report.insert(0, ('full sample', [self._fullYield,0,self._fullNevt]) )
         return report
+    def _getCutFlowYields(self,cuts,noEntryLine):
+        """Compute the same yields as getYields in a single loop on the tree, evaluating each cut
+           at most once per event. Returns None if it's not possible (e.g. cuts on arrays)."""
+        if self._options.columnar: return None # each cut is already cheap on the columns
+        allcuts = cuts.cuts()
+        if self._options.nMinusOne:
+            if len(set(cn for cn,cv in allcuts)) != len(allcuts): return None
+            lines = [ ("all but "+cn, i) for i,(cn,cv) in enumerate(allcuts) if i > 0 ] + [ ('all', len(allcuts)) ]
+        elif self._options.final:
+            lines = [ ('all', len(allcuts)) ]
+        else:
+            if not noEntryLine: allcuts = [ ('entry point','1') ] + allcuts
+            lines = [ (cn, i+1) for i,(cn,cv) in enumerate(allcuts) ]
+        adapted = []
+        for cn,cv in allcuts:
+            cv = self.adaptExpr(cv,cut=True)
+            if self._options.doS2V: cv = scalarToVector(cv)
+            adapted.append(cv)
+        weight = self._eventWeight()
+        cache = getPlotCache(self._options)
+        if cache:
+            key = self._cacheKey(cache, "cutflow", self._weight, bool(self._options.nMinusOne), adapted, weight, lines)
+            cached = cache.getYield(key)
+            if cached != None:
+                return [ (cn,cached[3*i:3*i+3]) for i,(cn,step) in enumerate(lines) ]
+        if not self._isInit: self._init()
+        _loadMultiDraw()
+        engine = ROOT.MultiDraw(self._tree)
+        engine.setNMinusOne(bool(self._options.nMinusOne))
+        for cv in adapted:
+            if engine.addCut(cv) == -1: return None
+        self._pruneBranches(adapted + [ weight ])
+        histos = []
+        for i,(cn,step) in enumerate(lines):
+            histo = ROOT.TH1D("dummy_yield_%d" % i,"dummy",1,0.0,1.0); histo.Sumw2()
+            if engine.add(histo, "0.5", "", "", weight, step) == -1:
+                raise RuntimeError, "Can't use weight %s for %s" % (weight, self._cname)
+            histos.append(histo)
+        addStat('entries', engine.run(*self._drawRange()))
+        report = []
+        for (cn,step),histo in zip(lines,histos):
+            nev = int(histo.GetEntries())
+            if self._weight:
+                self.negativeCheck(histo)
+                report.append((cn,[ histo.GetBinContent(1), histo.GetBinError(1), nev ]))
+            else:
+                report.append((cn,[ nev, sqrt(nev), nev ]))
+        if cache: cache.putYield(key, sum([ y for (cn,y) in report ], []))
+        return report
+    def _eventWeight(self):
+        """The per-event weight, without any cut"""
+        if not self._weight: return "1"
+        if self._isdata: weight = "(%s)     *(%s)" % (self._weightString,                    self._scaleFactor)
+        else:            weight = "(%s)*(%s)*(%s)" % (self._weightString,self._options.lumi, self._scaleFactor)
+        if self._options.doS2V:
+            weight = scalarToVector(weight)
+        return weight
     def prettyPrint(self,report):
         # maximum length of the cut descriptions
         clen = max([len(cut) for cut,yields in report]) + 3
@@ -215,25 +541,44 @@ class TreeToYield:
             if self._weight and nev < 1000: print nfmtS % toPrint,
             else                          : print nfmtL % toPrint,
             print ""
-    def _getYield(self,tree,cut):
+    def _getYield(self,cut):
         if self._weight:
             if self._isdata: cut = "(%s)     *(%s)*(%s)" % (self._weightString,                    self._scaleFactor, self.adaptExpr(cut,cut=True))
             else:            cut = "(%s)*(%s)*(%s)*(%s)" % (self._weightString,self._options.lumi, self._scaleFactor, self.adaptExpr(cut,cut=True))
             if self._options.doS2V:
                 cut  = scalarToVector(cut)
+        else: 
+            cut = self.adaptExpr(cut,cut=True)
+            if self._options.doS2V:
+                cut  = scalarToVector(cut)
+            cut = self.adaptExpr(cut,cut=True)
+        cache = getPlotCache(self._options)
+        if cache:
+            key = self._cacheKey(cache, "yield", self._weight, cut)
+            ret = cache.getYield(key)
+            if ret != None: return ret
+        if not self._isInit: self._init()
+        if self._weight:
 #            print cut
             ROOT.gROOT.cd()
             if ROOT.gROOT.FindObject("dummy") != None: ROOT.gROOT.FindObject("dummy").Delete()
             histo = ROOT.TH1D("dummy","dummy",1,0.0,1.0); histo.Sumw2()
-            nev = tree.Draw("0.5>>dummy", cut, "goff", self._options.maxEntries)
+            self._pruneBranches([ cut ])
+            columns = self._columnarTree()
+            if columns and columns.fill(histo, "0.5", cut):
+                nev = int(histo.GetEntries())
+            else:
+                nev = self._draw("0.5>>dummy", cut, "goff")
             self.negativeCheck(histo)
-            return [ histo.GetBinContent(1), histo.GetBinError(1), nev ]
+            ret = [ histo.GetBinContent(1), histo.GetBinError(1), nev ]
         else: 
-            cut = self.adaptExpr(cut,cut=True)
-            if self._options.doS2V:
-                cut  = scalarToVector(cut)
-            npass = tree.Draw("1",self.adaptExpr(cut,cut=True),"goff", self._options.maxEntries);
-            return [ npass, sqrt(npass), npass ]
+            self._pruneBranches([ cut ])
+            columns = self._columnarTree()
+            npass = columns.count(cut) if columns else None
+            if npass == None: npass = self._draw("1",cut,"goff");
+            ret = [ npass, sqrt(npass), npass ]
+        if cache: cache.putYield(key, ret)
+        return ret
     def _stylePlot(self,plot,spec):
         ## Sample specific-options, from self
         if self.hasOption('FillColor'):
@@ -254,6 +599,26 @@ class TreeToYield:
             plot.GetXaxis().SetNdivisions(spec.getOption('XNDiv',510))
     def getPlot(self,plotspec,cut):
         ret = self.getPlotRaw(plotspec.name, plotspec.expr, plotspec.bins, cut, plotspec)
+        if self._entryRange: return ret # finished by mergeChunkPlots
+        return self._finishPlot(ret,plotspec)
+    def getManyPlots(self,plotspecs,cut):
+        rets = self.getManyPlotsRaw(cut, plotspecs)
+        if self._entryRange: return rets # finished by mergeChunkPlots
+        return [ self._finishPlot(ret,plotspec) for (ret,plotspec) in zip(rets,plotspecs) ]
+    def getCategoryPlots(self,cuts,plotspecs,common=None):
+        rets = self.getCategoryPlotsRaw(cuts,plotspecs,common)
+        if self._entryRange: return rets # finished by mergeChunkPlots
+        return [ [ self._finishPlot(ret,plotspec) for (ret,plotspec) in zip(catRets,plotspecs) ] for catRets in rets ]
+    def getCutFlowPlots(self,cuts,steps,plotspecs):
+        rets = self.getCutFlowPlotsRaw(cuts,steps,plotspecs)
+        if self._entryRange: return rets # finished by mergeChunkPlots
+        return [ [ self._finishPlot(ret,plotspec) for (ret,plotspec) in zip(stepRets,plotspecs) ] for stepRets in rets ]
+    def getVariationPlots(self,cut,plotspecs,variations):
+        rets = self.getVariationPlotsRaw(cut,plotspecs,variations)
+        if self._entryRange: return rets # finished by mergeChunkPlots
+        return [ [ self._finishPlot(ret,plotspec) for (ret,plotspec) in zip(varRets,plotspecs) ] for varRets in rets ]
+    def _finishPlot(self,ret,plotspec):
+        if ret.InheritsFrom("THnBase"): return ret # sparse, no overflows to fold nor style
         # fold overflow
         if ret.ClassName() in [ "TH1F", "TH1D" ] :
             n = ret.GetNbinsX()
@@ -276,39 +641,31 @@ class TreeToYield:
                     ret.SetBinError(   b, ret.GetBinError(b) / ret.GetXaxis().GetBinWidth(b) )
         self._stylePlot(ret,plotspec)
         return ret
-    def getPlotRaw(self,name,expr,bins,cut,plotspec):
+    def _bookHisto(self,hname,expr,bins,plotspec):
+        """Book the histogram for a plot, as needed by the (already adapted) expression and the binning.
+           Returns (histo, canKeys, unbinnedData2D)"""
         unbinnedData2D = plotspec.getOption('UnbinnedData2D',False) if plotspec != None else False
         profile1D      = plotspec.getOption('Profile1D',False) if plotspec != None else False
         profile2D      = plotspec.getOption('Profile2D',False) if plotspec != None else False
-        if not self._isInit: self._init()
-        if self._weight:
-            if self._isdata: cut = "(%s)     *(%s)*(%s)" % (self._weightString,                    self._scaleFactor, self.adaptExpr(cut,cut=True))
-            else:            cut = "(%s)*(%s)*(%s)*(%s)" % (self._weightString,self._options.lumi, self._scaleFactor, self.adaptExpr(cut,cut=True))
-        else:
-            cut = self.adaptExpr(cut,cut=True)
-        expr = self.adaptExpr(expr)
-        if self._options.doS2V:
-            cut  = scalarToVector(cut)
-            expr = scalarToVector(expr)
-#        print cut
-#        print expr
-        if ROOT.gROOT.FindObject("dummy") != None: ROOT.gROOT.FindObject("dummy").Delete()
+        sparse         = plotspec.getOption('Sparse',False) if plotspec != None else False
         histo = None
         canKeys = False
         nvars = expr.replace("::","--").count(":")+1
+        if sparse and nvars in (2,3) and not (profile1D or profile2D):
+            return (self._bookSparse(hname,expr,bins,nvars),False,False)
         if nvars == 1 or (nvars == 2 and profile1D):
             if bins[0] == "[":
                 edges = [ float(f) for f in bins[1:-1].split(",") ]
                 if profile1D: 
-                    histo = ROOT.TProfile("dummy","dummy",len(edges)-1,array('f',edges))
+                    histo = ROOT.TProfile(hname,hname,len(edges)-1,array('f',edges))
                 else:
-                    histo = ROOT.TH1D("dummy","dummy",len(edges)-1,array('f',edges))
+                    histo = ROOT.TH1D(hname,hname,len(edges)-1,array('f',edges))
             else:
                 (nb,xmin,xmax) = bins.split(",")
                 if profile1D:
-                    histo = ROOT.TProfile("dummy","dummy",int(nb),float(xmin),float(xmax))
+                    histo = ROOT.TProfile(hname,hname,int(nb),float(xmin),float(xmax))
                 else:
-                    histo = ROOT.TH1D("dummy","dummy",int(nb),float(xmin),float(xmax))
+                    histo = ROOT.TH1D(hname,hname,int(nb),float(xmin),float(xmax))
                     canKeys = True
             unbinnedData2D = False
         elif nvars == 2 or (nvars == 3 and profile2D):
@@ -317,16 +674,16 @@ class TreeToYield:
                 xedges = [ float(f) for f in xbins[1:-1].split(",") ]
                 yedges = [ float(f) for f in ybins[1:-1].split(",") ]
                 if profile2D:
-                    histo = ROOT.TProfile2D("dummy","dummy",len(xedges)-1,array('d',xedges),len(yedges)-1,array('d',yedges))
+                    histo = ROOT.TProfile2D(hname,hname,len(xedges)-1,array('d',xedges),len(yedges)-1,array('d',yedges))
                 else:
-                    histo = ROOT.TH2F("dummy","dummy",len(xedges)-1,array('f',xedges),len(yedges)-1,array('f',yedges))
+                    histo = ROOT.TH2F(hname,hname,len(xedges)-1,array('f',xedges),len(yedges)-1,array('f',yedges))
             else:
                 (nbx,xmin,xmax,nby,ymin,ymax) = bins.split(",")
                 if profile2D:
-                    histo = ROOT.TProfile2D("dummy","dummy",int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax))
+                    histo = ROOT.TProfile2D(hname,hname,int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax))
                     unbinnedData2D = False 
                 else:
-                    histo = ROOT.TH2F("dummy","dummy",int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax))
+                    histo = ROOT.TH2F(hname,hname,int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax))
                     unbinnedData2D = (self._name == "data") and unbinnedData2D
         elif nvars == 3:
             ez,ey,ex = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
@@ -335,30 +692,115 @@ class TreeToYield:
                 xedges = [ float(f) for f in xbins[1:-1].split(",") ]
                 yedges = [ float(f) for f in ybins[1:-1].split(",") ]
                 zedges = [ float(f) for f in zbins[1:-1].split(",") ]
-                histo = ROOT.TH3F("dummy","dummy",len(xedges)-1,array('f',xedges),len(yedges)-1,array('f',yedges),len(zedges)-1,array('f',zedges))
+                histo = ROOT.TH3F(hname,hname,len(xedges)-1,array('f',xedges),len(yedges)-1,array('f',yedges),len(zedges)-1,array('f',zedges))
             else:
                 (nbx,xmin,xmax,nby,ymin,ymax,nbz,zmin,zmax) = bins.split(",")
-                histo = ROOT.TH3F("dummy","dummy",int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax),int(nbz),float(zmin),float(zmax))
+                histo = ROOT.TH3F(hname,hname,int(nbx),float(xmin),float(xmax),int(nby),float(ymin),float(ymax),int(nbz),float(zmin),float(zmax))
             histo.GetXaxis().SetTitle(ex)
             histo.GetYaxis().SetTitle(ey)
             histo.GetZaxis().SetTitle(ez)
         else:
             raise RuntimeError, "Can't make a plot with %d dimensions" % nvars
         histo.Sumw2()
+        return (histo,canKeys,unbinnedData2D)
+    def _bookSparse(self,hname,expr,bins,nvars):
+        """Book a THnSparse for a 2D or 3D plot with mostly empty bins (e.g. a signal scan): only the filled bins take memory"""
+        if bins[0] == "[":
+            edges = [ [ float(f) for f in b[1:-1].split(",") ] for b in bins.split("*") ]
+            axes  = [ (len(e)-1, e[0], e[-1]) for e in edges ]
+        else:
+            b = bins.split(",")
+            edges = None
+            axes  = [ (int(b[i]), float(b[i+1]), float(b[i+2])) for i in xrange(0,len(b),3) ]
+        if len(axes) != nvars: raise RuntimeError, "Binning %s doesn't match the %d variables of %s" % (bins, nvars, expr)
+        histo = ROOT.THnSparseD(hname,hname,nvars,array('i',[a[0] for a in axes]),array('d',[a[1] for a in axes]),array('d',[a[2] for a in axes]))
+        if edges:
+            for i,e in enumerate(edges): histo.GetAxis(i).Set(len(e)-1,array('d',e))
+        vars = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+        vars.reverse() # TTree::Draw syntax is z:y:x
+        for i,v in enumerate(vars): histo.GetAxis(i).SetTitle(v)
+        histo.Sumw2()
+        return histo
+    def _weightedCut(self,cut,variation=None):
+        vary = variation.adaptExpr if variation != None else (lambda expr : expr)
+        cut = vary(cut)
+        if self._weight:
+            weightString, scaleFactor = vary(self._weightString), vary(str(self._scaleFactor))
+            if self._isdata: cut = "(%s)     *(%s)*(%s)" % (weightString,                    scaleFactor, self.adaptExpr(cut,cut=True))
+            else:            cut = "(%s)*(%s)*(%s)*(%s)" % (weightString,self._options.lumi, scaleFactor, self.adaptExpr(cut,cut=True))
+        else:
+            cut = self.adaptExpr(cut,cut=True)
+        if self._options.doS2V:
+            cut  = scalarToVector(cut)
+        return cut
+    def _adaptedCut(self,cut):
+        cut = self.adaptExpr(cut,cut=True)
+        if self._options.doS2V:
+            cut  = scalarToVector(cut)
+        return cut
+    def _adaptPlotExpr(self,expr):
+        expr = self.adaptExpr(expr)
+        if self._options.doS2V:
+            expr = scalarToVector(expr)
+        return expr
+    def _plotCacheKey(self,cache,expr,bins,cut,plotspec):
+        opts = [ (o, plotspec.getOption(o,False)) for o in ('Profile1D','Profile2D','UnbinnedData2D','Sparse') ] if plotspec != None else []
+        keys = (self.getOption("KeysPdf",False), self.getOption('KeysPdfMinN',100)) if not self._isdata else None
+        return self._cacheKey(cache, "plot", expr, bins, cut, opts, keys)
+    def getPlotRaw(self,name,expr,bins,cut,plotspec):
+        selection = self._adaptedCut(cut)
+        cut  = self._weightedCut(cut)
+        expr = self._adaptPlotExpr(expr)
+#        print cut
+#        print expr
+        cache = getPlotCache(self._options)
+        if cache:
+            key = self._plotCacheKey(cache,expr,bins,cut,plotspec)
+            ret = cache.get(key)
+            if ret != None:
+                ret.SetName(name)
+                return ret
+        self._selectEntries(selection)
+        try:
+            ret = self._drawPlot(name,expr,bins,cut,plotspec)
+        finally:
+            self._selectEntries(None)
+        if cache and (ret.InheritsFrom("TH1") or ret.InheritsFrom("THnBase")): cache.put(key, ret)
+        return ret
+    def _drawPlot(self,name,expr,bins,cut,plotspec):
+        if not self._isInit: self._init()
+        if ROOT.gROOT.FindObject("dummy") != None: ROOT.gROOT.FindObject("dummy").Delete()
+        (histo,canKeys,unbinnedData2D) = self._bookHisto("dummy",expr,bins,plotspec)
+        self._pruneBranches([ expr, cut ])
         if unbinnedData2D:
-            self._tree.Draw("%s" % expr, cut, "", self._options.maxEntries)
+            self._draw("%s" % expr, cut, "")
             graph = ROOT.gROOT.FindObject("Graph").Clone(name)
             return graph
+        if histo.InheritsFrom("THnBase"):
+            # TTree::Draw can't fill sparse histograms
+            _loadMultiDraw()
+            engine = ROOT.MultiDraw(self._tree)
+            vars = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+            vars.reverse() # TTree::Draw syntax is z:y:x
+            vars += [ "" ] * (3-len(vars))
+            if engine.add(histo, vars[0], vars[1], vars[2], cut) == -1:
+                raise RuntimeError, "Can't fill plot %s (%s) for %s" % (name, expr, self._cname)
+            addStat('entries', engine.run(*self._drawRange()))
+            self.negativeCheck(histo)
+            histo.SetName(name)
+            return histo
         drawOpt = "goff"
-        if profile1D or profile2D: drawOpt += " PROF";
-        self._tree.Draw("%s>>%s" % (expr,"dummy"), cut, drawOpt, self._options.maxEntries)
-        if canKeys and histo.GetEntries() > 0 and histo.GetEntries() < self.getOption('KeysPdfMinN',100) and not self._isdata and self.getOption("KeysPdf",False):
+        if "TProfile" in histo.ClassName(): drawOpt += " PROF";
+        columns = self._columnarTree()
+        if not (columns and columns.fill(histo, expr, cut)):
+            self._draw("%s>>%s" % (expr,"dummy"), cut, drawOpt)
+        if canKeys and self._wantsKeysPdf(histo):
             #print "Histogram for %s/%s has %d entries, so will use KeysPdf " % (self._cname, self._name, histo.GetEntries())
             if "/TH1Keys_cc.so" not in ROOT.gSystem.GetLibraries(): 
                 ROOT.gROOT.ProcessLine(".L %s/src/CMGTools/TTHAnalysis/python/plotter/TH1Keys.cc+" % os.environ['CMSSW_BASE']);
             (nb,xmin,xmax) = bins.split(",")
             histo = ROOT.TH1KeysNew("dummyk","dummyk",int(nb),float(xmin),float(xmax))
-            self._tree.Draw("%s>>%s" % (expr,"dummyk"), cut, "goff", self._options.maxEntries)
+            self._draw("%s>>%s" % (expr,"dummyk"), cut, "goff")
             self.negativeCheck(histo)
             return histo.GetHisto().Clone(name)
         #elif not self._isdata and self.getOption("KeysPdf",False):
@@ -366,7 +808,202 @@ class TreeToYield:
         #    print "Histogram for %s/%s has %d entries, so won't use KeysPdf (%s, %s) " % (self._cname, self._name, histo.GetEntries(), canKeys, self.getOption("KeysPdf",False))
         self.negativeCheck(histo)
         return histo.Clone(name)
+    def _wantsKeysPdf(self,histo):
+        return histo.GetEntries() > 0 and histo.GetEntries() < self.getOption('KeysPdfMinN',100) and not self._isdata and self.getOption("KeysPdf",False)
+    def getManyPlotsRaw(self,cut,plotspecs):
+        """Fill the histograms of all the plotspecs, with the same cut, in a single loop on the tree."""
+        return self.getCategoryPlotsRaw([ cut ],plotspecs,common=cut)[0]
+    def getCategoryPlotsRaw(self,cuts,plotspecs,common=None):
+        """Fill the histograms of all the plotspecs for each of the cuts (e.g. the categories of an analysis)
+           in a single loop on the tree. If given, common is a selection implied by all the cuts, used to skip
+           the other events. Plots that can't be done this way (unbinned 2D data, KeysPdf) fall back to
+           getPlotRaw. Returns the list of plots for each cut."""
+        wcuts = [ self._weightedCut(cut) for cut in cuts ]
+        exprs = [ self._adaptPlotExpr(pspec.expr) for pspec in plotspecs ]
+        rets = [ [ None for pspec in plotspecs ] for cut in cuts ]
+        cache = getPlotCache(self._options)
+        keys = {}
+        if cache:
+            for j,wcut in enumerate(wcuts):
+                for i,pspec in enumerate(plotspecs):
+                    keys[(j,i)] = self._plotCacheKey(cache,exprs[i],pspec.bins,wcut,pspec)
+                    rets[j][i] = cache.get(keys[(j,i)])
+                    if rets[j][i] != None: rets[j][i].SetName(pspec.name)
+        todo = [ (j,i) for j in xrange(len(cuts)) for i in xrange(len(plotspecs)) if rets[j][i] == None ]
+        if not todo: return rets
+        if not self._isInit: self._init()
+        _loadMultiDraw()
+        engine = ROOT.MultiDraw(self._tree)
+        self._pruneBranches(list(set(exprs[i] for (j,i) in todo)) + list(set(wcuts[j] for (j,i) in todo)))
+        columns = self._columnarTree()
+        filled = {}
+        canKeys = {}
+        for (j,i) in todo:
+            pspec, expr = plotspecs[i], exprs[i]
+            (histo,canKeys[(j,i)],unbinnedData2D) = self._bookHisto("dummy_multi_%d_%d" % (j,i),expr,pspec.bins,pspec)
+            if unbinnedData2D: continue
+            if columns and columns.fill(histo, expr, wcuts[j]):
+                filled[(j,i)] = histo
+                continue
+            vars = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+            vars.reverse() # TTree::Draw syntax is z:y:x
+            vars += [ "" ] * (3-len(vars))
+            if engine.add(histo, vars[0], vars[1], vars[2], wcuts[j]) == -1:
+                raise RuntimeError, "Can't fill plot %s (%s) for %s" % (pspec.name, expr, self._cname)
+            filled[(j,i)] = histo
+        if engine.size(): 
+            if common != None: self._selectEntries(self._adaptedCut(common))
+            try:
+                addStat('entries', engine.run(*self._drawRange()))
+            finally:
+                if common != None: self._selectEntries(None)
+        for (j,i) in todo:
+            pspec = plotspecs[i]
+            histo = filled.get((j,i),None)
+            if histo != None and not (canKeys[(j,i)] and self._wantsKeysPdf(histo)):
+                self.negativeCheck(histo)
+                histo.SetName(pspec.name)
+                rets[j][i] = histo
+                if cache: cache.put(keys[(j,i)], histo)
+            else:
+                rets[j][i] = self.getPlotRaw(pspec.name, pspec.expr, pspec.bins, cuts[j], pspec)
+        return rets
+    def _variedCut(self,cut,variation):
+        wcut = self._weightedCut(cut,variation)
+        if variation.weight != "1": wcut = "(%s)*(%s)" % (wcut, self._adaptPlotExpr(variation.weight))
+        return wcut
+    def getVariationPlotsRaw(self,cut,plotspecs,variations):
+        """Fill the histograms of all the plotspecs for the nominal cut and weight and for each of the
+           variations (see Variation) in a single loop on the tree. Returns the list of nominal plots,
+           followed by the list of plots of each variation. KeysPdf is used only for the nominal plots."""
+        raw = [ pspec.expr for pspec in plotspecs ] + [ cut, self._weightString, str(self._scaleFactor) ]
+        for v in variations:
+            for old in v.unmatched(raw):
+                if (v.name,old) in _warnedReplacements: continue
+                _warnedReplacements.add((v.name,old))
+                print "WARNING: %s is not used in the plots, cut or weight of %s, the replacement has no effect in variation %s" % (old, self._cname, v.name)
+        wcuts = [ self._weightedCut(cut) ] + [ self._variedCut(cut,v) for v in variations ]
+        exprs = [ [ self._adaptPlotExpr(pspec.expr) for pspec in plotspecs ] ] + [ [ self._adaptPlotExpr(v.adaptExpr(pspec.expr)) for pspec in plotspecs ] for v in variations ]
+        rets = [ [ None for pspec in plotspecs ] for wcut in wcuts ]
+        cache = getPlotCache(self._options)
+        keys = {}
+        if cache:
+            for j,wcut in enumerate(wcuts):
+                for i,pspec in enumerate(plotspecs):
+                    keys[(j,i)] = self._plotCacheKey(cache,exprs[j][i],pspec.bins,wcut,pspec)
+                    rets[j][i] = cache.get(keys[(j,i)])
+                    if rets[j][i] != None: rets[j][i].SetName(pspec.name)
+        todo = [ (j,i) for j in xrange(len(wcuts)) for i in xrange(len(plotspecs)) if rets[j][i] == None ]
+        if not todo: return rets
+        if not self._isInit: self._init()
+        _loadMultiDraw()
+        engine = ROOT.MultiDraw(self._tree)
+        self._pruneBranches(list(set(exprs[j][i] for (j,i) in todo)) + list(set(wcuts[j] for (j,i) in todo)))
+        columns = self._columnarTree()
+        filled = {}
+        canKeys = {}
+        for (j,i) in todo:
+            pspec, expr = plotspecs[i], exprs[j][i]
+            (histo,canKeys[(j,i)],unbinnedData2D) = self._bookHisto("dummy_var_%d_%d" % (j,i),expr,pspec.bins,pspec)
+            if unbinnedData2D: continue
+            if columns and columns.fill(histo, expr, wcuts[j]):
+                filled[(j,i)] = histo
+                continue
+            vars = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+            vars.reverse() # TTree::Draw syntax is z:y:x
+            vars += [ "" ] * (3-len(vars))
+            if engine.add(histo, vars[0], vars[1], vars[2], wcuts[j]) == -1:
+                raise RuntimeError, "Can't fill plot %s (%s) for %s" % (pspec.name, expr, self._cname)
+            filled[(j,i)] = histo
+        if engine.size():
+            # the nominal selection can be used to skip events only if no variation changes it
+            common = self._adaptedCut(cut) if all(v.adaptExpr(cut) == cut for v in variations) else None
+            if common != None: self._selectEntries(common)
+            try:
+                addStat('entries', engine.run(*self._drawRange()))
+            finally:
+                if common != None: self._selectEntries(None)
+        for (j,i) in todo:
+            pspec = plotspecs[i]
+            histo = filled.get((j,i),None)
+            if histo != None and not (j == 0 and canKeys[(j,i)] and self._wantsKeysPdf(histo)):
+                self.negativeCheck(histo)
+                histo.SetName(pspec.name)
+                rets[j][i] = histo
+                if cache: cache.put(keys[(j,i)], histo)
+            elif j == 0:
+                rets[j][i] = self.getPlotRaw(pspec.name, pspec.expr, pspec.bins, cut, pspec)
+            else:
+                raise RuntimeError, "Can't make the %s variation of plot %s for %s" % (variations[j-1].name, pspec.name, self._cname)
+        return rets
+    def stepCut(self,cuts,step):
+        """The selection at a step of the cut-flow (see getCutFlowPlotsRaw)"""
+        if step == len(cuts.cuts()): return cuts.allCuts()
+        if self._options.nMinusOne: return cuts.nMinusOneCuts()[step-1][1]
+        return cuts.sequentialCuts()[step-1][1]
+    def getCutFlowPlotsRaw(self,cuts,steps,plotspecs):
+        """Fill the histograms of all the plotspecs for several steps of the cut-flow in a single loop on the
+           tree, evaluating each cut at most once per event. A step is the number of leading cuts applied or,
+           with n-minus-one, the index of the cut that is not applied (all cuts if equal to the number of cuts).
+           Returns the list of plots for each step, as getManyPlotsRaw(stepCut(cuts,step), plotspecs) would."""
+        allcuts = cuts.cuts()
+        stepCuts = [ self.stepCut(cuts,step) for step in steps ]
+        fallback = lambda : [ self.getManyPlotsRaw(cut,plotspecs) for cut in stepCuts ]
+        if self._options.columnar or not allcuts: return fallback()
+        if self._options.nMinusOne and len(set(cn for cn,cv in allcuts)) != len(allcuts): return fallback()
+        exprs = [ self._adaptPlotExpr(pspec.expr) for pspec in plotspecs ]
+        rets = [ [ None for pspec in plotspecs ] for step in steps ]
+        cache = getPlotCache(self._options)
+        keys = {}
+        if cache:
+            for j,cut in enumerate(stepCuts):
+                wcut = self._weightedCut(cut)
+                for i,pspec in enumerate(plotspecs):
+                    keys[(j,i)] = self._plotCacheKey(cache,exprs[i],pspec.bins,wcut,pspec)
+                    rets[j][i] = cache.get(keys[(j,i)])
+                    if rets[j][i] != None: rets[j][i].SetName(pspec.name)
+        todo = [ (j,i) for j in xrange(len(steps)) for i in xrange(len(plotspecs)) if rets[j][i] == None ]
+        if not todo: return rets
+        adapted = [ self._adaptedCut(cv) for cn,cv in allcuts ]
+        weight = self._eventWeight()
+        if not self._isInit: self._init()
+        _loadMultiDraw()
+        engine = ROOT.MultiDraw(self._tree)
+        engine.setNMinusOne(bool(self._options.nMinusOne))
+        for cv in adapted:
+            if engine.addCut(cv) == -1: return fallback()
+        self._pruneBranches([ exprs[i] for (j,i) in todo ] + adapted + [ weight ])
+        filled = {}
+        canKeys = {}
+        for (j,i) in todo:
+            pspec, expr = plotspecs[i], exprs[i]
+            (histo,canKeys[(j,i)],unbinnedData2D) = self._bookHisto("dummy_cutflow_%d_%d" % (j,i),expr,pspec.bins,pspec)
+            if unbinnedData2D: continue
+            vars = [ e.replace("--","::") for e in expr.replace("::","--").split(":") ]
+            vars.reverse() # TTree::Draw syntax is z:y:x
+            vars += [ "" ] * (3-len(vars))
+            if engine.add(histo, vars[0], vars[1], vars[2], weight, steps[j]) == -1:
+                raise RuntimeError, "Can't fill plot %s (%s) for %s" % (pspec.name, expr, self._cname)
+            filled[(j,i)] = histo
+        if engine.size():
+            self._selectEntries(adapted[0]) # needed by all the steps
+            try:
+                addStat('entries', engine.run(*self._drawRange()))
+            finally:
+                self._selectEntries(None)
+        for (j,i) in todo:
+            pspec = plotspecs[i]
+            histo = filled.get((j,i),None)
+            if histo != None and not (canKeys[(j,i)] and self._wantsKeysPdf(histo)):
+                self.negativeCheck(histo)
+                histo.SetName(pspec.name)
+                rets[j][i] = histo
+                if cache: cache.put(keys[(j,i)], histo)
+            else:
+                rets[j][i] = self.getPlotRaw(pspec.name, pspec.expr, pspec.bins, stepCuts[j], pspec)
+        return rets
     def negativeCheck(self,histo):
+        if self._entryRange: return # partial result, to be checked after merging the chunks
         if not self._options.allowNegative: 
             if "TH1" in histo.ClassName():
                 for b in xrange(0,histo.GetNbinsX()+2):
@@ -380,6 +1017,10 @@ class TreeToYield:
                     for by in xrange(0,histo.GetNbinsY()+2):
                         for bz in xrange(0,histo.GetNbinsZ()+2):
                             if histo.GetBinContent(bx,by,bz) < 0: histo.SetBinContent(bx,by,bz, 0.0); histo.SetBinError(bx,by,bz, 0.0)
+            elif histo.InheritsFrom("THnBase"):
+                # only the filled bins
+                for b in xrange(histo.GetNbins()):
+                    if histo.GetBinContent(b) < 0: histo.SetBinContent(b, 0.0); histo.SetBinError2(b, 0.0)
 
     def __str__(self):
         mystr = ""
@@ -425,6 +1066,13 @@ def addTreeToYieldOptions(parser):
     parser.add_option("--s2v", "--scalar2vector",     dest="doS2V",    action="store_true", default=False, help="Do scalar to vector conversion") 
     parser.add_option("--neg", "--allow-negative-results",     dest="allowNegative",    action="store_true", default=False, help="If the total yield is negative, keep it so rather than truncating it to zero") 
     parser.add_option("--max-entries",     dest="maxEntries", default=1000000000, type="int", help="Max entries to process in each tree") 
+    parser.add_option("--cache-dir",       dest="cacheDir", type="string", default=None, help="Directory of a persistent cache of plots and yields, keyed on trees, expressions, cuts and weights (default: no cache)") 
+    parser.add_option("--cache-size",      dest="cacheSize", type="int", default=2000, help="Maximum size in MB of the plot cache; the least recently used entries are removed beyond it") 
+    parser.add_option("--prune-branches",  dest="pruneBranches", action="store_true", default=False, help="Disable all the branches not used by the cuts, weights and plot expressions (after MC corrections and s2v), also in friend trees, and report the bytes not read") 
+    parser.add_option("--entry-lists",     dest="entryLists", action="store_true", default=False, help="Find only once the entries passing each selection, and read only those for all the plots with the same selection (stored also in the --cache-dir, if any)") 
+    parser.add_option("--columnar",        dest="columnar", action="store_true", default=False, help="Read the scalar branches used by the cuts, weights and plots in numpy arrays once per component, and evaluate on them all the expressions that can be translated (others still use TTree::Draw)") 
+    parser.add_option("--check-friends",   dest="checkFriends", action="store_true", default=False, help="Check that the entries of the friend trees are the same events as those of the main tree (the event numbers of the main tree are saved next to it, in a .evtidx.npy file); if the main tree is a skim, match the friend entries by event number instead of by entry number")
+    parser.add_option("--single-pass",     dest="singlePass", action="store_true", default=False, help="Fill all the plots (or all the yields of the cut-flow) of a component in a single loop on its tree, instead of one TTree::Draw per plot (or per cut)") 
 
 def mergeReports(reports):
     import copy
@@ -452,3 +1100,15 @@ def mergePlots(name,plots):
             one.Add(two)
     return one
 
+def denseHisto(histo,name=None):
+    """A TH2D/TH3D with the contents of a sparse histogram (THnSparse), for the code that needs the dense ones;
+       other histograms are returned as they are"""
+    if not histo.InheritsFrom("THnBase"): return histo
+    if name == None: name = histo.GetName()
+    if histo.GetNdimensions() == 2: ret = histo.Projection(1,0,"EO") # (ydim, xdim)
+    else:                           ret = histo.Projection(0,1,2,"EO")
+    ret.SetDirectory(None)
+    ret.SetName(name)
+    ret.SetTitle(histo.GetTitle())
+    return ret
+
@@ -16,3 +16,32 @@ def friendPtRelv2(lep,additionalJEC=1):
     l.SetPtEtaPhiM(lep.pt,lep.eta,lep.phi,lep.mass)
     if ((m-l).Rho()<1e-4): return 0 # lep.jet==lep (no match) or jet containing only the lepton
     return l.Perp((m-l).Vect())
+
+## the same on the columns of a ColumnCollection (numpy arrays of all the leptons of a chunk of events)
+def _p3(pt,eta,phi):
+    return numpy.array([pt*numpy.cos(phi), pt*numpy.sin(phi), pt*numpy.sinh(eta)])
+def friendJetLepAwareJECColumns(lep,additionalJEC=1):
+    """Returns (p3, E) of the lepton-aware jet, with p3 an array of shape (3, number of leptons)"""
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        lp = _p3(lep.pt,lep.eta,lep.phi)
+        le = numpy.sqrt((lp*lp).sum(axis=0) + lep.mass*lep.mass)
+        raw = lep.jetRawPt/lep.jetPt
+        jp = _p3(lep.jetPt,lep.jetEta,lep.jetPhi)*raw
+        je = lep.jetE*raw
+        onlyLep = (numpy.sqrt(((jp-lp)**2).sum(axis=0)) < 1e-4) # matched to jet containing only the lepton
+        scale = lep.jetCorrFactor_L1L2L3Res*additionalJEC
+        jp = (jp-lp*(1.0/lep.jetCorrFactor_L1))*scale+lp
+        je = (je-le*(1.0/lep.jetCorrFactor_L1))*scale+le
+        return (numpy.where(onlyLep,lp,jp), numpy.where(onlyLep,le,je))
+def friendPtRatiov2Columns(lep,additionalJEC=1):
+    (jp,je) = friendJetLepAwareJECColumns(lep,additionalJEC)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return lep.pt/numpy.hypot(jp[0],jp[1])
+def friendPtRelv2Columns(lep,additionalJEC=1):
+    (jp,je) = friendJetLepAwareJECColumns(lep,additionalJEC)
+    lp = _p3(lep.pt,lep.eta,lep.phi)
+    d  = jp-lp
+    d2 = (d*d).sum(axis=0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        perp = numpy.sqrt(numpy.maximum((lp*lp).sum(axis=0) - (lp*d).sum(axis=0)**2/d2, 0))
+    return numpy.where(numpy.sqrt(d2) < 1e-4, 0., perp) # lep.jet==lep (no match) or jet containing only the lepton
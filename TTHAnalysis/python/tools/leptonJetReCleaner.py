@@ -436,6 +436,35 @@ def _susy2lss_multiIso_relaxedForInSituApp(lep):
         else:                    A,B,C = (0.4,0.80,7.2)
         return lep.miniRelIso < A and (1/lep.jetPtRatiov2 < (1/B + lep.miniRelIso) or lep.jetPtRelv2 > C)
 
+## the same selections on the columns of a ColumnCollection (numpy arrays of all the leptons of a chunk of events)
+def _susy2lss_idEmu_cuts_columns(lep):
+    barrel = (abs(lep.etaSc)<1.479)
+    return (abs(lep.pdgId)!=11) | ((lep.sigmaIEtaIEta<numpy.where(barrel,0.011,0.031)) & (lep.hadronicOverEm<0.08) & (abs(lep.dEtaScTrkIn)<0.01) &
+                                   (abs(lep.dPhiScTrkIn)<numpy.where(barrel,0.04,0.08)) & (abs(lep.eInvMinusPInv)<0.01))
+
+def _susy2lss_idIsoEmu_cuts_columns(lep):
+    return (abs(lep.pdgId)!=11) | (_susy2lss_idEmu_cuts_columns(lep) & (lep.ecalPFClusterIso<0.45*lep.pt) & (lep.hcalPFClusterIso<0.25*lep.pt) & (lep.dr03TkSumPt<0.2*lep.pt))
+
+def _susy2lss_lepId_CBloose_columns(lep):
+    aeta = abs(lep.eta)
+    muon = (abs(lep.pdgId) == 13) & (lep.pt > 5)
+    electron = ((abs(lep.pdgId) == 11) & (lep.pt > 7) & (lep.convVeto != 0) & (lep.lostHits <= 1) &
+                (lep.mvaIdSpring15 > -0.70+(-0.83+0.70)*(aeta>0.8)+(-0.92+0.83)*(aeta>1.479)) & _susy2lss_idEmu_cuts_columns(lep))
+    return muon | electron
+
+def _susy2lss_lepId_loosestFO_columns(lep):
+    muon = (abs(lep.pdgId) == 13) & (lep.mediumMuonId > 0) & (lep.tightCharge > 0)
+    electron = (abs(lep.pdgId) == 11) & (lep.convVeto != 0) & (lep.tightCharge > 1) & (lep.lostHits == 0)
+    return _susy2lss_lepId_CBloose_columns(lep) & (muon | electron)
+
+def _susy2lss_lepId_tighterFO_columns(lep):
+    aeta = abs(lep.eta)
+    electron = (lep.mvaIdSpring15 > -0.155+(-0.56+0.155)*(aeta>0.8)+(-0.76+0.56)*(aeta>1.479)) & _susy2lss_idIsoEmu_cuts_columns(lep)
+    return _susy2lss_lepId_loosestFO_columns(lep) & ((abs(lep.pdgId) != 11) | electron)
+
+def _susy2lss_lepId_IPcuts_columns(lep):
+    return (lep.sip3d<4) & (abs(lep.dxy)<0.05) & (abs(lep.dz)<0.1)
+
 #def _susy2lss_multiIso_withMiniIsoRelaxed_ConePtJetPtRatiov2(lep):
 #        if abs(lep.pdgId) == 13: A,B,C = (0.4,0.76,7.2)
 #        else:                    A,B,C = (0.4,0.80,7.2)
@@ -1,11 +1,16 @@
 from CMGTools.TTHAnalysis.treeReAnalyzer import *
 
 class ObjFloatCalc:
-    def __init__(self,label,coll,newvars,sizelimit=10):
+    """columnVars, if given, are the same functions written for ColumnCollection (numpy arrays
+       of all the objects of a chunk of events): they're used instead of newvars when the
+       events are read in chunks"""
+    def __init__(self,label,coll,newvars,sizelimit=10,columnVars=None):
         self.label = "" if (label in ["",None]) else (label)
         self.coll = coll
         self.newvars = newvars
         self.sizelimit = sizelimit
+        self.columnVars = columnVars
+        self._chunk = None
     def listBranches(self):
         biglist = [ ("n"+self.coll,"I") ]
         biglist.extend([(self.coll+"_"+newvar,"F",100,"n"+self.coll) for newvar in self.newvars.keys()])
@@ -16,6 +21,8 @@ class ObjFloatCalc:
         except AssertionError:
             print 'ERROR in ObjFloatCalc: branch size limit is '+str(self.sizelimit)+' while n'+self.coll+'=='+str(getattr(event,"n"+self.coll))
             raise
+        if self.columnVars != None and event._chunk != None:
+            return self._fromColumns(event)
         objs = [l for l in Collection(event,self.coll,"n"+self.coll)]
         ret = {"n"+self.coll : getattr(event,"n"+self.coll) }
         for newvar in self.newvars.keys():
@@ -23,6 +30,17 @@ class ObjFloatCalc:
             for i,ob in enumerate(objs):
                 ret[self.coll+"_"+newvar][i] = self.newvars[newvar](ob)
         return ret
+    def _fromColumns(self,event):
+        if self._chunk is not event._chunk:
+            objs = ColumnCollection(event._chunk,self.coll,"n"+self.coll)
+            self._chunk, self._values = event._chunk, {}
+            for newvar,func in self.columnVars.iteritems():
+                self._values[newvar] = objs.split(func(objs))
+        i = event._entry - self._chunk.first
+        ret = {"n"+self.coll : getattr(event,"n"+self.coll) }
+        for newvar,values in self._values.iteritems():
+            ret[self.coll+"_"+newvar] = values[i]
+        return ret
 
 if __name__ == '__main__':
     from sys import argv
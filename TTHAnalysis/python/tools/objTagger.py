@@ -1,11 +1,16 @@
 from CMGTools.TTHAnalysis.treeReAnalyzer import *
 
 class ObjTagger:
-    def __init__(self,label,coll,sel,sizelimit=10):
+    """columnSel, if given, is the same selection written for ColumnCollection (numpy arrays
+       of all the objects of a chunk of events, so with &, | and numpy.where instead of and, or, if):
+       it's used instead of sel when the events are read in chunks"""
+    def __init__(self,label,coll,sel,sizelimit=10,columnSel=None):
         self.label = "" if (label in ["",None]) else (label)
         self.coll = coll
         self.sel = sel
         self.sizelimit = sizelimit
+        self.columnSel = columnSel
+        self._chunk = None
     def listBranches(self):
         biglist = [ ("n"+self.coll,"I"), ("n"+self.coll+"_"+self.label, "I"), (self.coll+"_is"+self.label,"I",100,"n"+self.coll) ]
         return biglist
@@ -15,6 +20,8 @@ class ObjTagger:
         except AssertionError:
             print 'ERROR in ObjTagger: branch size limit is '+str(self.sizelimit)+' while n'+self.coll+'=='+str(getattr(event,"n"+self.coll))
             raise
+        if self.columnSel != None and event._chunk != None:
+            return self._fromColumns(event)
         objs = [l for l in Collection(event,self.coll,"n"+self.coll)]
         ret = {"n"+self.coll : getattr(event,"n"+self.coll) }
         ret["n"+self.coll+"_"+self.label]=0
@@ -29,6 +36,15 @@ class ObjTagger:
                 ret["n"+self.coll+"_"+self.label] += 1
                 ret[self.coll+"_is"+self.label][i] = 1
         return ret
+    def _fromColumns(self,event):
+        if self._chunk is not event._chunk:
+            objs = ColumnCollection(event._chunk,self.coll,"n"+self.coll)
+            passing = numpy.ones(len(objs), dtype=bool)
+            for selector in self.columnSel:
+                passing &= (selector(objs) != 0)
+            self._chunk, self._tags = event._chunk, objs.split(passing.astype(numpy.int64))
+        tags = self._tags[event._entry - self._chunk.first]
+        return { "n"+self.coll : getattr(event,"n"+self.coll), "n"+self.coll+"_"+self.label : sum(tags), self.coll+"_is"+self.label : tags }
 
 if __name__ == '__main__':
     from sys import argv
@@ -10,22 +10,146 @@ sys.argv = ['-b']
 import ROOT
 sys.argv = args
 ROOT.gROOT.SetBatch(True)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #### ========= EDM/FRAMEWORK =======================
+class EventChunk:
+    """The values of the branches for a range of consecutive entries of a tree.
+       Each branch is read when first asked for, for all the entries of the range at once,
+       and kept in memory as a list of python values (or of lists, for arrays)"""
+    _types = { 'TLeafF':float, 'TLeafD':float, 'TLeafI':int, 'TLeafS':int, 'TLeafB':int, 'TLeafL':int, 'TLeafO':bool }
+    def __init__(self,tree,first,n):
+        self._tree = tree
+        self.first = first
+        self.n = n
+        self._columns = {}
+        self._arrays = {}
+    def __contains__(self,entry):
+        return self.first <= entry < self.first + self.n
+    def get(self,name,entry):
+        """Value of the branch for the entry, or None if the branch can't be read this way"""
+        if name not in self._columns: self._columns[name] = self._read(name)
+        col = self._columns[name]
+        return col[entry - self.first] if col != None else None
+    def array(self,name):
+        """All the values of the branch in the range, one entry after the other, as a numpy array
+           (or None if the branch can't be read this way)"""
+        if name not in self._arrays: self._arrays[name] = self._readArray(name)
+        return self._arrays[name][0] if self._arrays[name] != None else None
+    def _draw(self,expr,size):
+        estimate = self._tree.GetEstimate()
+        self._tree.SetEstimate(size + 1)
+        rows = self._tree.Draw(expr, "", "goff", self.n, self.first)
+        if rows > size:
+            self._tree.SetEstimate(rows + 1)
+            rows = self._tree.Draw(expr, "", "goff", self.n, self.first)
+        ret = []
+        for i in xrange(expr.count(":")+1):
+            buf = getattr(self._tree, "GetV%d" % (i+1))()
+            if hasattr(buf,'SetSize'): buf.SetSize(rows)
+            ret.append(numpy.frombuffer(buf, dtype=numpy.float64, count=rows) if rows > 0 else numpy.zeros(0))
+        self._tree.SetEstimate(estimate)
+        return ret
+    def _readArray(self,name):
+        """Returns (values, lengths, python type), with lengths = None for scalars"""
+        if numpy == None or self._tree.GetAlias(name): return None
+        leaf = self._tree.GetLeaf(name)
+        if not leaf or leaf.IsA().GetName() not in self._types: return None
+        pytype = self._types[leaf.IsA().GetName()]
+        size = leaf.GetLenStatic()
+        if leaf.GetLeafCount():
+            (vals, entries) = self._draw("%s:Entry$" % name, self.n * size * max(leaf.GetLeafCount().GetMaximum(),1))
+            lengths = numpy.bincount(entries.astype(numpy.int64) - self.first, minlength=self.n)
+        else:
+            (vals,) = self._draw(name, self.n * size)
+            if len(vals) != self.n * size: return None
+            lengths = numpy.repeat(size, self.n) if size > 1 else None
+        return (numpy.array(vals), lengths, pytype)
+    def _read(self,name):
+        arr = self._arrays[name] if name in self._arrays else self._readArray(name)
+        if arr == None: return None
+        (vals, lengths, pytype) = arr
+        vals = vals.astype(numpy.int64).tolist() if pytype == int else vals.tolist()
+        if pytype == bool: vals = [ bool(v) for v in vals ]
+        if lengths is None: return vals
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).tolist()
+        return [ vals[offsets[i]:offsets[i+1]] for i in xrange(self.n) ]
+
+class ColumnCollection:
+    """A collection for all the entries of an EventChunk: each attribute is a numpy array
+       with the values for all the objects, one entry after the other"""
+    def __init__(self,chunk,prefix,len):
+        self._chunk = chunk
+        self._prefix = prefix+"_"
+        counts = chunk.array(len)
+        if counts is None: raise RuntimeError, "Can't read %s for collection %s" % (len,prefix)
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(counts.astype(numpy.int64))))
+    def __len__(self):
+        return int(self.offsets[-1])
+    def __getattr__(self,name):
+        if name[:2] == "__" and name[-2:] == "__":
+            raise AttributeError, name
+        vals = self._chunk.array(self._prefix+name)
+        if vals is None or vals.shape[0] != len(self): raise AttributeError, self._prefix+name
+        self.__dict__[name] = vals ## cache
+        return vals
+    def split(self,values):
+        """Lists of the values (one per object) for each entry of the chunk"""
+        vals = (numpy.asarray(values) * numpy.ones(len(self), dtype=numpy.asarray(values).dtype)).tolist()
+        off = self.offsets.tolist()
+        return [ vals[off[i]:off[i+1]] for i in xrange(self._chunk.n) ]
+
+def _enableFormulaBranches(tree,formula):
+    """TTreeFormula doesn't read disabled branches: enable the ones it uses"""
+    for i in xrange(formula.GetNcodes()):
+        leaf = formula.GetLeaf(i)
+        if leaf: tree.SetBranchStatus(leaf.GetBranch().GetName(), 1)
+
 class Event:
-    def __init__(self,tree,entry):
+    def __init__(self,tree,entry,chunk=None,lazy=False):
         self._tree = tree
         self._entry = entry
-        self._sync()
+        self._chunk = chunk
+        self._lazy = lazy
+        self._loaded = set()
+        if chunk == None and not lazy: self._sync()
         self._isEval = False
     def _sync(self):
         if self._tree.entry != self._entry:
             self._tree.GetEntry(self._entry)
             self._tree.entry = self._entry
+    def _load(self):
+        """Make the tree ready to evaluate formulas on this entry: when reading in chunks or lazily,
+           the formulas read by themselves the branches they need"""
+        if self._chunk == None and not self._lazy:
+            self._sync()
+        elif self._tree.GetReadEntry() != self._entry:
+            self._tree.LoadTree(self._entry)
+    def _loadBranch(self,name):
+        """Read only the branch of this leaf (and of its counter) for this entry, even if disabled"""
+        if name in self._loaded: return
+        self._loaded.add(name)
+        leaf = self._tree.GetLeaf(name)
+        if not leaf: return
+        if self._tree.GetReadEntry() != self._entry: self._tree.LoadTree(self._entry)
+        for l in leaf.GetLeafCount(), leaf:
+            if not l: continue
+            branch = l.GetBranch()
+            branch.GetEntry(branch.GetTree().GetReadEntry(), 1)
+        if hasattr(self._tree,'_usedBranches'): self._tree._usedBranches.add(leaf.GetBranch().GetName())
     def __getattr__(self,name):
         if name in self.__dict__: return self.__dict__[name]
-        if name == "metLD": return self._tree.met*0.00397 + self._tree.mhtJet25*0.00265
-        self._sync()
+        if name == "metLD": return self.met*0.00397 + self.mhtJet25*0.00265
+        if self._chunk != None and "(" not in name:
+            val = self._chunk.get(name,self._entry)
+            if val != None: return val
+        if not self._lazy: 
+            self._sync()
+        elif "(" not in name:
+            self._loadBranch(name)
         if "(" in name:
             self._isEval = True
             ret = eval(name, globals(), self)
@@ -54,14 +178,18 @@ class Event:
             else:
                 formula.go = formula.EvalInstance
             self._tree._exprs[expr] = formula
+            if hasattr(self._tree,'_activeBranches'): _enableFormulaBranches(self._tree,formula)
             # force sync, to be safe
-            self._tree.GetEntry(self._entry)
-            self._tree.entry = self._entry
+            if self._chunk == None and not self._lazy:
+                self._tree.GetEntry(self._entry)
+                self._tree.entry = self._entry
+            else:
+                self._tree.LoadTree(self._entry)
             #self._tree._exprs[expr].SetQuickLoad(False)
         else:
-            self._sync()
+            self._load()
             formula = self._tree._exprs[expr]
-        if "[" in expr: # unclear why this is needed, but otherwise for some arrays x[i] == 0 for all i > 0
+        if "[" in expr or self._chunk != None or self._lazy: # unclear why this is needed, but otherwise for some arrays x[i] == 0 for all i > 0
             formula.GetNdata()
         return formula.go()
             
@@ -160,6 +288,9 @@ class Module:
         pass
     def analyze(self,event):
         pass
+    def requiredBranches(self):
+        """Names (or patterns) of the branches read in analyze, or None if not known"""
+        return None
     def book(self,what,name,*args):
         return self._booker.book(what,name,*args)
     def beginComponent(self,component):
@@ -172,15 +303,62 @@ class Module:
 class EventLoop:
     def __init__(self,modules):
         self._modules = modules
-    def loop(self,trees,maxEvents=-1,cut=None,eventRange=None):
+    def loop(self,trees,maxEvents=-1,cut=None,eventRange=None,chunkSize=0,onlyUsedBranches=False,sampleEvents=100):
+        """If chunkSize > 0 (and numpy is available), the branches are read chunkSize entries at a time.
+           If onlyUsedBranches, each branch is read only when asked for, and all the branches that are
+           not declared by the modules in requiredBranches() (or, if some module doesn't declare them,
+           not used in the first sampleEvents events) are disabled."""
+        for m in self._modules: m.beginJob()
+        self._loop(trees,maxEvents,cut,eventRange,chunkSize,onlyUsedBranches,sampleEvents)
+        for m in self._modules: m.endJob()
+    def loopParallel(self,fname,treename,ranges,processes,vectorTree=True,**kwargs):
+        """Run the loop on these ranges of entries of a tree, with a pool of processes (the other arguments
+           are those of loop). Each process fills its own copy of the booked histograms in memory, and only
+           their contents are sent back and summed into the histograms of the modules' bookers, so that
+           there's a single output file and no need of hadd. Only histograms (TH1, TH2, TH3) can be booked,
+           and other data members of the modules are not merged; endJob is run once, on the sum."""
+        global _parallelLoop
+        if numpy == None: raise RuntimeError, "EventLoop.loopParallel needs numpy"
+        from multiprocessing import Pool
+        _parallelLoop = (self,fname,treename,vectorTree,kwargs)
+        pool = Pool(processes)
+        for m in self._modules: m.beginJob()
+        for results in pool.imap_unordered(_runParallelRange, ranges):
+            for (m,contents) in zip(self._modules,results):
+                if contents != None: m._booker.add(contents)
+        pool.close()
+        pool.join()
+        _parallelLoop = None
+        for m in self._modules: m.endJob()
+    def _loop(self,trees,maxEvents=-1,cut=None,eventRange=None,chunkSize=0,onlyUsedBranches=False,sampleEvents=100):
         modules = self._modules
-        for m in modules: m.beginJob()
         if type(trees) != list: trees = [ trees ]
+        if numpy == None and chunkSize > 0:
+            print "numpy not available, will read the trees event by event"
+            chunkSize = 0
         for tree in trees:
             tree.entry = -1
+            chunk = None
+            declared = None
+            if onlyUsedBranches:
+                tree._usedBranches = set()
+                declared = self.requiredBranches()
+                if declared != None and chunkSize == 0: self._pruneBranches(tree,declared)
+            nev = 0
+            end = tree.GetEntries()
+            if eventRange != None and len(eventRange) > 0: end = min(end, eventRange[-1]+1)
+            if maxEvents > 0: end = min(end, maxEvents-1)
             for i in xrange(tree.GetEntries()) if eventRange == None else eventRange:
                 if maxEvents > 0 and i >= maxEvents-1: break
-                e = Event(tree,i)
+                if chunkSize > 0:
+                    if chunk == None or i not in chunk: 
+                        chunk = EventChunk(tree, i, max(min(chunkSize, end-i),1))
+                    e = Event(tree,i,chunk,lazy=onlyUsedBranches)
+                else:
+                    e = Event(tree,i,lazy=onlyUsedBranches)
+                nev += 1
+                if onlyUsedBranches and declared == None and chunkSize == 0 and nev == sampleEvents:
+                    self._pruneBranches(tree,tree._usedBranches)
                 if cut != None and not e.eval(cut): 
                     continue
                 ret = True
@@ -189,19 +367,54 @@ class EventLoop:
                     if ret == False: break
                 if i > 0 and i % 10000 == 0:
                     print "Processed %8d/%8d entries of this tree" % (i,tree.GetEntries())
-        for m in modules: m.endJob()
+    def requiredBranches(self):
+        ret = set()
+        for m in self._modules:
+            req = m.requiredBranches() if hasattr(m,'requiredBranches') else None
+            if req == None: return None
+            ret.update(req)
+        return ret
+    def _pruneBranches(self,tree,branches):
+        tree.SetBranchStatus("*",0)
+        for b in branches: tree.SetBranchStatus(b,1)
+        if hasattr(tree,'_exprs'):
+            for formula in tree._exprs.itervalues(): _enableFormulaBranches(tree,formula)
+        tree._activeBranches = set(branches)
+        print "Reading only %d branches" % len(branches)
     def beginComponent(self,component):
         for m in self._modules: m.beginComponent(component)
     def endComponent(self,component):
         for m in self._modules: m.endComponent(component)
 
+_parallelLoop = None # (event loop, file name, tree name, vectorTree, loop options) for the processes of EventLoop.loopParallel
+def _runParallelRange(eventRange):
+    (el,fname,treename,vectorTree,kwargs) = _parallelLoop
+    tfile = ROOT.TFile.Open(fname)
+    tree = tfile.Get(treename)
+    tree.vectorTree = vectorTree
+    accumulators = []
+    for m in el._modules:
+        if getattr(m,'_booker',None) != None: m._booker = HistAccumulator()
+        accumulators.append(getattr(m,'_booker',None))
+    for m in el._modules: m.beginJob()
+    el._loop([tree],eventRange=eventRange,**kwargs)
+    ret = [ (acc.contents() if acc != None else None) for acc in accumulators ]
+    tfile.Close()
+    return ret
+
 #### ========= NTUPLING AND HISTOGRAMMING =======================
 class PyTree:
+    """If numpy is available, the branches are backed by numpy arrays, and vectors are set with a
+       single slice assignment"""
+    _dtypes = { 'f':'float32', 'd':'float64', 'i':'int32', 'l':'int64', 's':'int16', 'b':'int8' }
     def __init__(self,tree):
         self.tree = tree
         self._branches = {} ## must be the last line
     def branch(self,name,type,n=1,lenVar=None):
-        arr = array(type.lower(), n*[0 if type in 'iI' else 0.]) 
+        if numpy != None and type.lower() in self._dtypes:
+            arr = numpy.zeros(n, dtype=self._dtypes[type.lower()])
+        else:
+            arr = array(type.lower(), n*[0 if type in 'iI' else 0.]) 
         self._branches[name] = arr
         if n == 1:
             self.tree.Branch(name, arr, name+"/"+type.upper())
@@ -215,12 +428,18 @@ class PyTree:
             arr = self._branches[name]
             if len(arr) == 1:
                 arr[0] = val
+            elif type(arr) != array:
+                n = min(len(val), len(arr))
+                arr[:n] = val[:n]
             else:
                 for i,v in enumerate(val):
                     if i >= len(arr): break
                     arr[i]  = v
         else:
             self.__dict__[name] = val
+    def update(self,values):
+        """Set all the branches in the dictionary"""
+        for name,val in values.iteritems(): self.__setattr__(name,val)
     def fill(self):
         self.tree.Fill()
 
@@ -245,6 +464,15 @@ class BookDir:
         for s in self._subs: s.done()
         for k,v in self._objects.iteritems():
             self.tdir.WriteTObject(v)
+    def add(self,contents):
+        """Add to the booked histograms the contents of others, as given by HistAccumulator.contents()"""
+        subs = dict((s.name,s) for s in self._subs)
+        for path,arrays in contents.iteritems():
+            if "/" in path:
+                (sub,rest) = path.split("/",1)
+                subs[sub].add({rest:arrays})
+            else:
+                _addHistArrays(self._objects[path],arrays)
     def printObj(self,on,o,dir):
         c1 = ROOT.TCanvas("c1","c1",800,600)
         o.Draw()
@@ -264,6 +492,59 @@ class Booker(BookDir):
         BookDir.done(self)
         self.tdir.Close()
 
+class HistAccumulator(BookDir):
+    """Books the histograms in memory, for a job whose results are summed into those of a Booker
+       (see EventLoop.loopParallel): contents() gives them as numpy arrays, to be passed to Booker.add()"""
+    def __init__(self):
+        BookDir.__init__(self,None)
+    def mkdir(self,name):
+        ret = HistAccumulator()
+        ret.name = name
+        self._subs.append(ret)
+        return ret
+    def book(self,what,name,*args):
+        obj = getattr(ROOT,what)(name,*args)
+        if not obj.InheritsFrom("TH1") or obj.InheritsFrom("TProfile") or obj.InheritsFrom("TProfile2D"):
+            raise RuntimeError, "Can only accumulate histograms, not %s (%s)" % (what, name)
+        obj.SetDirectory(None)
+        self._objects[name] = obj
+        return obj
+    def contents(self):
+        """{ path : (bin contents, sum of weights squared or None, statistics, entries) }"""
+        ret = {}
+        for k,v in self._objects.iteritems(): ret[k] = _histArrays(v)
+        for s in self._subs:
+            for k,v in s.contents().iteritems(): ret[s.name+"/"+k] = v
+        return ret
+    def done(self):
+        pass
+
+_histTypes = [ ("TArrayD",'float64'), ("TArrayF",'float32'), ("TArrayI",'int32'), ("TArrayS",'int16'), ("TArrayC",'int8') ]
+def _histArrays(h):
+    n = h.GetNcells()
+    dtype = [ t for (c,t) in _histTypes if h.IsA().InheritsFrom(c) ][0]
+    buf = h.GetArray()
+    if hasattr(buf,'SetSize'): buf.SetSize(n)
+    vals = numpy.frombuffer(buf, dtype=dtype, count=n).astype(numpy.float64)
+    sumw2 = None
+    if h.GetSumw2N():
+        buf = h.GetSumw2().GetArray()
+        if hasattr(buf,'SetSize'): buf.SetSize(n)
+        sumw2 = numpy.frombuffer(buf, dtype=numpy.float64, count=n).copy()
+    stats = numpy.zeros(16)
+    h.GetStats(stats)
+    return (vals, sumw2, stats, h.GetEntries())
+def _addHistArrays(h,(vals,sumw2,stats,entries)):
+    (myvals,mysumw2,mystats,myentries) = _histArrays(h) # before changing the contents, which resets the statistics
+    if sumw2 is not None:
+        if mysumw2 is None: 
+            h.Sumw2()
+            mysumw2 = _histArrays(h)[1]
+        h.GetSumw2().Set(len(sumw2), mysumw2 + sumw2)
+    h.SetContent(myvals + vals)
+    h.PutStats(mystats + stats)
+    h.SetEntries(myentries + entries)
+
 #### ========= UTILITIES =======================
 def deltaPhi(phi1,phi2):
     ## Catch if being called with two objects
@@ -317,7 +598,10 @@ if __name__ == '__main__':
         t.vectorTree = False
     booker = Booker("test.root")
     el = EventLoop([DummyModule("dummy",booker)])
-    el.loop(t,1000)
+    if len(argv) > 2: # number of processes
+        el.loopParallel(argv[1], t.GetName(), [ xrange(i,min(i+250,1000)) for i in xrange(0,1000,250) ], int(argv[2]), vectorTree=t.vectorTree)
+    else:
+        el.loop(t,1000)
     booker.done()
     print "Wrote to test.root"
 